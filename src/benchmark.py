@@ -0,0 +1,59 @@
+from argparse import ArgumentParser
+
+from util.benchmark import BENCHMARK_GROUPS, BENCHMARK_SUITES, BenchmarkRunner, compare_results, load_results, save_results
+
+def parse_arguments():
+    parser = ArgumentParser(description='Benchmark the traffic simulation, without a display.')
+
+    parser.add_argument('--suite',
+                        type=str,
+                        default='quick',
+                        choices=list(BENCHMARK_SUITES),
+                        help='Suite of benchmarks to run.')
+    parser.add_argument('--groups',
+                        type=str,
+                        nargs='+',
+                        default=BENCHMARK_GROUPS,
+                        choices=BENCHMARK_GROUPS,
+                        help='Groups of benchmarks to run.')
+    parser.add_argument('--process-counts',
+                        type=int,
+                        nargs='+',
+                        default=None,
+                        help='Process counts of the simulator benchmark.  Default is 1 and the number of processors.')
+    parser.add_argument('--output',
+                        type=str,
+                        default='benchmark.json',
+                        help='JSON file to write the results to.')
+    parser.add_argument('--baseline',
+                        type=str,
+                        default=None,
+                        help='JSON results of an earlier run to compare against.')
+    parser.add_argument('--tolerance',
+                        type=float,
+                        default=0.1,
+                        help='Largest relative slowdown against the baseline that is not a regression.')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_arguments()
+
+    runner = BenchmarkRunner(suite=args.suite, groups=args.groups, process_counts=args.process_counts)
+    results = runner.run()
+    save_results(args.output, results)
+    runner.log(f'Results saved to {args.output}')
+
+    # A suite whose multi-lane runs never change lanes does not time the whole step
+    if len(runner.inactive) > 0:
+        raise SystemExit(f'{len(runner.inactive)} multi-lane benchmark(s) had no lane changes: {", ".join(runner.inactive)}.')
+
+    # Compare against the baseline, and fail if anything got slower than the tolerance allows
+    if args.baseline is not None:
+        comparison = compare_results(results, load_results(args.baseline), args.tolerance)
+        for row in comparison:
+            ratio = f"{row['Ratio']:.2f}x" if row['Ratio'] is not None else '-'
+            runner.log(f"{row['Status']:>11}  {ratio:>7}  {row['Name']}")
+        regressions = [row for row in comparison if row['Status'] == 'regression']
+        if len(regressions) > 0:
+            raise SystemExit(f'{len(regressions)} benchmark(s) regressed by more than {args.tolerance:.0%} against {args.baseline}.')
+        runner.log(f'No regressions against {args.baseline}.')
@@ -1,6 +1,7 @@
 from typing import List
 # from const.param import *
 from models.carbase import CarBase
+from models.history import History
 
 # Container for car information
 class Car(CarBase):
@@ -27,13 +28,14 @@ class Car(CarBase):
         self.max_v = max_v
 
         self.time_step = time_step
-        self.time = [t_0]
-        self.velocity = [0]
-        self.pos = [x_0]
-        self.headway = [[h_0] for i in range(0, lane_count)]
+        self.time = History([t_0])
+        self.history_offset = 0
+        self.velocity = History([0])
+        self.pos = History([x_0])
+        self.headway = [History([h_0]) for i in range(0, lane_count)]
         self.total_dist = 0
 
-        self.lanes = [lane]
+        self.lanes = History([lane], typecode='i')
         self.lane_count = lane_count
 
         self.lbda = lbda
@@ -42,7 +44,7 @@ class Car(CarBase):
 
         self.color = color
 
-        self.impatience = [0.0]
+        self.impatience = History([0.0])
         self.impatience_step = impatience_step
 
         self.tags = []
@@ -1,22 +1,48 @@
-from typing import List
+from math import floor
+from const.param import ERROR_MARGIN
+from models.history import History, RingHistory
 
 class CarBase:
     def __init__(self, id: int) -> None:
         self.id = id
-        self.pos = []
-        self.velocity = []
-        self.time = []
-        self.lanes = []
-        self.impatience = []
+        self.pos = History()
+        self.velocity = History()
+        self.time = History()
+        self.lanes = History(typecode='i')
+        self.impatience = History()
+        self.headway = []
         self.time_step = 0.05
-    
+
+        # Step of the run at history index 0, nonzero once the history starts over at a
+        # restored or warm started window
+        self.history_offset = 0
+
+    # Preallocate the history of the car so values are written in place during a run
+    # Params:
+    #   - capacity: number of time steps, including the initial state, to make room for
+    def reserve_history(self, capacity: int) -> None:
+        for history in [self.time, self.pos, self.velocity, self.lanes, self.impatience] + self.headway:
+            history.reserve(capacity)
+
+    # Only keep the most recent values of the car's history
+    # Params:
+    #   - depth: number of time steps to keep
+    def limit_history(self, depth: int) -> None:
+        limit = lambda history: RingHistory(history, history.data.typecode, depth)
+        self.time = limit(self.time)
+        self.pos = limit(self.pos)
+        self.velocity = limit(self.velocity)
+        self.lanes = limit(self.lanes)
+        self.impatience = limit(self.impatience)
+        self.headway = [limit(headway) for headway in self.headway]
+
     # Get position at time t
     # Params:
     #   - t: time get get position at
     # Returns:
     #   - position of car at t
     def get_pos_at_time(self, t: float) -> float:
-        return self.__get_at_time__(t, self.pos)
+        return self.__get_at_step__(self.step_at_time(t), self.pos)
 
     # Get velocity at time t
     # Params:
@@ -24,7 +50,7 @@ class CarBase:
     # Returns:
     #   - velocity of car at t
     def get_velocity_at_time(self, t: float) -> float:
-        return self.__get_at_time__(t, self.velocity)
+        return self.__get_at_step__(self.step_at_time(t), self.velocity)
 
     # Get headway at time t
     # Params:
@@ -32,9 +58,7 @@ class CarBase:
     # Returns:
     #   - headway of car at t
     def get_headway_at_time(self, t: float, lane: int) -> float:
-        if lane >= self.lane_count or lane < 0:
-            return 0.0
-        return self.__get_at_time__(t, self.headway[lane])
+        return self.get_headway_at_step(self.step_at_time(t), lane)
 
     # Get lane at time t
     # Params:
@@ -42,7 +66,7 @@ class CarBase:
     # Returns:
     #   - lane of car at t
     def get_lane_at_time(self, t: float) -> float:
-        return self.__get_at_time__(t, self.lanes)
+        return self.__get_at_step__(self.step_at_time(t), self.lanes)
     
     # Get impatience at time t
     # Params:
@@ -50,18 +74,44 @@ class CarBase:
     # Returns:
     #   - impatience of car at t
     def get_impatience_at_time(self, t: float) -> float:
-        return self.__get_at_time__(t, self.impatience)
+        return self.__get_at_step__(self.step_at_time(t), self.impatience)
+
+    # Convert a time to the history index of the step it falls in.  Times that land on a
+    # step boundary up to float rounding are counted as that step.
+    # Params:
+    #   - t: time to convert
+    # Returns:
+    #   - history index of t, negative for times before the start of the history
+    def step_at_time(self, t: float) -> int:
+        return floor(t / self.time_step + ERROR_MARGIN) - self.history_offset
+
+    # The models read history by step index directly, without converting from time
+    # Params:
+    #   - k: history index of the step, values before the first step read the initial state
+    def get_pos_at_step(self, k: int) -> float:
+        return self.__get_at_step__(k, self.pos)
+
+    def get_velocity_at_step(self, k: int) -> float:
+        return self.__get_at_step__(k, self.velocity)
+
+    def get_headway_at_step(self, k: int, lane: int) -> float:
+        if lane >= self.lane_count or lane < 0:
+            return 0.0
+        return self.__get_at_step__(k, self.headway[lane])
+
+    def get_lane_at_step(self, k: int) -> int:
+        return self.__get_at_step__(k, self.lanes)
+
+    def get_impatience_at_step(self, k: int) -> float:
+        return self.__get_at_step__(k, self.impatience)
 
-    # Helper function for getting values at time
+    # Helper function for getting values at a step
     # Params:
-    #   - t: time to get attribute at
+    #   - k: history index to get attribute at
     #   - list: list that you are pulling values from
     # Returns:
-    #   - float: list value at time t
-    def __get_at_time__(self, t: float, list: List[any]) -> float:
-        if t < 0:
+    #   - float: list value at step k
+    def __get_at_step__(self, k: int, list: History) -> float:
+        if k < 0:
             return list[0]
-        i = int(t / self.time_step)
-        if i >= len(list):
-            return None
-        return list[i]
\ No newline at end of file
+        return list.get(k)
@@ -0,0 +1,134 @@
+from array import array
+from typing import Iterable
+
+# Typed, array backed history of a single car attribute.
+# Storage can be preallocated with reserve() so that values are written by step index
+# instead of growing a list of boxed floats; each value then costs one machine word.
+# Supports the list operations the models rely on (append, indexing, len, iteration).
+class History:
+    __slots__ = ('data', 'length')
+
+    # Params:
+    #   - values: initial values of the history
+    #   - typecode: array typecode of the stored values, 'd' for floats and 'i' for integers
+    def __init__(self, values: Iterable = (), typecode: str = 'd') -> None:
+        self.data = array(typecode)
+        self.length = 0
+        for value in values:
+            self.append(value)
+
+    # Wrap existing storage, such as a numpy view, without copying it
+    # Params:
+    #   - data: indexable storage holding the values
+    #   - length: number of values held, defaults to the length of data
+    @classmethod
+    def wrap(cls, data, length: int = None) -> 'History':
+        history = cls.__new__(cls)
+        history.data = data
+        history.length = len(data) if length is None else length
+        return history
+
+    # Get the value at step i without the overhead of list style indexing
+    # Params:
+    #   - i: non-negative step index
+    # Returns:
+    #   - value at step i, or None if step i has not been written yet
+    def get(self, i: int):
+        if i >= self.length:
+            return None
+        return self.data[i]
+
+    # Make room for at least capacity values without reallocating
+    # Params:
+    #   - capacity: total number of values the history should be able to hold
+    def reserve(self, capacity: int) -> None:
+        missing = capacity - len(self.data)
+        if missing > 0:
+            self.data.frombytes(bytes(missing * self.data.itemsize))
+
+    def append(self, value) -> None:
+        if self.length == len(self.data):
+            self.reserve(max(2 * self.length, 16))
+        self.data[self.length] = value
+        self.length += 1
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __getitem__(self, i):
+        if i.__class__ is slice:
+            return self.data[:self.length][i]
+        if i < 0:
+            i += self.length
+            if i < 0:
+                raise IndexError('history index out of range')
+        elif i >= self.length:
+            raise IndexError('history index out of range')
+        return self.data[i]
+
+    def __setitem__(self, i: int, value) -> None:
+        if i < 0:
+            i += self.length
+        if i < 0 or i >= self.length:
+            raise IndexError('history index out of range')
+        self.data[i] = value
+
+    def __iter__(self):
+        return iter(self.data[:self.length])
+
+    def __repr__(self) -> str:
+        return f'History({self.data[:self.length].tolist()})'
+
+# Bounded history that only keeps the most recent depth values of an attribute.
+# Indices stay absolute, so step i is read with history[i] for as long as it is one
+# of the last depth steps; reading an older step raises an IndexError.
+class RingHistory(History):
+    __slots__ = ('depth',)
+
+    # Params:
+    #   - values: initial values of the history, only the last depth are kept
+    #   - typecode: array typecode of the stored values, 'd' for floats and 'i' for integers
+    #   - depth: number of most recent values to keep
+    def __init__(self, values: Iterable = (), typecode: str = 'd', depth: int = 2) -> None:
+        self.depth = depth
+        self.data = array(typecode, bytes(depth * array(typecode).itemsize))
+        self.length = 0
+        for value in values:
+            self.append(value)
+
+    # The ring never grows, so there is nothing to reserve
+    def reserve(self, capacity: int) -> None:
+        pass
+
+    def append(self, value) -> None:
+        self.data[self.length % self.depth] = value
+        self.length += 1
+
+    # Translate an absolute index into a position in the ring
+    def __slot__(self, i: int) -> int:
+        if i < 0:
+            i += self.length
+        if i < 0 or i >= self.length:
+            raise IndexError('history index out of range')
+        if i < self.length - self.depth:
+            raise IndexError(f'history index {i} is older than the last {self.depth} steps kept')
+        return i % self.depth
+
+    def get(self, i: int):
+        if i >= self.length:
+            return None
+        return self.data[self.__slot__(i)]
+
+    def __getitem__(self, i):
+        if i.__class__ is slice:
+            return [self.data[self.__slot__(j)] for j in range(*i.indices(self.length))]
+        return self.data[self.__slot__(i)]
+
+    def __setitem__(self, i: int, value) -> None:
+        self.data[self.__slot__(i)] = value
+
+    def __iter__(self):
+        return iter(self[max(self.length - self.depth, 0):])
+
+    def __repr__(self) -> str:
+        return f'RingHistory({list(self)}, depth={self.depth})'
@@ -3,6 +3,7 @@
 #####################
 # Remains in codebase in order to assist porting of legacy scripts to new model from JSON.
 import warnings
+from const.param import ERROR_MARGIN
 from model.traffic_influencer import TrafficInfluencer
 from model.car import Car
 from typing import List
@@ -22,10 +23,10 @@ class InstantLight(TrafficInfluencer):
         self.last_change_time = 0.0
 
     def update_status(self, t: float) -> None:
-        if self.red and (t - self.last_change_time) % self.red_time == 0:
+        if self.red and self.__phase_over__(t, self.red_time):
             self.red = False
             self.last_change_time = t
-        elif not self.red and (t - self.last_change_time) % self.green_time == 0:
+        elif not self.red and self.__phase_over__(t, self.green_time):
             self.red = True
             self.last_change_time = t
     
@@ -35,4 +36,13 @@ class InstantLight(TrafficInfluencer):
         for i in range(0, len(cars)):
             if cars[i].id == self.car_id:
                 cars[i].fix_velocity(influenced_velocity)
-        return cars
\ No newline at end of file
+        return cars
+
+    # Check if the time since the last change is a whole number of phases.  Times are
+    # computed in floating point, so an exact modulo comparison would miss phase changes.
+    # Params:
+    #   - t: current time
+    #   - duration: length of the phase
+    def __phase_over__(self, t: float, duration: float) -> bool:
+        phases = (t - self.last_change_time) / duration
+        return abs(phases - round(phases)) < ERROR_MARGIN
@@ -3,6 +3,7 @@
 #####################
 # Remains in codebase in order to assist porting of legacy scripts to new model from JSON.
 import warnings
+from const.param import ERROR_MARGIN
 from enum import Enum
 
 class LightStatus(Enum):
@@ -27,12 +28,21 @@ class TrafficLight:
         self.light_size = 0
 
     def update_status(self, t: float) -> None:
-        if self.status == LightStatus.RED and (t - self.last_change_time) % self.red_time == 0:
+        if self.status == LightStatus.RED and self.__phase_over__(t, self.red_time):
             self.status = LightStatus.GREEN
             self.last_change_time = t
-        elif self.status == LightStatus.YELLOW and (t - self.last_change_time) % self.yellow_time == 0:
+        elif self.status == LightStatus.YELLOW and self.__phase_over__(t, self.yellow_time):
             self.status = LightStatus.RED 
             self.last_change_time = t
-        elif self.status == LightStatus.GREEN and (t - self.last_change_time) % self.green_time == 0:
+        elif self.status == LightStatus.GREEN and self.__phase_over__(t, self.green_time):
             self.status = LightStatus.YELLOW
-            self.last_change_time = t
\ No newline at end of file
+            self.last_change_time = t
+
+    # Check if the time since the last change is a whole number of phases.  Times are
+    # computed in floating point, so an exact modulo comparison would miss phase changes.
+    # Params:
+    #   - t: current time
+    #   - duration: length of the phase
+    def __phase_over__(self, t: float, duration: float) -> bool:
+        phases = (t - self.last_change_time) / duration
+        return abs(phases - round(phases)) < ERROR_MARGIN
@@ -1,6 +1,7 @@
 from argparse import ArgumentParser
 from typing import List
 
+from util.loggable import LOG_LEVELS, configure_logging
 from util.traffic_simulator import TrafficSimulator
 
 def parse_arguments():
@@ -9,8 +10,13 @@ def parse_arguments():
     parser.add_argument('--simulation-json', 
                         type=str, 
                         nargs='+', 
-                        required=True, 
+                        default=[], 
                         help='JSON file(s) containing simulation parameters.')
+    parser.add_argument('--sweep',
+                        type=str,
+                        nargs='+',
+                        default=[],
+                        help='JSON file(s) describing parameter sweeps over a base config.')
     parser.add_argument('--simulation-count', 
                         type=int, 
                         default=1, 
@@ -23,16 +29,54 @@ def parse_arguments():
                         type=str,
                         default='manifest.csv',
                         help='Output manifest file for keeping track of output runs.')
+    parser.add_argument('--cache',
+                        action='store_true',
+                        help='Skip simulations that already finished with the same parameters, scripts and seed.')
+    parser.add_argument('--fundamental-diagram',
+                        type=str,
+                        default=None,
+                        help='Only collect statistics of each run and write the flow and speed of every Density and lane to this CSV table.')
+    parser.add_argument('--profile',
+                        action='store_true',
+                        help='Time every phase of the steps of each run, and report it in the summary and manifest.')
+    parser.add_argument('--profile-memory',
+                        action='store_true',
+                        help='Profile each run and trace its peak memory as well, which slows the runs down.')
+    parser.add_argument('--progress',
+                        type=int,
+                        default=0,
+                        help='Report the progress of each run every this many steps, and show the progress of all runs together.')
+    parser.add_argument('--progress-seconds',
+                        type=float,
+                        default=10.0,
+                        help='Seconds between views of the progress of all runs.')
+    parser.add_argument('--log-level',
+                        type=str,
+                        default='INFO',
+                        choices=LOG_LEVELS,
+                        help='Lowest level of the messages that are logged.')
+    parser.add_argument('--log-file',
+                        type=str,
+                        default=None,
+                        help='JSON-lines file every logged message is appended to as well.')
     return parser.parse_args()
 
 if __name__ == '__main__':
     args = parse_arguments()
-    if args.simulation_json is None or len(args.simulation_json) == 0:
-        raise ValueError('Please provide at least one JSON configuration.')
+    if len(args.simulation_json) == 0 and len(args.sweep) == 0:
+        raise ValueError('Please provide at least one JSON configuration or sweep.')
+    configure_logging(args.log_level, args.log_file)
 
     # Run simulations
     main = TrafficSimulator(simulation_configs=args.simulation_json, 
         manifest=args.manifest,
         simulation_count=args.simulation_count, 
-        process_count=args.process_count)
+        process_count=args.process_count,
+        sweeps=args.sweep,
+        cache=args.cache,
+        fundamental_diagram=args.fundamental_diagram,
+        profile=args.profile,
+        profile_memory=args.profile_memory,
+        progress=args.progress,
+        progress_seconds=args.progress_seconds)
     main.run()
\ No newline at end of file
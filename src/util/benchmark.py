@@ -0,0 +1,356 @@
+import io
+import json
+import logging
+import os
+import platform
+import numpy as np
+from contextlib import redirect_stdout
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from typing import List
+
+from models.car import Car
+from util.loggable import Loggable
+from util.output_reader import load_cars_from_binary, load_cars_from_csv
+from util.output_sink import open_sink
+from util.profiler import PhaseProfiler
+from util.simulation_from_json import ENGINES
+from util.traffic_simulator import TrafficSimulator
+
+# Version of the results layout, results of another version are not compared
+BENCHMARK_VERSION = 2
+
+# Seed of the car populations and of the lane change draws of every benchmark
+BENCHMARK_SEED = 1234
+
+# Parameters shared by every synthetic run.  Cars are spaced for a density of 0.03 cars per
+# meter in every lane, so the track grows with the number of cars and the work per car stays
+# comparable between sizes.  Top speeds are drawn between MinSpeedFactor * V_max and V_max.
+BENCHMARK_PARAMS = {
+    'Lambda': 1.0,
+    'V_max': 30.0,
+    'd_min': 7.5,
+    'L_car': 5.0,
+    'TimeStep': 0.05,
+    'PassingModifier': 0.1,
+    'ImpatienceStep': 0.01,
+    'Density': 0.03,
+    'MinSpeedFactor': 0.6
+}
+
+# Case every axis of the engine benchmarks is varied around, one axis at a time
+BENCHMARK_CENTER = {'Cars': 100, 'LaneCount': 2, 'ReactionSteps': 4, 'Steps': 200}
+
+# Values of each axis of the engine benchmarks, the number of times every benchmark is
+# repeated, keeping the fastest, and the number of simulations of the simulator benchmark
+BENCHMARK_SUITES = {
+    'quick': {
+        'Cars': [10, 100, 1000],
+        'LaneCount': [1, 2, 4],
+        'ReactionSteps': [0, 4],
+        'Steps': [200],
+        'Repeats': 1,
+        'Simulations': 4
+    },
+    'full': {
+        'Cars': [10, 30, 100, 300, 1000, 3000, 10000],
+        'LaneCount': [1, 2, 3, 4, 5, 6],
+        'ReactionSteps': [0, 1, 4, 10, 20],
+        'Steps': [100, 200, 400, 800],
+        'Repeats': 3,
+        'Simulations': 16
+    }
+}
+
+# Groups of benchmarks:
+#   - engine: evaluating each engine over the axes of the suite, with the time of every phase
+#   - output: writing the full history of the center case as CSV and binary output
+#   - load: loading that output the way the visualizer does
+#   - simulator: simulations per second of the TrafficSimulator process pool
+BENCHMARK_GROUPS = ['engine', 'output', 'load', 'simulator']
+
+# Build a synthetic population that exercises every phase of a step.  Lanes hold fewer cars
+# from left to right, so drivers in the fuller lanes see more headway next to them, grow
+# impatient and change lanes.  Every driver gets a seeded top speed, so faster cars catch up
+# and pass.  The cars of each lane are evenly spaced and shifted by a seeded random offset.
+# Params:
+#   - cars: number of cars
+#   - lane_count: number of lanes
+#   - reaction_steps: reaction time of the drivers in time steps
+#   - seed: seed of the offsets and the top speeds
+# Returns:
+#   - the cars, and the length of the track they are spaced on
+def synthetic_population(cars: int, lane_count: int, reaction_steps: int, seed: int = BENCHMARK_SEED) -> tuple:
+    params = BENCHMARK_PARAMS
+    rng = np.random.default_rng(seed)
+    track_length = cars / lane_count / params['Density']
+    weights = np.arange(lane_count, 0, -1, dtype=np.float64)
+    counts = np.floor(cars * weights / weights.sum()).astype(np.int64)
+    counts[0] += cars - counts.sum()
+    speeds = rng.uniform(params['MinSpeedFactor'], 1.0, cars) * params['V_max']
+
+    population = []
+    for lane, count in enumerate(counts):
+        spacing = track_length / max(count, 1)
+        offsets = rng.uniform(0.0, 0.5 * max(spacing - params['d_min'] - params['L_car'], 0.0), count)
+        for i in range(0, count):
+            population.append(Car(
+                id                  = len(population) + 1,
+                reaction_time       = reaction_steps * params['TimeStep'],
+                headway_threshold   = params['d_min'],
+                x_0                 = (i + lane / lane_count) * spacing + offsets[i],
+                t_0                 = 0,
+                h_0                 = spacing,
+                max_v               = float(speeds[len(population)]),
+                time_step           = params['TimeStep'],
+                lane                = lane,
+                lane_count          = lane_count,
+                impatience_step     = params['ImpatienceStep'],
+                lbda                = params['Lambda']))
+    return sorted(population, key=lambda car: car.pos[-1], reverse=True), track_length
+
+# Runs the benchmarks of a suite without a display, and compares the results to a baseline
+class BenchmarkRunner(Loggable):
+    # Params:
+    #   - suite: name of the suite, see BENCHMARK_SUITES
+    #   - groups: groups of benchmarks to run, see BENCHMARK_GROUPS
+    #   - process_counts: process counts of the simulator benchmark, None for 1 and the number of processors
+    def __init__(self, suite: str = 'quick', groups: List[str] = BENCHMARK_GROUPS, process_counts: List[int] = None) -> None:
+        super().__init__()
+        if suite not in BENCHMARK_SUITES:
+            raise ValueError(f"Unknown benchmark suite '{suite}'.  Must be one of: {', '.join(BENCHMARK_SUITES)}.")
+        for group in groups:
+            if group not in BENCHMARK_GROUPS:
+                raise ValueError(f"Unknown benchmark group '{group}'.  Must be one of: {', '.join(BENCHMARK_GROUPS)}.")
+        self.suite = suite
+        self.spec = BENCHMARK_SUITES[suite]
+        self.groups = list(groups)
+        self.process_counts = sorted(set(process_counts if process_counts is not None else [1, os.cpu_count() or 1]))
+        self.results = []
+
+        # Names of the multi-lane engine benchmarks whose drivers never changed lanes, so the
+        # lane change and passing phases were not really timed
+        self.inactive = []
+
+    # Run every group of the suite
+    # Returns:
+    #   - machine readable results, as written by save
+    def run(self) -> dict:
+        self.results = []
+        self.inactive = []
+        with TemporaryDirectory() as directory:
+            if 'engine' in self.groups:
+                self.run_engines()
+            if 'output' in self.groups or 'load' in self.groups:
+                self.run_output(directory)
+            if 'simulator' in self.groups:
+                self.run_simulator(directory)
+        return {
+            'Version': BENCHMARK_VERSION,
+            'Suite': self.suite,
+            'Seed': BENCHMARK_SEED,
+            'Python': platform.python_version(),
+            'NumPy': np.__version__,
+            'Platform': platform.platform(),
+            'Processors': os.cpu_count(),
+            'Results': self.results
+        }
+
+    # Returns:
+    #   - every engine case of the suite, each axis varied on its own around the center case
+    def engine_cases(self) -> List[dict]:
+        cases = []
+        for axis in ['Cars', 'LaneCount', 'ReactionSteps', 'Steps']:
+            for value in self.spec[axis]:
+                case = dict(BENCHMARK_CENTER, **{axis: value})
+                if case not in cases:
+                    cases.append(case)
+        return cases
+
+    # Params:
+    #   - engine: name of the engine, see util.simulation_from_json.ENGINES
+    #   - case: number of cars and lanes, reaction time in steps and number of steps
+    #   - history: history mode of the model
+    # Returns:
+    #   - model of the case, ready to evaluate
+    def build_model(self, engine: str, case: dict, history: str = 'ring'):
+        cars, track_length = synthetic_population(case['Cars'], case['LaneCount'], case['ReactionSteps'])
+        params = BENCHMARK_PARAMS
+        with redirect_stdout(io.StringIO()):
+            return ENGINES[engine](lbda=params['Lambda'],
+                start_time=0,
+                max_time=case['Steps'] * params['TimeStep'],
+                collision_threshold=params['L_car'],
+                time_step=params['TimeStep'],
+                track_length=track_length,
+                cars=cars,
+                lane_count=case['LaneCount'],
+                lane_vmax_weights=[1.0 + 0.1 * lane for lane in range(0, case['LaneCount'])],
+                passing_modifier=params['PassingModifier'],
+                history=history,
+                seed=BENCHMARK_SEED,
+                collision_policy='clamp')
+
+    # Time both engines on every case, keeping the fastest repeat
+    def run_engines(self) -> None:
+        for case in self.engine_cases():
+            for engine in ENGINES:
+                best = None
+                for _ in range(0, self.spec['Repeats']):
+                    model = self.build_model(engine, case)
+                    profiler = PhaseProfiler()
+                    model.attach_profiler(profiler)
+                    with redirect_stdout(io.StringIO()):
+                        profiler.start()
+                        model.evaluate()
+                        profiler.stop(model.step)
+                    profile = profiler.summary()
+                    if best is None or profile['WallTime'] < best['WallTime']:
+                        best = profile
+                steps = best['Steps']
+                cars = model.num_cars
+                name = f"engine/{engine}/cars={case['Cars']}/lanes={case['LaneCount']}/reaction={case['ReactionSteps']}/steps={case['Steps']}"
+                if case['LaneCount'] > 1 and len(model.lane_changes) == 0:
+                    self.log('%s: no driver changed lanes, the lane change and passing phases were not exercised.', name, level=logging.WARNING)
+                    self.inactive.append(name)
+                self.record(dict(case,
+                    Name=name,
+                    Group='engine',
+                    Engine=engine,
+                    StepsRun=steps,
+                    LaneChanges=len(model.lane_changes),
+                    Collisions=model.collision_log.count(),
+                    WallTime=best['WallTime'],
+                    StepsPerSecond=best['StepsPerSecond'],
+                    CarStepsPerSecond=best['StepsPerSecond'] * cars,
+                    Phases={phase: timing['Time'] for phase, timing in best['Phases'].items()}))
+
+    # Time writing the full history of the center case, and loading it back
+    # Params:
+    #   - directory: directory to write the output to
+    def run_output(self, directory: str) -> None:
+        model = self.build_model('loop', BENCHMARK_CENTER, history='full')
+        with redirect_stdout(io.StringIO()):
+            model.evaluate()
+        rows = sum(len(car.pos) - model.first_step - 1 for car in model.cars)
+
+        for output_format in ['csv', 'binary']:
+            filename = os.path.join(directory, f'output.{output_format}')
+            write = lambda: self.write_output(model, filename, output_format)
+            if 'output' in self.groups:
+                wall_time = self.time(write)
+                self.record({'Name': f'output/{output_format}', 'Group': 'output', 'Format': output_format, 'Rows': rows,
+                    'Bytes': os.path.getsize(filename), 'WallTime': wall_time, 'RowsPerSecond': rows / wall_time})
+            else:
+                with redirect_stdout(io.StringIO()):
+                    write()
+
+            if 'load' in self.groups:
+                load = load_cars_from_csv if output_format == 'csv' else load_cars_from_binary
+                wall_time = self.time(lambda: load(filename))
+                self.record({'Name': f'load/{output_format}', 'Group': 'load', 'Format': output_format, 'Rows': rows,
+                    'WallTime': wall_time, 'RowsPerSecond': rows / wall_time})
+
+    # Write the full history of a model the way a finished run dumps it
+    # Params:
+    #   - model: model that finished evaluating
+    #   - filename: output file
+    #   - output_format: 'csv' or 'binary'
+    def write_output(self, model, filename: str, output_format: str) -> None:
+        if output_format == 'csv':
+            model.dump(filename)
+            return
+        sink = open_sink(filename, model.lane_count, output_format)
+        try:
+            model.write_history(sink)
+        finally:
+            sink.close()
+
+    # Time a batch of statistics only simulations through the TrafficSimulator for every process count
+    # Params:
+    #   - directory: directory to write the configs and output to
+    def run_simulator(self, directory: str) -> None:
+        case = BENCHMARK_CENTER
+        config = dict(BENCHMARK_PARAMS,
+            Delta=case['ReactionSteps'] * BENCHMARK_PARAMS['TimeStep'],
+            L_track=case['Cars'] / case['LaneCount'] / BENCHMARK_PARAMS['Density'],
+            t_max=case['Steps'] * BENCHMARK_PARAMS['TimeStep'],
+            LaneCount=case['LaneCount'],
+            Engine='loop',
+            Seed=BENCHMARK_SEED,
+            Statistics=True,
+            OutputTrajectories=False,
+            OutputDirectory=os.path.join(directory, 'simulator', ''))
+        filename = os.path.join(directory, 'simulator.json')
+        with open(filename, 'w') as file:
+            json.dump(config, file)
+
+        simulations = self.spec['Simulations']
+        for process_count in self.process_counts:
+            with redirect_stdout(io.StringIO()):
+                simulator = TrafficSimulator([filename], manifest=os.path.join(directory, 'manifest.csv'),
+                    simulation_count=simulations, process_count=process_count)
+            wall_time = self.time(simulator.run)
+            self.record({'Name': f'simulator/processes={process_count}', 'Group': 'simulator', 'ProcessCount': process_count,
+                'Simulations': simulations, 'WallTime': wall_time, 'SimulationsPerSecond': simulations / wall_time})
+
+    # Params:
+    #   - function: function to time, its output is discarded
+    # Returns:
+    #   - fastest wall time of the repeats of the suite
+    def time(self, function) -> float:
+        best = None
+        for _ in range(0, self.spec['Repeats']):
+            with redirect_stdout(io.StringIO()):
+                start = perf_counter()
+                function()
+                elapsed = perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+
+    # Params:
+    #   - result: result of a benchmark, with at least a Name and a WallTime
+    def record(self, result: dict) -> None:
+        self.results.append(result)
+        self.log(f"{result['Name']}: {result['WallTime']:.4f}s")
+
+# Save benchmark results
+# Params:
+#   - filename: JSON file to write
+#   - results: results, as returned by BenchmarkRunner.run
+def save_results(filename: str, results: dict) -> None:
+    with open(filename, 'w') as file:
+        json.dump(results, file, indent=4)
+
+# Load benchmark results
+# Params:
+#   - filename: JSON file, as written by save_results
+# Returns:
+#   - the results
+def load_results(filename: str) -> dict:
+    with open(filename, 'r') as file:
+        results = json.load(file)
+    if results.get('Version') != BENCHMARK_VERSION:
+        raise ValueError(f"Benchmark results {filename} have version {results.get('Version')}, expected {BENCHMARK_VERSION}.")
+    return results
+
+# Compare the wall time of every benchmark to a baseline
+# Params:
+#   - results: current results
+#   - baseline: baseline results
+#   - tolerance: largest relative slowdown that is not a regression
+# Returns:
+#   - Name, baseline and current WallTime, their Ratio and the Status of every benchmark:
+#     'regression', 'improvement', 'ok', or 'new' when the baseline does not have it
+def compare_results(results: dict, baseline: dict, tolerance: float = 0.1) -> List[dict]:
+    before = {result['Name']: result['WallTime'] for result in baseline['Results']}
+    comparison = []
+    for result in results['Results']:
+        name, current = result['Name'], result['WallTime']
+        if name not in before:
+            comparison.append({'Name': name, 'Baseline': None, 'Current': current, 'Ratio': None, 'Status': 'new'})
+            continue
+        ratio = current / before[name] if before[name] > 0 else float('inf')
+        status = 'regression' if ratio > 1 + tolerance else 'improvement' if ratio < 1 - tolerance else 'ok'
+        comparison.append({'Name': name, 'Baseline': before[name], 'Current': current, 'Ratio': ratio, 'Status': status})
+    return comparison
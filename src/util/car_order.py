@@ -0,0 +1,181 @@
+from bisect import bisect_left, insort
+from typing import List
+
+from models.car import Car
+
+# Persistent ordering of cars by position, front to back, globally and per lane.
+# Cars on a ring almost never reorder between steps, so instead of sorting every step the
+# orderings are repaired: cars that wrapped around the end of the track are rotated from
+# the front to the back, then an insertion pass moves the few cars that overtook someone.
+# Cars that changed lanes are moved between the lane orderings.  Ties keep their order.
+class CarOrder:
+    def __init__(self, cars: List[Car], lane_count: int) -> None:
+        self.cars = sorted(cars, key=lambda car: car.pos[-1], reverse=True)
+        self.lanes = [[] for _ in range(0, lane_count)]
+        self.lane_of = {}
+        for car in self.cars:
+            lane = car.lanes[-1]
+            self.lanes[lane].append(car)
+            self.lane_of[car] = lane
+
+    # Repair the orderings after the cars moved
+    def update(self) -> None:
+        # Move cars that changed lanes out of their old lane ordering
+        changed = []
+        for car in self.cars:
+            if car.lanes[-1] != self.lane_of[car]:
+                self.lanes[self.lane_of[car]].remove(car)
+                changed.append(car)
+
+        self.__repair__(self.cars)
+        for lane in self.lanes:
+            self.__repair__(lane)
+
+        # Insert them into their new lane ordering
+        for car in changed:
+            lane = car.lanes[-1]
+            insort(self.lanes[lane], car, key=lambda c: -c.pos[-1])
+            self.lane_of[car] = lane
+
+    # Get the nearest car ahead of every car in every lane in a single pass over the order,
+    # wrapping around to the back of each lane for the cars at the front
+    # Returns:
+    #   - for each car in self.cars, a list holding its leader in each lane, or None if it has none
+    def get_leaders(self) -> List[List[Car]]:
+        last = [lane[-1] if len(lane) > 0 else None for lane in self.lanes]
+        leaders = []
+        for car in self.cars:
+            lane = self.lane_of[car]
+            car_leaders = list(last)
+
+            # A car alone in its lane has no leader
+            if car_leaders[lane] is car:
+                car_leaders[lane] = None
+            leaders.append(car_leaders)
+            last[lane] = car
+        return leaders
+
+    # Repair a nearly sorted list of cars in place
+    # Params:
+    #   - cars: list of cars that was sorted by position at the previous step
+    def __repair__(self, cars: List[Car]) -> None:
+        n = len(cars)
+        if n < 2:
+            return
+
+        # Rotate the cars at the front that wrapped around the end of the track to the back
+        wrapped = 0
+        while wrapped < n and len(cars[wrapped].pos) > 1 and cars[wrapped].pos[-1] < cars[wrapped].pos[-2]:
+            wrapped += 1
+        if 0 < wrapped < n:
+            front = cars[:wrapped]
+            del cars[:wrapped]
+            cars.extend(front)
+
+        # Adaptive insertion pass, only cars that overtook the car in front of them move
+        prev = cars[0].pos[-1]
+        for i in range(1, n):
+            car = cars[i]
+            key = car.pos[-1]
+            if key <= prev:
+                prev = key
+                continue
+            j = i - 1
+            while j > 0 and cars[j - 1].pos[-1] < key:
+                j -= 1
+            del cars[i]
+            cars.insert(j, car)
+
+# Ordering of the cars by the position they had at a delayed snapshot, used to find the
+# cars that passed each other between two consecutive delayed snapshots.  A pass is a
+# swap in relative order, so re-sorting the previous snapshot's order by the current
+# snapshot finds every pass with one insertion pass, and the rotation at the wrap point
+# keeps the order ready for the next step.
+class DelayedOrder:
+    def __init__(self, cars: List[Car]) -> None:
+        self.cars = list(cars)
+        self.index = None
+        self.snapshot = None
+
+    # Count the cars in an adjacent lane that passed each car between two snapshots
+    # Params:
+    #   - prev: history index of the earlier snapshot
+    #   - cur: history index of the later snapshot
+    #   - track_length: length of the track
+    # Returns:
+    #   - dictionary of the number of times each car was passed
+    def count_passes(self, prev: int, cur: int, track_length: float) -> dict:
+        # The order is normally already sorted by the earlier snapshot, unless the
+        # snapshots did not advance by exactly one index since the last call
+        if self.index != prev:
+            self.cars.sort(key=lambda car: car.pos.get(prev), reverse=True)
+        cars = self.cars
+        n = len(cars)
+
+        prev_pos = [car.pos.get(prev) for car in cars]
+        lanes = [car.lanes.get(cur) for car in cars]
+
+        # Unwrap cars that crossed the end of the track
+        cur_pos = [car.pos.get(cur) for car in cars]
+        for i in range(0, n):
+            if cur_pos[i] < prev_pos[i]:
+                cur_pos[i] += track_length
+
+        # Insertion pass by the later snapshot.  Every car that is moved past another car
+        # passed it, since it was behind at the earlier snapshot and is ahead now.
+        counts = [0 for _ in range(0, n)]
+        order = list(range(0, n))
+        for i in range(1, n):
+            x = order[i]
+            j = i
+            while j > 0 and cur_pos[order[j - 1]] < cur_pos[x]:
+                passed = order[j - 1]
+                if prev_pos[passed] > prev_pos[x] and abs(lanes[passed] - lanes[x]) == 1:
+                    counts[passed] += 1
+                j -= 1
+            if j != i:
+                del order[i]
+                order.insert(j, x)
+
+        # Rotate the cars that wrapped from the front to the back so the order is sorted
+        # by position at the later snapshot, ready for the next step
+        wrapped = 0
+        while wrapped < n and cur_pos[order[wrapped]] >= track_length:
+            wrapped += 1
+        self.cars = [cars[i] for i in order[wrapped:] + order[:wrapped]]
+        self.index = cur
+        self.snapshot = None
+
+        return {cars[i]: counts[i] for i in range(0, n)}
+
+    # Check if any car other than the given one is within a distance of a position in a lane,
+    # at the snapshot the order is currently sorted by.  Positions per lane are searched with
+    # bisect, so this is O(log N) regardless of how far back the snapshot is.
+    # Params:
+    #   - lane: lane to check
+    #   - pos: position to check around
+    #   - distance: cars in [pos - distance, pos + distance) around the track are counted
+    #   - track_length: length of the track
+    #   - exclude: car to ignore, usually the one changing lanes
+    # Returns:
+    #   - True if the lane is occupied around the position
+    def is_occupied(self, lane: int, pos: float, distance: float, track_length: float, exclude: Car) -> bool:
+        # Build the lane snapshots, with positions ascending, the first time they are needed
+        if self.snapshot is None:
+            self.snapshot = {}
+            for car in reversed(self.cars):
+                positions, cars = self.snapshot.setdefault(car.lanes.get(self.index), ([], []))
+                positions.append(car.pos.get(self.index))
+                cars.append(car)
+        if lane not in self.snapshot:
+            return False
+        positions, cars = self.snapshot[lane]
+
+        # Search the window shifted by a track length either way to handle wrapping
+        for shift in (-track_length, 0, track_length):
+            i = bisect_left(positions, pos - distance + shift)
+            while i < len(positions) and positions[i] < pos + distance + shift:
+                if cars[i] is not exclude:
+                    return True
+                i += 1
+        return False
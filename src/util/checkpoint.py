@@ -0,0 +1,39 @@
+import json
+import numpy as np
+from os import replace
+from typing import Dict
+
+# Version of the checkpoint layout, checkpoints of another version cannot be restored
+CHECKPOINT_VERSION = 2
+
+# A checkpoint is a compressed NumPy .npz archive.  The 'meta' entry holds a JSON document
+# with the scalar state of the model (current step, random stream states, lane change log,
+# collision state, lights), every other entry is an array of the model state, indexed by
+# each car's position in the initial car list.
+
+# Save a checkpoint, replacing the file only once it is completely written so that a
+# killed run always leaves the previous checkpoint intact
+# Params:
+#   - filename: checkpoint file
+#   - meta: JSON serializable scalar state
+#   - arrays: array state
+def save_checkpoint(filename: str, meta: dict, arrays: Dict[str, np.ndarray]) -> None:
+    meta = dict(meta, version=CHECKPOINT_VERSION)
+    encoded = np.frombuffer(json.dumps(meta).encode('utf-8'), dtype=np.uint8)
+    temporary = f'{filename}.tmp'
+    with open(temporary, 'wb') as file:
+        np.savez_compressed(file, meta=encoded, **arrays)
+    replace(temporary, filename)
+
+# Load a checkpoint
+# Params:
+#   - filename: checkpoint file
+# Returns:
+#   - the scalar state and the array state of the checkpoint
+def load_checkpoint(filename: str) -> tuple:
+    with np.load(filename) as archive:
+        meta = json.loads(archive['meta'].tobytes().decode('utf-8'))
+        arrays = {name: archive[name] for name in archive.files if name != 'meta'}
+    if meta.get('version') != CHECKPOINT_VERSION:
+        raise ValueError(f"Checkpoint {filename} has version {meta.get('version')}, expected {CHECKPOINT_VERSION}.")
+    return meta, arrays
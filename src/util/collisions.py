@@ -0,0 +1,65 @@
+import csv
+from typing import List
+
+# What a run does when cars collide: 'stop' ends the run (or the replica), 'clamp' slows each
+# car that collided for the step so that it ends the step the collision threshold behind the
+# car it hit, or stays where it started if it was already closer, and never moves it backward,
+# 'remove' takes the cars that collided off the track
+COLLISION_POLICIES = ['stop', 'clamp', 'remove']
+
+# Columns of a collision log file, in order
+COLLISION_COLUMNS = ['Time', 'Car', 'Leader', 'Lane', 'Gap']
+
+# Every collision of a run, one per car that comes closer than the collision threshold to the
+# car ahead of it in its lane.  A contact that lasts several steps is a single collision.
+# Events are kept as plain tuples of numbers per replica, so a run that collides often still
+# keeps a compact log.
+class CollisionLog:
+    # Params:
+    #   - replicas: number of replicas of the run
+    def __init__(self, replicas: int) -> None:
+        self.events = [[] for _ in range(0, replicas)]
+
+    # Add the collisions of a replica found in one step
+    # Params:
+    #   - replica: replica the cars belong to
+    #   - t: time of the step
+    #   - cars: id of every car that collided
+    #   - leaders: id of the car each of them collided with
+    #   - lanes: lane of every collision
+    #   - gaps: distance between each car and its leader
+    def record(self, replica: int, t: float, cars: List[int], leaders: List[int], lanes: List[int], gaps: List[float]) -> None:
+        self.events[replica].extend((t, int(car), int(leader), int(lane), float(gap)) for car, leader, lane, gap in zip(cars, leaders, lanes, gaps))
+
+    # Params:
+    #   - replica: replica to count the collisions of
+    # Returns:
+    #   - number of collisions of the replica
+    def count(self, replica: int = 0) -> int:
+        return len(self.events[replica])
+
+    # Params:
+    #   - replica: replica to get the first collision of
+    # Returns:
+    #   - time of the first collision of the replica, None if it never collided
+    def first_time(self, replica: int = 0) -> float:
+        return self.events[replica][0][0] if len(self.events[replica]) > 0 else None
+
+    # Returns:
+    #   - the events logged so far, as saved in a checkpoint
+    def get_state(self) -> list:
+        return [[list(event) for event in events] for events in self.events]
+
+    # Params:
+    #   - state: events, as returned by get_state
+    def set_state(self, state: list) -> None:
+        self.events = [[tuple(event) for event in events] for events in state]
+
+    # Params:
+    #   - replica: replica to write the collisions of
+    #   - filename: CSV file to write, see COLLISION_COLUMNS
+    def write(self, replica: int, filename: str) -> None:
+        with open(filename, 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(COLLISION_COLUMNS)
+            writer.writerows(self.events[replica])
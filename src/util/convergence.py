@@ -0,0 +1,70 @@
+import numpy as np
+from typing import List
+
+# Metrics a run can be checked for convergence on:
+#   - velocity: mean velocity of the cars
+#   - flow: flow in each lane, the sum of the velocities of its cars over the track length
+#   - occupancy: fraction of the cars in each lane
+CONVERGENCE_METRICS = ['velocity', 'flow', 'occupancy']
+
+# Detects when a run has settled into a steady state.  The metrics are sampled every few
+# steps, and a run has converged once the mean of its last window of samples differs from
+# the mean of the window before it by less than the tolerance, relative to their size.
+# Every replica of an ensemble converges on its own.
+class ConvergenceMonitor:
+    # Params:
+    #   - metrics: names of the metrics to check, all of them must converge
+    #   - tolerance: largest relative change between consecutive windows of a converged run
+    #   - window: number of samples in a window
+    #   - replicas: number of replicas that are checked
+    #   - lane_count: number of lanes
+    #   - track_length: length of the track
+    def __init__(self, metrics: List[str], tolerance: float, window: int, replicas: int, lane_count: int, track_length: float) -> None:
+        for metric in metrics:
+            if metric not in CONVERGENCE_METRICS:
+                raise ValueError(f"Unknown convergence metric '{metric}'.  Must be one of: {', '.join(CONVERGENCE_METRICS)}.")
+        if len(metrics) == 0:
+            raise ValueError('At least one convergence metric must be checked.')
+        if window < 1:
+            raise ValueError('The convergence window must hold at least one sample.')
+        self.metrics = list(metrics)
+        self.tolerance = tolerance
+        self.window = window
+        self.lane_count = lane_count
+        self.track_length = track_length
+        self.samples = [[] for _ in range(0, replicas)]
+
+    # Params:
+    #   - velocities: current velocity of every car, one row per replica
+    #   - lanes: current lane of every car, one row per replica
+    # Returns:
+    #   - value of every metric, one row per replica
+    def measure(self, velocities: np.ndarray, lanes: np.ndarray) -> np.ndarray:
+        values = []
+        for metric in self.metrics:
+            if metric == 'velocity':
+                values.append(velocities.mean(axis=1, keepdims=True))
+            elif metric == 'flow':
+                values.append(np.stack([np.where(lanes == lane, velocities, 0).sum(axis=1) for lane in range(0, self.lane_count)], axis=1) / self.track_length)
+            else:
+                values.append(np.stack([(lanes == lane).mean(axis=1) for lane in range(0, self.lane_count)], axis=1))
+        return np.concatenate(values, axis=1)
+
+    # Record a sample of the metrics and check for convergence
+    # Params:
+    #   - replicas: replicas the samples belong to
+    #   - values: value of every metric for each of the replicas, as returned by measure
+    # Returns:
+    #   - whether each of the replicas has converged
+    def update(self, replicas: List[int], values: np.ndarray) -> np.ndarray:
+        converged = np.zeros(len(replicas), dtype=bool)
+        for i, replica in enumerate(replicas):
+            samples = self.samples[replica]
+            samples.append(values[i].tolist())
+            del samples[:-2 * self.window]
+            if len(samples) < 2 * self.window:
+                continue
+            before = np.mean(samples[:self.window], axis=0)
+            after = np.mean(samples[self.window:], axis=0)
+            converged[i] = np.all(np.abs(after - before) <= self.tolerance * np.maximum(np.abs(before), np.abs(after)))
+        return converged
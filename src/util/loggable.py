@@ -1,7 +1,154 @@
+import json
+import logging
+import sys
+from logging.handlers import QueueHandler, QueueListener
+from time import monotonic
+
+# Root of the loggers of every Loggable, each class logs to a child named after it
+LOGGER_NAME = 'traffic'
+
+# Levels that can be selected by name
+LOG_LEVELS = ['DEBUG', 'INFO', 'WARNING', 'ERROR']
+
+# Logs to the current standard output, resolved on every record so that redirecting
+# sys.stdout also redirects the log
+class StdoutHandler(logging.StreamHandler):
+    def __init__(self) -> None:
+        super().__init__(sys.stdout)
+
+    @property
+    def stream(self):
+        return sys.stdout
+
+    @stream.setter
+    def stream(self, value) -> None:
+        pass
+
+# Formats a record as '[Title] message', the title being the class that logged it
+class TitleFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        return f'[{record.name.rsplit(".", 1)[-1]}] {record.getMessage()}'
+
+# Formats a record as a single line JSON object, for log files that are read by tools
+class JsonLinesFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        return json.dumps({
+            'time': record.created,
+            'level': record.levelname,
+            'logger': record.name.rsplit('.', 1)[-1],
+            'process': record.process,
+            'message': record.getMessage()
+        })
+
+# Hands records to a queue in batches, so that a worker process only touches the queue
+# every few records.  A batch is sent once it is full, once it is older than the flush
+# interval, for every warning or error, and on flush.
+class BatchQueueHandler(QueueHandler):
+    # Params:
+    #   - queue: queue shared with the process that writes the log
+    #   - capacity: largest number of records in a batch
+    #   - interval: longest time in seconds a record waits in a batch
+    def __init__(self, queue, capacity: int = 100, interval: float = 1.0) -> None:
+        super().__init__(queue)
+        self.capacity = capacity
+        self.interval = interval
+        self.buffer = []
+        self.started = monotonic()
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            if len(self.buffer) == 0:
+                self.started = monotonic()
+            self.buffer.append(self.prepare(record))
+        except Exception:
+            self.handleError(record)
+            return
+        if len(self.buffer) >= self.capacity or record.levelno >= logging.WARNING or monotonic() - self.started >= self.interval:
+            self.flush()
+
+    def flush(self) -> None:
+        self.acquire()
+        try:
+            if len(self.buffer) > 0:
+                self.queue.put(self.buffer)
+                self.buffer = []
+        finally:
+            self.release()
+
+    def close(self) -> None:
+        self.flush()
+        super().close()
+
+# Writes the batches of records of every worker process with the handlers of this process
+class BatchQueueListener(QueueListener):
+    def handle(self, records: list) -> None:
+        for record in records:
+            super().handle(record)
+
 class Loggable:
     def __init__(self):
         # Get the title of the child class
         self.title = self.__class__.__name__
+        self.logger = logging.getLogger(f'{LOGGER_NAME}.{self.title}')
+
+    # Log a message.  Arguments are only formatted into the message, %-style, if the level
+    # is enabled, so messages that are usually disabled cost little more than the check.
+    # Params:
+    #   - message: message, or %-style format of the message
+    #   - args: arguments of the format
+    #   - level: level of the message, from the logging module
+    def log(self, message: str, *args, level: int = logging.INFO) -> None:
+        if self.logger.isEnabledFor(level):
+            self.logger.log(level, message, *args)
+
+# Configure where and what is logged in this process, replacing the previous configuration
+# Params:
+#   - level: lowest level that is logged, see LOG_LEVELS
+#   - log_file: JSON-lines file every record is appended to as well, None for none
+def configure_logging(level: str = 'INFO', log_file: str = None) -> None:
+    if level not in LOG_LEVELS:
+        raise ValueError(f"Unknown log level '{level}'.  Must be one of: {', '.join(LOG_LEVELS)}.")
+    logger = logging.getLogger(LOGGER_NAME)
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        handler.close()
+
+    handler = StdoutHandler()
+    handler.setFormatter(TitleFormatter())
+    logger.addHandler(handler)
+    if log_file is not None:
+        handler = logging.FileHandler(log_file, mode='a', encoding='utf-8')
+        handler.setFormatter(JsonLinesFormatter())
+        logger.addHandler(handler)
+    logger.setLevel(level)
+    logger.propagate = False
+
+# Send every record of this worker process to the process that writes the log
+# Params:
+#   - queue: queue read by a listener from start_log_listener
+#   - level: lowest level that is logged, records below it are dropped in the worker
+def configure_worker_logging(queue, level: int) -> None:
+    logger = logging.getLogger(LOGGER_NAME)
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    logger.addHandler(BatchQueueHandler(queue))
+    logger.setLevel(level)
+    logger.propagate = False
+
+# Params:
+#   - queue: queue the worker processes send their records to
+# Returns:
+#   - started listener that writes the records with the handlers of this process
+def start_log_listener(queue) -> QueueListener:
+    listener = BatchQueueListener(queue, *logging.getLogger(LOGGER_NAME).handlers, respect_handler_level=True)
+    listener.start()
+    return listener
+
+# Send the records still waiting in a batch
+def flush_logging() -> None:
+    for handler in logging.getLogger(LOGGER_NAME).handlers:
+        handler.flush()
 
-    def log(self, message: str) -> None:
-        print(f'[{self.title}] {message}')
\ No newline at end of file
+# Log to standard output until configured otherwise
+if len(logging.getLogger(LOGGER_NAME).handlers) == 0:
+    configure_logging()
@@ -1,15 +1,25 @@
-
-
 import csv
-from numpy import arange, exp, arctan
-from random import random
-from typing import List
+import logging
+import numpy as np
+from enum import Enum
+from math import ceil
+from numpy import exp, arctan
+from numpy.random import Generator, SeedSequence, default_rng
+from typing import List, Union
 
 from const.param import *
 from models.car import Car
 from models.traffic_light import *
 from models.traffic_influencer import TrafficInfluencer
+from models.history import History, RingHistory
+from util.car_order import CarOrder, DelayedOrder
+from util.checkpoint import load_checkpoint, save_checkpoint
+from util.collisions import COLLISION_POLICIES, CollisionLog
+from util.convergence import ConvergenceMonitor
 from util.loggable import Loggable
+from util.profiler import PhaseProfiler
+from util.statistics import StatisticsCollector
+from util.output_sink import output_columns
 
 def is_integer_multiple(a: float, b: float) -> bool:
     if b == 0:
@@ -17,6 +27,22 @@ def is_integer_multiple(a: float, b: float) -> bool:
     quotient = a / b
     return abs(quotient - round(quotient)) < ERROR_MARGIN
 
+# Params:
+#   - obj: traffic light or influencer
+# Returns:
+#   - the plain attributes of the object, the ones that can change while the model runs
+def object_state(obj) -> dict:
+    return {name: value.name if isinstance(value, Enum) else value
+        for name, value in vars(obj).items() if isinstance(value, (bool, int, float, str, Enum))}
+
+# Params:
+#   - obj: traffic light or influencer
+#   - state: attributes saved by object_state
+def restore_object_state(obj, state: dict) -> None:
+    for name, value in state.items():
+        current = getattr(obj, name)
+        setattr(obj, name, type(current)[value] if isinstance(current, Enum) else value)
+
 class Model(Loggable):
     def __init__(self,
                 lbda: float, 
@@ -31,7 +57,10 @@ class Model(Loggable):
                 track_length: float = 100,
                 lane_change_frequency: float = 1.0,
                 lane_vmax_weights: List[float] = [],
-                passing_modifier = 0.1
+                passing_modifier = 0.1,
+                history: str = 'full',
+                seed: Union[int, SeedSequence] = None,
+                collision_policy: str = 'stop'
                 ) -> None:
         super().__init__()
         # Assert clean data
@@ -59,116 +88,545 @@ class Model(Loggable):
         self.collided = False
         self.collided_ids = []
 
+        # Collisions either stop the run, or are logged and resolved by the policy so the run
+        # continues, see util/collisions.py
+        if collision_policy not in COLLISION_POLICIES:
+            raise ValueError(f"Unknown collision policy '{collision_policy}'.  Must be one of: {', '.join(COLLISION_POLICIES)}.")
+        self.collision_policy = collision_policy
+        self.collision_log = CollisionLog(1)
+        self.step_collisions = []
+        self.removed_cars = []
+
+        # Pairs of cars in contact at the last step, as (car, leader) indices into the initial
+        # car list, so that a contact lasting several steps is logged once
+        self.contacts = set()
+
         self.lane_changes = []
 
+        # The loop engine always runs a single replica of the cars
+        self.replicas = 1
+
+        # Random draws come from streams derived from the seed, a random seed if none is given.
+        # Every step draws once for the whole fleet, indexed by each car's position in the
+        # initial car list, so the draws do not depend on the order of the cars.
+        self.seed_sequence = seed if isinstance(seed, SeedSequence) else SeedSequence(seed)
+        self.rng = self.random_stream(0)
+        self.fleet = list(cars)
+        self.fleet_index = {car: i for i, car in enumerate(cars)}
+        self.draws = None
+
         self.end_time = self.max_time - self.time_step
 
+        # Why the run stopped, 't_max', 'collision' or 'converged', and the time of its last step
+        self.stop_reason = 't_max'
+        self.stop_time = None
+
+        # Steady state detection and running statistics, off unless attached
+        self.monitor = None
+        self.convergence_steps = 0
+        self.statistics = None
+
+        # Per phase timing of the steps and progress reports, off unless attached
+        self.profiler = None
+        self.progress = None
+        self.progress_interval = 0
+
         self.lane_vmax_weights = lane_vmax_weights if len(lane_vmax_weights) == lane_count else [1.0 for _ in range(0, lane_count)]
 
-    # Run simulation
+        # Either preallocate car histories for every step of the run, or only keep the steps
+        # that are still read by the dynamics and hand finished samples to an output sink
+        self.history = history
+        self.sink = None
+        self.steps = max(int(ceil((self.max_time - self.start_time) / self.time_step - ERROR_MARGIN)), 0)
+        if history not in ('full', 'ring'):
+            raise ValueError(f"Unknown history mode '{history}'.  Must be 'full' or 'ring'.")
+        for c in self.cars:
+            # Reaction delays in whole steps, so delayed values are read by history index
+            c.reaction_steps = int(round(c.reaction_time / self.time_step))
+            if history == 'full':
+                c.reserve_history(len(c.pos) + self.steps)
+            else:
+                # Every car keeps the deepest history, passes are counted from the delayed
+                # snapshots of every reaction time over the whole fleet
+                c.limit_history(self.max_history_depth())
+
+        # History index of the state the first step starts from
+        self.first_step = len(self.cars[0].pos) - 1 if self.num_cars > 0 else 0
+
+        # Steps run so far and the history index of the state the next step starts from
+        self.step = 0
+        self.tick = self.first_step
+
+        # Step of the run at history index 0, see CarBase.step_at_time
+        self.history_offset = 0
+
+        # Periodic checkpoints of the model state, off unless attached
+        self.checkpoint_file = None
+        self.checkpoint_interval = 0
+
+        # Ordering of the cars by position, globally and per lane, repaired every step
+        self.car_order = CarOrder(self.cars, self.lane_count)
+        self.delayed_orders = {}
+
+    # Number of steps of history that must be kept for a given reaction time.  The dynamics
+    # read one step before the reaction delay while the next step is being written.
+    # Parameters:
+    #   - reaction_time: reaction time of the car
+    def history_depth(self, reaction_time: float) -> int:
+        return int(round(reaction_time / self.time_step)) + 3
+
+    # Returns:
+    #   - number of steps of history needed by the car with the longest reaction time
+    def max_history_depth(self) -> int:
+        return max([self.history_depth(c.reaction_time) for c in self.cars], default=1)
+
+    # Parameters:
+    #   - replica: replica to get the random stream of
+    # Returns:
+    #   - independent random stream of the replica, derived from the seed of the model
+    def random_stream(self, replica: int) -> Generator:
+        seed = self.seed_sequence
+        return default_rng(SeedSequence(seed.entropy, spawn_key=seed.spawn_key + (replica,)))
+
+    # Attach an output sink that receives the samples of every finished time step
+    # Parameters:
+    #   - sink: object with a write(columns) method
+    def attach_sink(self, sink) -> None:
+        self.sink = sink
+
+    # Save a checkpoint of the model state every few steps while it runs
+    # Parameters:
+    #   - filename: checkpoint file, replaced by every new checkpoint
+    #   - interval: number of steps between checkpoints
+    def attach_checkpoints(self, filename: str, interval: int) -> None:
+        if interval < 1:
+            raise ValueError('The checkpoint interval must be at least one step.')
+        self.checkpoint_file = filename
+        self.checkpoint_interval = interval
+
+    # Stop the run early once it reaches a steady state
+    # Parameters:
+    #   - metrics: names of the metrics that must converge, see util/convergence.py
+    #   - tolerance: largest relative change of the metrics between consecutive windows
+    #   - window: length of a window in seconds
+    #   - check_steps: number of steps between samples of the metrics
+    def attach_convergence(self, metrics: List[str], tolerance: float, window: float, check_steps: int) -> None:
+        if check_steps < 1:
+            raise ValueError('Convergence must be checked at least every step.')
+        samples = max(int(round(window / (check_steps * self.time_step))), 1)
+        self.monitor = ConvergenceMonitor(metrics, tolerance, samples, self.replicas, self.lane_count, self.track_length)
+        self.convergence_steps = check_steps
+
+    # Update running statistics of the run after every step
+    # Parameters:
+    #   - collector: collector the statistics are added to
+    def attach_statistics(self, collector: StatisticsCollector) -> None:
+        velocities, lanes, _ = self.get_fleet_state()
+        collector.start(velocities, lanes)
+        self.statistics = collector
+
+    # Returns:
+    #   - current velocity, lane and impatience of every car still on the track, one row per
+    #     replica, with the cars in the order of the initial car list
+    def get_fleet_state(self) -> tuple:
+        return (
+            np.array([[c.velocity[-1] for c in self.fleet]], dtype=np.float64),
+            np.array([[c.lanes[-1] for c in self.fleet]], dtype=np.int64),
+            np.array([[c.impatience[-1] for c in self.fleet]], dtype=np.float64))
+
+    # Time every phase of the steps
+    # Parameters:
+    #   - profiler: profiler the phases are charged to
+    def attach_profiler(self, profiler: PhaseProfiler) -> None:
+        self.profiler = profiler
+
+    # Report the progress of the run every few steps while it runs
+    # Parameters:
+    #   - reporter: reporter the progress is handed to, see util/progress.py
+    #   - interval: number of steps between reports
+    def attach_progress(self, reporter, interval: int) -> None:
+        if interval < 1:
+            raise ValueError('Progress must be reported at most every step.')
+        self.progress = reporter
+        self.progress_interval = interval
+
+    # Charge the time since the previous phase to a phase of the step, when profiling
+    # Parameters:
+    #   - phase: phase that just finished, see util/profiler.py
+    def lap(self, phase: str) -> None:
+        if self.profiler is not None:
+            self.profiler.lap(phase)
+
+    # Parameters:
+    #   - replica: replica to get the stop of, only replica 0 exists in the loop engine
+    # Returns:
+    #   - why the replica stopped and the time of its last step
+    def get_stop(self, replica: int = 0) -> tuple:
+        return self.stop_reason, self.stop_time
+
+    # Run simulation, continuing from the current step
     def evaluate(self) -> None:
         # Step through time and use Euler's method to calculate positon
-        for t in arange(self.start_time, self.max_time, self.time_step):
+        for step in range(self.step, self.steps):
 
             # Stop if we indicate the model should no longer be running
             if not self.running:
                 return
-            
+
+            # The dynamics run on history indices, real time is only computed for output
+            k = self.tick
+            t = self.start_time + step * self.time_step
+            if self.profiler is not None:
+                self.profiler.mark()
+
             for light in self.lights:
                 light.update_status(t)
             for inf in self.influencers:
                 inf.update_status(t)
                 self.cars = inf.influence(self.cars)
+            self.lap('influencers')
 
-            # Sort cars based on position to ensure the "next" car is always the one directly in front
-            self.cars = sorted(self.cars, key=lambda car: car.pos[-1], reverse=True)
+            # Order cars based on position to ensure the "next" car is always the one directly in front
+            self.car_order.update()
+            self.cars = self.car_order.cars
+            self.lap('order')
 
             # Update lane of cars
-            self.get_lane(t)
+            self.get_lane(t, k)
+            self.lap('lane')
 
             # Update headway of cars
-            self.get_headway(t)
+            self.get_headway(t, k)
+            self.lap('headway')
 
             # Get velocity of the cars
-            self.get_velocity(t)
+            self.get_velocity(t, k)
+            self.lap('velocity')
 
             # Update position of cars
             self.get_position(t)
+            if self.collision_policy == 'clamp':
+                self.clamp_collisions()
+            self.lap('position')
 
             # Update time of cars
             self.save_time(t)
 
+            # Hand the finished time step to the output sink
+            if self.sink is not None:
+                self.sink.write(self.get_step_output())
+            self.lap('output')
+
+            # Cars that collided leave the track once their last sample is written
+            if self.collision_policy == 'remove':
+                self.remove_collided()
+
+            self.stop_time = t
+            self.step, self.tick = step + 1, k + 1
+            if self.statistics is not None:
+                self.statistics.update(np.zeros(1, dtype=np.int64), t, *self.get_fleet_state())
+            self.check_convergence(t)
+            self.save_periodic_checkpoint()
+            self.report_progress(t)
+            self.lap('monitoring')
+
+    # Sample the metrics and stop a run that converged, if a check is due after the step
+    # that just finished
     # Parameters:
-    #   - t: current time
-    def save_time(self, t: float) -> None:
-        for i in range(0, self.num_cars):
-            self.cars[i].time.append(t)
-
-    def get_car_passing_impatience(self, i: int, t: float):
-        impatience = 0.0
-
-        target_car = self.cars[i]
-        r_t = self.cars[i].reaction_time
-
-        lane = self.cars[i].get_lane_at_time(t - r_t)
-        prev_lane = self.cars[i].get_lane_at_time(t - r_t - self.time_step)
-
-        # Only consider constant lanes
-        if lane != prev_lane:
-            return 0
-
-        target_pos = self.cars[i].get_pos_at_time(t - r_t)
-        target_pos_prev = self.cars[i].get_pos_at_time(t - r_t - self.time_step)
-        if target_pos - target_pos_prev < 0:
-            target_pos += self.track_length
-
-        for j in range(0, len(self.cars)):
-            if i == j:
-                continue
+    #   - t: time of the step that just finished
+    def check_convergence(self, t: float) -> None:
+        if self.monitor is None or not self.running or self.step % self.convergence_steps != 0:
+            return
+        velocities, lanes, _ = self.get_fleet_state()
+        if self.monitor.update([0], self.monitor.measure(velocities, lanes))[0]:
+            self.log(f'Converged to a steady state at time t={t}.')
+            self.running = False
+            self.stop_reason = 'converged'
+
+    # Save a checkpoint if one is due after the step that just finished
+    def save_periodic_checkpoint(self) -> None:
+        if self.checkpoint_file is not None and self.running and self.step % self.checkpoint_interval == 0:
+            self.save_checkpoint(self.checkpoint_file)
+
+    # Report the progress of the run if a report is due after the step that just finished
+    # Parameters:
+    #   - t: time of the step that just finished
+    def report_progress(self, t: float) -> None:
+        if self.progress is not None and self.step % self.progress_interval == 0:
+            self.progress.update(self.step, t)
 
-            check_car = self.cars[j]
+    # Save the complete state of the model, so that a run restored from it continues exactly
+    # as the run would have.  Car histories are only saved as far back as the dynamics read.
+    # Parameters:
+    #   - filename: checkpoint file
+    def save_checkpoint(self, filename: str) -> None:
+        meta, arrays = self.get_state()
+        save_checkpoint(filename, meta, arrays)
+        self.log(f'Saved checkpoint at step {self.step} to {filename}.')
+
+    # Restore the state of the model from a checkpoint.  The model must have been built with
+    # the same cars, lanes and time step as the one the checkpoint was saved from.  Histories
+    # restart at the saved window, so a restored run only outputs the steps it runs itself.
+    # Parameters:
+    #   - filename: checkpoint file
+    def restore_checkpoint(self, filename: str) -> None:
+        meta, arrays = self.load_state(filename)
+        if meta['engine'] != type(self).__name__:
+            raise ValueError(f"Checkpoint {filename} was saved by the {meta['engine']} engine, not the {type(self).__name__} engine.")
+        if meta['replicas'] != self.replicas:
+            raise ValueError(f"Checkpoint {filename} holds {meta['replicas']} replicas, the model runs {self.replicas}.")
+        if meta['steps'] != self.steps:
+            self.log(f"Checkpoint {filename} was saved from a run of {meta['steps']} steps, continuing for {self.steps}.")
+        self.set_state(meta, arrays)
+        self.log(f'Restored checkpoint at step {self.step} from {filename}.')
+
+    # Start the run from the state saved by another run instead of the initial state of the
+    # cars, so that it skips the transient.  The saved window of positions, velocities, lanes,
+    # impatience and headways becomes the history before the start time, the dynamics read it
+    # as the delayed states of the cars.  Random streams, lane changes and collisions start over,
+    # and the parameters of the cars are the ones of this model.  The state of a single run can
+    # warm start every replica of an ensemble.
+    # Parameters:
+    #   - filename: checkpoint or end state file of another run with the same cars
+    def warm_start(self, filename: str) -> None:
+        meta, arrays = self.load_state(filename)
+        if meta['replicas'] not in (1, self.replicas):
+            raise ValueError(f"State {filename} holds {meta['replicas']} replicas, the model runs {self.replicas}.")
+        if meta['collided']:
+            raise ValueError(f'State {filename} was saved from a run that ended in a collision.')
+        window = meta['window']
+        if window < self.max_history_depth():
+            self.log(f'State {filename} holds {window} steps of history, reaction delays reaching further back read its oldest step.')
+
+        # Times of the saved window lead up to the start time of this run, and the time getters
+        # read its last step at t = 0
+        times = self.start_time + self.time_step * np.arange(1 - window, 1)
+        arrays = dict(arrays, time=np.broadcast_to(times[:, np.newaxis], arrays['time'].shape))
+        self.set_history(arrays, window, self.steps, 1 - window)
+        self.step = 0
+        self.reset_order()
+        self.log(f'Warm started from {filename}.')
+
+    # Load a saved state and check that it was saved from the same cars, lanes and time step
+    # Parameters:
+    #   - filename: checkpoint file
+    # Returns:
+    #   - the scalar state and the array state that were saved
+    def load_state(self, filename: str) -> tuple:
+        meta, arrays = load_checkpoint(filename)
+        if meta['lane_count'] != self.lane_count or meta['time_step'] != self.time_step:
+            raise ValueError(f'State {filename} does not match the lane count or time step of the model.')
+        if not np.array_equal(arrays['ids'], np.array([c.id for c in self.fleet_index])):
+            raise ValueError(f'State {filename} does not hold the same cars as the model.')
+        return meta, arrays
+
+    # Returns:
+    #   - the scalar state and the array state of the model, with every car indexed by its
+    #     position in the initial car list, as saved in a checkpoint
+    def get_state(self) -> tuple:
+        if len(self.removed_cars) > 0:
+            raise RuntimeError('Cars were removed from the run, its state can no longer be saved.')
+        cars = list(self.fleet_index)
+        window = min(self.tick + 1, self.max_history_depth())
+        start, end = self.tick + 1 - window, self.tick + 1
+        column = lambda attribute, dtype: np.array([attribute(c)[start:end] for c in cars], dtype=dtype).reshape(len(cars), window).T
+        indices = lambda order: np.array([self.fleet_index[c] for c in order], dtype=np.int64)
+        delayed = sorted(self.delayed_orders.items())
+
+        arrays = {
+            'ids': np.array([c.id for c in cars]),
+            'time': column(lambda c: c.time, np.float64),
+            'pos': column(lambda c: c.pos, np.float64),
+            'velocity': column(lambda c: c.velocity, np.float64),
+            'impatience': column(lambda c: c.impatience, np.float64),
+            'lanes': column(lambda c: c.lanes, np.int64),
+            'headway': np.stack([column(lambda c: c.headway[lane], np.float64) for lane in range(0, self.lane_count)], axis=1),
+            'fixed_velocities': np.array([np.nan if c.fixed_velocity is None else c.fixed_velocity for c in cars], dtype=np.float64),
+            'order': indices(self.car_order.cars)[np.newaxis],
+            'lane_order': np.concatenate([indices(lane) for lane in self.car_order.lanes]),
+            'lane_sizes': np.array([len(lane) for lane in self.car_order.lanes], dtype=np.int64),
+            'delayed_orders': np.array([indices(order.cars)[np.newaxis] for _, order in delayed], dtype=np.int64).reshape(len(delayed), 1, len(cars))
+        }
+        meta = dict(self.common_state(window),
+            streams=[self.rng.bit_generator.state],
+            lane_changes=[self.lane_changes],
+            # Snapshot index of each delayed order relative to the current history index
+            delayed=[[r_t, None if order.index is None else order.index - self.tick] for r_t, order in delayed],
+            lights=[object_state(light) for light in self.lights],
+            influencers=[object_state(inf) for inf in self.influencers])
+        return meta, arrays
 
-            # Only consider lanes immediately next to the target car
-            if abs(check_car.get_lane_at_time(t - r_t) - lane) != 1:
-                continue
+    # Parameters:
+    #   - window: number of steps of history saved
+    # Returns:
+    #   - the scalar state shared by both engines
+    def common_state(self, window: int) -> dict:
+        return {
+            'engine': type(self).__name__,
+            'replicas': self.replicas,
+            'lane_count': self.lane_count,
+            'time_step': self.time_step,
+            'steps': self.steps,
+            'step': self.step,
+            'window': window,
+            # Step of the run at the first step of the saved window
+            'history_offset': self.history_offset + self.tick + 1 - window,
+            'running': self.running,
+            'collided': self.collided,
+            'collided_ids': self.collided_ids,
+            'collisions': self.collision_log.get_state(),
+            'contacts': sorted([car, leader] for car, leader in self.contacts),
+            'end_time': self.end_time,
+            'stop_reason': self.stop_reason,
+            'stop_time': self.stop_time,
+            'convergence': None if self.monitor is None else self.monitor.samples,
+            'statistics': None if self.statistics is None else self.statistics.get_state()
+        }
 
-            c_pos = check_car.get_pos_at_time(t - r_t)
-            c_pos_prev = check_car.get_pos_at_time(t - r_t - self.time_step)
+    # Parameters:
+    #   - meta: scalar state, as returned by common_state
+    def set_common_state(self, meta: dict) -> None:
+        self.running = meta['running']
+        self.collided = meta['collided']
+        self.collided_ids = meta['collided_ids']
+        self.collision_log.set_state(meta['collisions'])
+        self.contacts = {(car, leader) for car, leader in meta['contacts']}
+        self.end_time = meta['end_time']
+        self.stop_reason = meta['stop_reason']
+        self.stop_time = meta['stop_time']
+        if self.monitor is not None and meta['convergence'] is not None:
+            self.monitor.samples = meta['convergence']
+        if self.statistics is not None and meta['statistics'] is not None:
+            self.statistics.set_state(meta['statistics'])
+
+    # Replace the history of every car with a saved window, which starts the history over at index 0
+    # Parameters:
+    #   - arrays: array state holding the window, as returned by get_state
+    #   - window: number of steps in the window
+    #   - steps: number of steps left to run
+    #   - offset: step of the run at the first step of the window
+    def set_history(self, arrays: dict, window: int, steps: int, offset: int) -> None:
+        depth = self.max_history_depth()
+        history = lambda values, typecode: RingHistory(values.tolist(), typecode, depth) if self.history == 'ring' else History(values.tolist(), typecode)
+        for g, c in enumerate(self.fleet_index):
+            c.time = history(arrays['time'][:, g], 'd')
+            c.pos = history(arrays['pos'][:, g], 'd')
+            c.velocity = history(arrays['velocity'][:, g], 'd')
+            c.impatience = history(arrays['impatience'][:, g], 'd')
+            c.lanes = history(arrays['lanes'][:, g], 'i')
+            c.headway = [history(arrays['headway'][:, lane, g], 'd') for lane in range(0, self.lane_count)]
+            c.history_offset = offset
+            if self.history == 'full':
+                c.reserve_history(window + steps)
+        self.tick = self.first_step = window - 1
+        self.history_offset = offset
+
+    # Order the cars from scratch by their current position
+    def reset_order(self) -> None:
+        self.car_order = CarOrder(list(self.fleet_index), self.lane_count)
+        self.cars = self.car_order.cars
+        self.delayed_orders = {}
 
-            if c_pos - c_pos_prev < 0:
-                c_pos += self.track_length
+    # Parameters:
+    #   - meta: scalar state, as returned by get_state
+    #   - arrays: array state, as returned by get_state
+    def set_state(self, meta: dict, arrays: dict) -> None:
+        cars = list(self.fleet_index)
+        self.set_history(arrays, meta['window'], self.steps - meta['step'], meta['history_offset'])
+        self.step = meta['step']
+        for c, fixed in zip(cars, arrays['fixed_velocities']):
+            c.fixed_velocity = None if np.isnan(fixed) else float(fixed)
+
+        self.car_order.cars = [cars[g] for g in arrays['order'][0]]
+        self.car_order.lanes = []
+        self.car_order.lane_of = {}
+        offset = 0
+        for lane, size in enumerate(arrays['lane_sizes']):
+            self.car_order.lanes.append([cars[g] for g in arrays['lane_order'][offset:offset + size]])
+            for c in self.car_order.lanes[-1]:
+                self.car_order.lane_of[c] = lane
+            offset += size
+        self.cars = self.car_order.cars
+
+        self.delayed_orders = {}
+        for (r_t, index), order in zip(meta['delayed'], arrays['delayed_orders']):
+            self.delayed_orders[r_t] = DelayedOrder([cars[g] for g in order[0]])
+            self.delayed_orders[r_t].index = None if index is None else self.tick + index
+
+        self.rng.bit_generator.state = meta['streams'][0]
+        self.lane_changes = meta['lane_changes'][0]
+        self.set_common_state(meta)
+        for light, state in zip(self.lights, meta['lights']):
+            restore_object_state(light, state)
+        for inf, state in zip(self.influencers, meta['influencers']):
+            restore_object_state(inf, state)
+
+    # Returns:
+    #   - one list per output column, holding the latest sample of each car
+    def get_step_output(self) -> List[list]:
+        columns = [
+            [car.id for car in self.cars],
+            [car.time[-1] for car in self.cars],
+            [car.pos[-1] for car in self.cars],
+            [car.velocity[-1] for car in self.cars],
+            [car.impatience[-1] for car in self.cars],
+            [car.lanes[-1] for car in self.cars]]
+        for lane in range(0, self.lane_count):
+            columns.append([car.headway[lane][-1] for car in self.cars])
+        return columns
 
-            prev_diff = target_pos_prev - c_pos_prev
-            cur_diff = target_pos - c_pos
+    # Parameters:
+    #   - t: current time
+    def save_time(self, t: float) -> None:
+        for i in range(0, self.num_cars):
+            self.cars[i].time.append(t)
 
-            if prev_diff > 0 and cur_diff < 0:
-                impatience += self.passing_modifier
+    # Parameters:
+    #   - k: history index of the current step
+    # Returns:
+    #   - dictionary of the impatience each car gains from being passed by cars in an adjacent lane
+    def get_passing_impatience(self, k: int) -> dict:
+        impatience = {}
+
+        # Cars sharing a reaction time perceive the same snapshots
+        groups = {}
+        for car in self.cars:
+            groups.setdefault(car.reaction_time, []).append(car)
+
+        for r_t, cars in groups.items():
+            cur = max(k - cars[0].reaction_steps, 0)
+            prev = max(k - cars[0].reaction_steps - 1, 0)
+            if r_t not in self.delayed_orders:
+                self.delayed_orders[r_t] = DelayedOrder(self.cars)
+            counts = self.delayed_orders[r_t].count_passes(prev, cur, self.track_length)
+
+            for car in cars:
+                # Only consider constant lanes
+                if car.lanes.get(cur) != car.lanes.get(prev):
+                    impatience[car] = 0
+                else:
+                    impatience[car] = counts[car] * self.passing_modifier
         return impatience
 
-    def process_lane_change(self, t: float, i: int, cur_lane: int, left_headway: float, right_headway) -> int:
+    def process_lane_change(self, t: float, k: int, i: int, cur_lane: int, left_headway: float, right_headway) -> int:
 
         can_go_left = cur_lane > 0
         can_go_right = cur_lane < self.lane_count - 1
 
-        # TODO: this solution may not work for large reaction times
-        # Prop.: For an n lane traffic system, we only need to check n - 1 cars to see if lane changing will cause a collision from behind/front
-        # Cor.: For an n lane traffic system, we only need to check 2n - 2 cars to see if lane changing will cause a collision
-        # Using this to speed up lane changing.  May have to stop doing this when facotring in larger reaction times
-        for j in range(i - self.lane_count + 1, i + self.lane_count): 
-            if i == j:
-                continue
-            car = self.cars[j % self.num_cars]
-            car_headway = (car.get_pos_at_time(t - self.cars[i].reaction_time) - self.cars[i].get_pos_at_time(t - self.cars[i].reaction_time)) % self.track_length
-            car_lane = car.get_lane_at_time(t - self.cars[i].reaction_time)
-
-            if car_headway < self.cars[i].headway_threshold or car_headway >= self.track_length - self.cars[i].headway_threshold: 
-                if car_lane == cur_lane - 1:
-                    can_go_left = False
-                if car_lane == cur_lane + 1:
-                    can_go_right = False
-        probability = 1 - pow(1 - ((2 / PI) * arctan(self.cars[i].get_impatience_at_time(t))), self.time_step)
+        # A lane is blocked if a car is within the headway threshold of where the driver perceives
+        # itself, using the positions and lanes every car had at the same delayed snapshot
+        if self.lane_count > 1:
+            car = self.cars[i]
+            snapshot = self.delayed_orders[car.reaction_time]
+            pos = car.get_pos_at_step(k - car.reaction_steps)
+            if can_go_left and snapshot.is_occupied(cur_lane - 1, pos, car.headway_threshold, self.track_length, car):
+                can_go_left = False
+            if can_go_right and snapshot.is_occupied(cur_lane + 1, pos, car.headway_threshold, self.track_length, car):
+                can_go_right = False
+
+        probability = 1 - pow(1 - ((2 / PI) * arctan(self.cars[i].get_impatience_at_step(k))), self.time_step)
         probability_to_change = 0 if probability < 0 else probability
-        random_draw = random()
+        random_draw = self.draws[self.fleet_index[self.cars[i]]]
 
         # If the probability allows, attempt a lane change
         if random_draw <= probability_to_change:
@@ -197,16 +655,27 @@ class Model(Loggable):
         # Return the lane decided
         return cur_lane
 
-    def get_lane(self, t: float) -> None:
+    # Parameters:
+    #   - t: current time
+    #   - k: history index of the current step
+    def get_lane(self, t: float, k: int) -> None:
+        # Impatience from being passed, computed for every car at once
+        passing = self.get_passing_impatience(k) if self.lane_count > 1 else None
+        self.lap('passing')
+
+        # Lane change draws of the whole fleet, including the cars that were removed
+        self.draws = self.rng.random(len(self.fleet_index))
+
         for i in range(0, self.num_cars):
             # Get current lane of car
-            cur_lane = self.cars[i].get_lane_at_time(t)
-            impatience = self.cars[i].get_impatience_at_time(t)
+            cur_lane = self.cars[i].get_lane_at_step(k)
+            impatience = self.cars[i].get_impatience_at_step(k)
             
             # Get headway in current lane, as well as the headway if the car was in the right and left lane
-            headway = self.cars[i].get_headway_at_time(t - self.cars[i].reaction_time, cur_lane)
-            left_headway = self.cars[i].get_headway_at_time(t - self.cars[i].reaction_time, cur_lane - 1)
-            right_headway = self.cars[i].get_headway_at_time(t - self.cars[i].reaction_time, cur_lane + 1)
+            delayed = k - self.cars[i].reaction_steps
+            headway = self.cars[i].get_headway_at_step(delayed, cur_lane)
+            left_headway = self.cars[i].get_headway_at_step(delayed, cur_lane - 1)
+            right_headway = self.cars[i].get_headway_at_step(delayed, cur_lane + 1)
 
             if self.lane_count > 1:
                 # If the headway in the other lanes is larger, then the driver becomes less patient
@@ -218,54 +687,112 @@ class Model(Loggable):
                     impatience -= self.cars[i].impatience_step
 
                 # Factor in passing cars to impatience
-                impatience += self.get_car_passing_impatience(i, t)
+                impatience += passing[self.cars[i]]
             
             # Add impatience to the car
             self.cars[i].impatience.append(impatience)
             
             # Process possible lane change
-            cur_lane = self.process_lane_change(t, i, cur_lane, left_headway, right_headway)
+            cur_lane = self.process_lane_change(t, k, i, cur_lane, left_headway, right_headway)
             self.cars[i].lanes.append(cur_lane)
 
     # Parameters:
     #   - t: current time
-    def get_headway(self, t: float) -> None:
+    #   - k: history index of the current step
+    def get_headway(self, t: float, k: int) -> None:
+        # Nearest car ahead of each car in every lane
+        leaders = self.car_order.get_leaders()
+
         # Get headway for each car
         for i in range(0, self.num_cars):
+            car = self.cars[i]
+            pos = car.get_pos_at_step(k)
 
-            # Get cur lane
-            cur_lane = self.cars[i].get_lane_at_time(t)
-
-            # headways[lane] = headway for that current lane
-            headways = [INF for _ in range(0, self.lane_count)]
-            seen_lanes = []
-
-            for j in range(i - 1, i - self.num_cars + 1, -1):
-                car = self.cars[j % self.num_cars]
-                lane = car.get_lane_at_time(t)
-
-                if lane in seen_lanes:
-                    continue
-
-                headway = (car.get_pos_at_time(t) - self.cars[i].get_pos_at_time(t)) % self.track_length
+            for lane, leader in enumerate(leaders[i]):
+                headway = INF
+                if leader is not None:
+                    headway = (leader.get_pos_at_step(k) - pos) % self.track_length
 
-                headways[lane] = headway
-                seen_lanes.append(lane)
+                # Store the headway value in the car
+                car.headway[lane].append(headway)
 
-                # Check for collision
-                if headway < self.collision_threshold and lane == cur_lane:
-                    self.log(f"Collision between car #{self.cars[i].id} and car #{self.cars[j].id} at time t={t}.\n    Car #{self.cars[i].id}: pos={self.cars[i].get_pos_at_time(t)}; vel={self.cars[i].velocity[-1]}\n    Car #{self.cars[j].id}: pos={car.get_pos_at_time(t)}; vel={self.cars[j].velocity[-1]}")
-                    self.running = False
-                    self.collided = True
-                    self.collided_ids += [self.cars[i].id, self.cars[j].id]
-                    self.end_time = t - self.time_step
+        self.detect_collisions(t, k)
 
-                if len(seen_lanes) == self.lane_count:
-                    break
-
-            # Store the headway values in the car
-            for lane, headway in enumerate(headways):
-                self.cars[i].headway[lane].append(headway)
+    # Find every collision of the step at once: the gaps between consecutive cars of each lane
+    # ordering are the headways of the cars in their own lane, a car is in contact if its gap is
+    # below the collision threshold.  Only pairs that were not in contact at the last step
+    # collided, the policy still applies to every pair in contact.
+    # Parameters:
+    #   - t: current time
+    #   - k: history index of the current step
+    def detect_collisions(self, t: float, k: int) -> None:
+        self.step_collisions = []
+        for lane, cars in enumerate(self.car_order.lanes):
+            if len(cars) < 2:
+                continue
+            pos = np.array([car.get_pos_at_step(k) for car in cars])
+            gaps = (np.roll(pos, 1) - pos) % self.track_length
+            for i in np.nonzero(gaps < self.collision_threshold)[0]:
+                self.step_collisions.append((cars[i], cars[i - 1], lane, float(gaps[i])))
+
+        contacts = {(self.fleet_index[car], self.fleet_index[leader]) for car, leader, _, _ in self.step_collisions}
+        collisions = [collision for collision in self.step_collisions if (self.fleet_index[collision[0]], self.fleet_index[collision[1]]) not in self.contacts]
+        self.contacts = contacts
+        if len(collisions) > 0:
+            self.collide(t, k, collisions)
+
+    # Log the collisions of the step, and stop the run unless the policy lets it continue
+    # Parameters:
+    #   - t: current time
+    #   - k: history index of the current step
+    #   - collisions: car, leader, lane and gap of every pair that came into contact
+    def collide(self, t: float, k: int, collisions: list) -> None:
+        cars, leaders, lanes, gaps = zip(*collisions)
+        self.collision_log.record(0, t, [car.id for car in cars], [leader.id for leader in leaders], lanes, gaps)
+
+        # Collisions the run continues through are only worth a line of debug output each
+        level = logging.WARNING if self.collision_policy == 'stop' else logging.DEBUG
+        for car, leader, _, _ in collisions:
+            self.log("Collision between car #%s and car #%s at time t=%s.\n    Car #%s: pos=%s; vel=%s\n    Car #%s: pos=%s; vel=%s",
+                car.id, leader.id, t, car.id, car.get_pos_at_step(k), car.velocity[-1], leader.id, leader.get_pos_at_step(k), leader.velocity[-1], level=level)
+            if self.collision_policy == 'stop':
+                self.collided_ids += [car.id, leader.id]
+        if self.collision_policy == 'stop':
+            self.running = False
+            self.collided = True
+            self.stop_reason = 'collision'
+            self.end_time = t - self.time_step
+
+    # Slow down every car that collided during the step so that it ends the step at least the
+    # collision threshold behind the car it hit, or where it started the step if it was already
+    # closer than that.  Cars never move backward, since the orderings and the passing counts
+    # rely on it.  Cars are clamped front to back, so a car behind a clamped car is clamped
+    # against its new position.
+    def clamp_collisions(self) -> None:
+        for car, leader, _, _ in self.step_collisions:
+            start = car.pos[-2]
+            room = (leader.pos[-1] - start) % self.track_length - self.collision_threshold
+            if car.velocity[-1] * self.time_step > room:
+                car.velocity[-1] = max(room, 0.0) / self.time_step
+                car.pos[-1] = (start + car.velocity[-1] * self.time_step) % self.track_length
+
+    # Take every car that collided during the step off the track, the cars they hit stay on it.
+    # Removed cars keep the history they have so far, and are still written to the output.
+    def remove_collided(self) -> None:
+        for car, _, _, _ in self.step_collisions:
+            if car not in self.car_order.lane_of:
+                continue
+            self.car_order.cars.remove(car)
+            self.car_order.lanes[self.car_order.lane_of.pop(car)].remove(car)
+            for order in self.delayed_orders.values():
+                order.cars.remove(car)
+                order.snapshot = None
+            if self.statistics is not None:
+                self.statistics.remove([self.fleet.index(car)])
+            self.fleet.remove(car)
+            self.removed_cars.append(car)
+        self.cars = self.car_order.cars
+        self.num_cars = len(self.cars)
 
     # Parameters:
     #   - t: current time
@@ -279,7 +806,8 @@ class Model(Loggable):
 
     # Parameters:
     #   - t: current time
-    def get_velocity(self, t: float) -> None:
+    #   - k: history index of the current step
+    def get_velocity(self, t: float, k: int) -> None:
         # Get current velocity of each car
         for i in range(0, self.num_cars):
 
@@ -288,14 +816,15 @@ class Model(Loggable):
                 self.cars[i].velocity.append(self.cars[i].fixed_velocity)
                 continue
 
-            cur_lane = self.cars[i].get_lane_at_time(t - self.cars[i].reaction_time)
-            dist_to_next = self.cars[i].get_headway_at_time(t - self.cars[i].reaction_time, cur_lane)
+            delayed = k - self.cars[i].reaction_steps
+            cur_lane = self.cars[i].get_lane_at_step(delayed)
+            dist_to_next = self.cars[i].get_headway_at_step(delayed, cur_lane)
 
             # If an influencers is close enough, then allow it to be treated as a "next car" in terms of headway
             for light in self.lights:
 
                 # Get distance to light
-                dist_to_light = (light.pos - self.cars[i].get_pos_at_time(t - self.cars[i].reaction_time)) % self.track_length
+                dist_to_light = (light.pos - self.cars[i].get_pos_at_step(delayed)) % self.track_length
 
                 # If the light is red, then treat the red light as a car in the distance calculation
                 if dist_to_light < dist_to_next and light.status == LightStatus.RED:
@@ -304,16 +833,14 @@ class Model(Loggable):
                 # If the light is yellow, see if the perceived distance to travel is greater than the distance
                 # to the light.  If it is, keep driving and ignore the light.  Otherwise, treat it as a stop.
                 elif dist_to_light < dist_to_next and light.status == LightStatus.YELLOW:
-                    perceived_velocity = self.cars[i].get_velocity_at_time(t - self.cars[i].reaction_time)
+                    perceived_velocity = self.cars[i].get_velocity_at_step(delayed)
                     time_left = light.yellow_time - t - light.last_change_time
                     carryover_dist = perceived_velocity * time_left
                     if carryover_dist < dist_to_light:
                         dist_to_next = dist_to_light
 
-            lane = self.cars[i].get_lane_at_time(t - self.cars[i].reaction_time)
-
             # Get velocity of car using Newell's equation
-            vel = (self.cars[i].max_v * self.lane_vmax_weights[lane]) - (self.cars[i].max_v * self.lane_vmax_weights[lane]) * exp((-1 * self.cars[i].lbda / (self.lane_vmax_weights[lane] * self.cars[i].max_v)) * ((dist_to_next - self.cars[i].headway_threshold)))
+            vel = (self.cars[i].max_v * self.lane_vmax_weights[cur_lane]) - (self.cars[i].max_v * self.lane_vmax_weights[cur_lane]) * exp((-1 * self.cars[i].lbda / (self.lane_vmax_weights[cur_lane] * self.cars[i].max_v)) * ((dist_to_next - self.cars[i].headway_threshold)))
 
             # Velocity cannot be < 0
             if vel < 0:
@@ -321,12 +848,36 @@ class Model(Loggable):
 
             self.cars[i].velocity.append(vel)
 
-    def dump(self, filename="data/run.csv") -> None:
+    # Write the whole history of every car to an output sink, one car at a time
+    # Parameters:
+    #   - sink: object with a write(columns) method
+    #   - replica: replica to write, only replica 0 exists in the loop engine
+    def write_history(self, sink, replica: int = 0) -> None:
+        if replica != 0:
+            raise ValueError(f'Replica {replica} does not exist, the loop engine runs a single replica.')
+        if self.history != 'full':
+            raise RuntimeError('Only the most recent history is kept, attach an output sink to save the run instead.')
+        first = self.first_step + 1
+        for car in self.cars + self.removed_cars:
+            steps = len(car.pos) - first
+            sink.write([
+                [car.id] * steps,
+                car.time[first:],
+                car.pos[first:],
+                car.velocity[first:],
+                car.impatience[first:],
+                car.lanes[first:]] + [headway[first:] for headway in car.headway])
+
+    def dump(self, filename="data/run.csv", replica: int = 0) -> None:
+        if replica != 0:
+            raise ValueError(f'Replica {replica} does not exist, the loop engine runs a single replica.')
+        if self.history != 'full':
+            raise RuntimeError('Only the most recent history is kept, attach an output sink to save the run instead.')
         with open(filename, 'w', newline='') as csvfile:
             writer = csv.writer(csvfile)
-            writer.writerow(['Car ID', 'Time', 'Position', 'Velocity', 'Impatience', 'Lane'] + [f'Headway to Lane {lane}' for lane in range(0, self.lane_count)])
-            for car in self.cars:
-                for i in range(1, len(car.pos)):
+            writer.writerow(output_columns(self.lane_count))
+            for car in self.cars + self.removed_cars:
+                for i in range(self.first_step + 1, len(car.pos)):
                     writer.writerow([
                         car.id, 
                         round(car.time[i], 4), 
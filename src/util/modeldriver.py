@@ -162,10 +162,10 @@ class ModelDriver():
 
     def get_deltan(self) -> List:
         cars_per_lane = []
-        for t in arange(self.model.start_time, self.model.max_time, self.model.time_step):
+        for k in range(self.model.first_step, self.model.tick):
             lane_counts = [0 for _ in range(0, self.lane_count)]
             for car in self.model.cars:
-                lane = car.get_lane_at_time(t)
+                lane = car.get_lane_at_step(k)
                 lane_counts[lane] += 1
             cars_per_lane.append(lane_counts)
 
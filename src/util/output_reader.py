@@ -0,0 +1,94 @@
+import csv
+import json
+import numpy as np
+from typing import List
+
+from models.carbase import CarBase
+from models.history import History
+from util.output_sink import BINARY_MAGIC
+
+# Memory map binary simulation output, see BINARY_MAGIC in util.output_sink
+# Params:
+#   - filename: binary output file
+# Returns:
+#   - structured array with one field per output column, backed by the file
+def read_binary_output(filename: str) -> np.ndarray:
+    with open(filename, 'rb') as file:
+        if file.read(len(BINARY_MAGIC)) != BINARY_MAGIC:
+            raise ValueError(f'{filename} is not a binary simulation output file.')
+        header_length = int.from_bytes(file.read(4), 'little')
+        header = json.loads(file.read(header_length).decode('utf-8'))
+        offset = file.tell()
+        file.seek(0, 2)
+        size = file.tell()
+
+    dtype = np.dtype([tuple(field) for field in header['dtype']])
+
+    # Ignore a partially written record at the end of the file
+    count = (size - offset) // dtype.itemsize
+    if count == 0:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=(count,))
+
+# Load binary simulation output into one CarBase per car
+# Params:
+#   - filename: binary output file
+# Returns:
+#   - cars in order of first appearance, with histories ordered by time
+def load_cars_from_binary(filename: str) -> List[CarBase]:
+    records = read_binary_output(filename)
+    ids = records['Car ID']
+
+    # Group records by car, keeping the order they were written in
+    order = np.argsort(ids, kind='stable')
+    unique_ids, starts, counts = np.unique(ids[order], return_index=True, return_counts=True)
+    first_seen = np.argsort(order[starts])
+
+    cars = []
+    for u in first_seen:
+        rows = order[starts[u]:starts[u] + counts[u]]
+        car = CarBase(int(unique_ids[u]))
+        car.time = History.wrap(records['Time'][rows])
+        car.pos = History.wrap(records['Position'][rows])
+        car.velocity = History.wrap(records['Velocity'][rows])
+        car.impatience = History.wrap(records['Impatience'][rows])
+        car.lanes = History.wrap(records['Lane'][rows])
+        cars.append(car)
+    return cars
+
+# Load CSV simulation output into one CarBase per car
+# Params:
+#   - filename: CSV output file
+# Returns:
+#   - cars in order of first appearance, with histories in the order they were written
+def load_cars_from_csv(filename: str) -> List[CarBase]:
+    # Rows may be ordered by car or by time, so look cars up by id
+    cars = {}
+    with open(filename, 'r') as file:
+        reader = csv.reader(file)
+        for rownum, row in enumerate(reader):
+
+            # Skip first row
+            if rownum == 0:
+                continue
+
+            # Get data from csv
+            id = int(row[0])
+            position = float(row[2])
+            velocity = float(row[3])
+            time = float(row[1])
+            impatience = float(row[4])
+            lane = int(row[5])
+
+            # Make a new car if it doesn't exist
+            if id not in cars:
+                cars[id] = CarBase(id)
+
+            # Add information to car
+            car = cars[id]
+            car.pos.append(position)
+            car.velocity.append(velocity)
+            car.time.append(time)
+            car.lanes.append(lane)
+            car.impatience.append(impatience)
+    return list(cars.values())
@@ -0,0 +1,191 @@
+import csv
+import json
+import numpy as np
+from queue import Queue
+from threading import Thread
+from typing import List
+
+from util.loggable import Loggable
+
+# Get the column names of simulation output
+# Params:
+#   - lane_count: number of lanes in the simulation
+# Returns:
+#   - list of column names
+def output_columns(lane_count: int) -> List[str]:
+    return ['Car ID', 'Time', 'Position', 'Velocity', 'Impatience', 'Lane'] + [f'Headway to Lane {lane}' for lane in range(0, lane_count)]
+
+# Binary output starts with BINARY_MAGIC, a little endian uint32 holding the length of a
+# JSON header, and the JSON header itself, padded with spaces to a multiple of 16 bytes.
+# The header describes the numpy dtype of the fixed-width records that fill the rest of
+# the file, one record per car per time step:
+#   Car ID (int64), Time, Position, Velocity, Impatience (float64), Lane (int32),
+#   Headway to Lane 0..n (float64)
+BINARY_MAGIC = b'TRAFSIM\x01'
+BINARY_ALIGNMENT = 16
+
+# Extension of the output file for each output format
+OUTPUT_EXTENSIONS = {
+    'csv': 'csv',
+    'binary': 'bin'
+}
+
+# Get the record dtype of binary simulation output
+# Params:
+#   - lane_count: number of lanes in the simulation
+# Returns:
+#   - numpy structured dtype with one field per output column
+def binary_dtype(lane_count: int) -> np.dtype:
+    types = ['<i8', '<f8', '<f8', '<f8', '<f8', '<i4'] + ['<f8' for _ in range(0, lane_count)]
+    return np.dtype(list(zip(output_columns(lane_count), types)))
+
+# Output sink that writes finished samples to a CSV file as the model produces them.
+# Rows are written one time step at a time, so the file is ordered by time rather than by car.
+class CsvSink(Loggable):
+    def __init__(self, filename: str, lane_count: int) -> None:
+        super().__init__()
+        self.filename = filename
+        self.file = open(filename, 'w', newline='')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(output_columns(lane_count))
+
+    # Write the samples of one time step
+    # Params:
+    #   - columns: one sequence per output column, holding a value for each car
+    def write(self, columns: List[list]) -> None:
+        ids, time, pos, velocity, impatience, lanes = columns[:6]
+        self.writer.writerows(zip(
+            ids,
+            [round(v, 4) for v in time],
+            [round(v, 6) for v in pos],
+            [round(v, 6) for v in velocity],
+            [round(v, 6) for v in impatience],
+            lanes,
+            *columns[6:]))
+
+    def flush(self) -> None:
+        self.file.flush()
+
+    def close(self) -> None:
+        self.file.close()
+
+# Output sink that appends samples as fixed-width binary records, see BINARY_MAGIC.
+# Records are written whole, so the file can be memory mapped while it is being written
+# and a killed run leaves every completed record readable.
+class BinarySink(Loggable):
+    def __init__(self, filename: str, lane_count: int) -> None:
+        super().__init__()
+        self.filename = filename
+        self.dtype = binary_dtype(lane_count)
+        header = json.dumps({'lane_count': lane_count, 'dtype': self.dtype.descr}).encode('utf-8')
+        padding = -(len(BINARY_MAGIC) + 4 + len(header)) % BINARY_ALIGNMENT
+        header += b' ' * padding
+        self.file = open(filename, 'wb')
+        self.file.write(BINARY_MAGIC + len(header).to_bytes(4, 'little') + header)
+
+    # Write a batch of samples
+    # Params:
+    #   - columns: one sequence per output column, holding a value for each sample
+    def write(self, columns: List[list]) -> None:
+        records = np.empty(len(columns[0]), dtype=self.dtype)
+        for name, column in zip(self.dtype.names, columns):
+            records[name] = column
+        records.tofile(self.file)
+
+    def flush(self) -> None:
+        self.file.flush()
+
+    def close(self) -> None:
+        self.file.close()
+
+# Open an output sink for the given format
+# Params:
+#   - filename: file to write to
+#   - lane_count: number of lanes in the simulation
+#   - output_format: 'csv' or 'binary'
+def open_sink(filename: str, lane_count: int, output_format: str = 'csv'):
+    if output_format == 'binary':
+        return BinarySink(filename, lane_count)
+    return CsvSink(filename, lane_count)
+
+# Output sink that splits the samples of an ensemble run into one sink per replica
+class ReplicaSink(Loggable):
+    # Params:
+    #   - sinks: sink of each replica, such as a CsvSink
+    def __init__(self, sinks: list) -> None:
+        super().__init__()
+        self.sinks = sinks
+
+    # Write the samples of one time step
+    # Params:
+    #   - columns: dictionary of the output columns of each replica that has samples
+    def write(self, columns: dict) -> None:
+        for replica, replica_columns in columns.items():
+            self.sinks[replica].write(replica_columns)
+
+    def flush(self) -> None:
+        for sink in self.sinks:
+            sink.flush()
+
+    def close(self) -> None:
+        for sink in self.sinks:
+            sink.close()
+
+# Output sink that collects finished time steps into chunks and hands each chunk to a
+# background thread, which writes it to the wrapped sink and flushes it to disk.  Disk
+# writes overlap with the simulation, and a killed run keeps every flushed chunk.
+class StreamingWriter(Loggable):
+    # Params:
+    #   - sink: sink that the chunks are written to, such as a CsvSink
+    #   - chunk_steps: number of time steps per chunk
+    #   - max_pending: number of chunks that may wait to be written before the model blocks
+    def __init__(self, sink, chunk_steps: int = 100, max_pending: int = 4) -> None:
+        super().__init__()
+        self.sink = sink
+        self.chunk_steps = max(int(chunk_steps), 1)
+        self.chunk = []
+        self.error = None
+        self.queue = Queue(maxsize=max_pending)
+        self.thread = Thread(target=self.__write_chunks__, daemon=True)
+        self.thread.start()
+
+    # Add the samples of one time step to the current chunk
+    # Params:
+    #   - columns: one sequence per output column, holding a value for each car
+    def write(self, columns: List[list]) -> None:
+        self.chunk.append(columns)
+        if len(self.chunk) >= self.chunk_steps:
+            self.__submit__()
+
+    # Write any remaining samples and wait for the background thread to finish
+    def close(self) -> None:
+        if len(self.chunk) > 0 and self.error is None:
+            self.queue.put(self.chunk)
+            self.chunk = []
+        self.queue.put(None)
+        self.thread.join()
+        self.sink.close()
+        if self.error is not None:
+            raise RuntimeError(f'Failed to write output: {self.error}') from self.error
+
+    def __submit__(self) -> None:
+        if self.error is not None:
+            raise RuntimeError(f'Failed to write output: {self.error}') from self.error
+        self.queue.put(self.chunk)
+        self.chunk = []
+
+    # Background thread, writes chunks until it receives None
+    def __write_chunks__(self) -> None:
+        while True:
+            chunk = self.queue.get()
+            if chunk is None:
+                return
+            # Keep draining the queue after an error so the model never blocks on it
+            if self.error is not None:
+                continue
+            try:
+                for columns in chunk:
+                    self.sink.write(columns)
+                self.sink.flush()
+            except Exception as e:
+                self.error = e
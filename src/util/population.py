@@ -0,0 +1,57 @@
+from typing import List
+
+from models.car import Car
+from util.script import Script
+
+# Build evenly spaced cars in every lane, with the lanes staggered so that no two cars start
+# side by side.  Every car starts with a headway of the spacing.
+# Params:
+#   - per_lane: number of cars in each lane
+#   - lane_count: number of lanes
+#   - spacing: distance between consecutive cars of a lane
+#   - offsets: extra offset of every car from its evenly spaced position, in order of lane
+#     and then car, None to keep the cars evenly spaced
+#   - params: reaction_time, headway_threshold, max_v, time_step, impatience_step and lbda of every car
+# Returns:
+#   - cars with ids from 1, in descending order of position
+def spaced_cars(per_lane: int, lane_count: int, spacing: float, offsets: List[float] = None, **params) -> List[Car]:
+    cars = []
+    for lane in range(0, lane_count):
+        for i in range(0, per_lane):
+            offset = 0.0 if offsets is None else offsets[len(cars)]
+            cars.append(
+                Car(
+                    id          = len(cars) + 1,
+                    x_0         = (i + lane / lane_count) * spacing + offset,
+                    t_0         = 0,
+                    h_0         = spacing,
+                    lane        = lane,
+                    lane_count  = lane_count,
+                    **params
+                )
+            )
+    return sorted(cars, key=lambda car: car.pos[-1], reverse=True)
+
+# Built in pre-run script that generates the cars from the 'Density' parameter, in cars per
+# meter of track in every lane.  The cars of each lane are evenly spaced, and the lanes are
+# staggered so that no two cars start side by side.
+class DensityPopulation(Script):
+    def run(self, simulationParams) -> None:
+        super().run(simulationParams)
+        lane_count, track_length = simulationParams.LaneCount, simulationParams.L_track
+        per_lane = int(round(simulationParams.Density * track_length))
+        if per_lane < 1:
+            raise ValueError(f'Density {simulationParams.Density} leaves no cars on a track of length {track_length}.')
+        spacing = track_length / per_lane
+        if spacing <= simulationParams.L_car:
+            raise ValueError(f'Density {simulationParams.Density} spaces cars closer than their length {simulationParams.L_car}.')
+
+        self.Cars = spaced_cars(per_lane, lane_count, spacing,
+            reaction_time       = simulationParams.Delta,
+            headway_threshold   = simulationParams.d_min,
+            max_v               = simulationParams.V_max,
+            time_step           = simulationParams.TimeStep,
+            impatience_step     = simulationParams.ImpatienceStep,
+            lbda                = simulationParams.Lambda)
+        self.NumCars = len(self.Cars)
+        self.log(f'Generated {self.NumCars} cars at a density of {simulationParams.Density} cars per meter per lane.')
@@ -0,0 +1,78 @@
+import tracemalloc
+from time import perf_counter
+
+# Phases of a time step, in the order the engines run them
+PROFILE_PHASES = ['influencers', 'order', 'passing', 'lane', 'headway', 'velocity', 'position', 'output', 'monitoring']
+
+# Cumulative wall time and call count of every phase of a run.  The model marks the end of
+# each phase with lap, which charges the time since the previous mark to that phase, so a
+# step costs one clock read per phase and nothing is nested.  Optionally the peak memory
+# allocated by Python during the run is traced as well, which slows the run down noticeably.
+class PhaseProfiler:
+    # Params:
+    #   - memory: trace the peak memory of the run with tracemalloc
+    def __init__(self, memory: bool = False) -> None:
+        self.memory = memory
+        self.times = {phase: 0.0 for phase in PROFILE_PHASES}
+        self.calls = {phase: 0 for phase in PROFILE_PHASES}
+        self.steps = 0
+        self.elapsed = 0.0
+        self.peak_memory = None
+        self.started = None
+        self.last = None
+        self.tracing = False
+
+    # Start timing, before the model evaluates
+    def start(self) -> None:
+        if self.memory:
+            self.tracing = not tracemalloc.is_tracing()
+            if self.tracing:
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+        self.started = self.last = perf_counter()
+
+    # Mark the start of a time step, time spent between steps is not charged to any phase
+    def mark(self) -> None:
+        self.last = perf_counter()
+
+    # Charge the time since the previous mark to a phase
+    # Params:
+    #   - phase: phase that just finished, see PROFILE_PHASES
+    def lap(self, phase: str) -> None:
+        now = perf_counter()
+        self.times[phase] += now - self.last
+        self.calls[phase] += 1
+        self.last = now
+
+    # Stop timing, after the model evaluated
+    # Params:
+    #   - steps: number of steps the model ran
+    def stop(self, steps: int) -> None:
+        self.elapsed += perf_counter() - self.started
+        self.steps += steps
+        if self.memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            self.peak_memory = peak if self.peak_memory is None else max(self.peak_memory, peak)
+            if self.tracing:
+                tracemalloc.stop()
+
+    # Returns:
+    #   - wall time, steps per second and peak memory of the run, and the time, share of the
+    #     wall time and call count of every phase
+    def summary(self) -> dict:
+        phases = {}
+        for phase in PROFILE_PHASES:
+            if self.calls[phase] > 0:
+                phases[phase] = {
+                    'Time': self.times[phase],
+                    'Share': self.times[phase] / self.elapsed if self.elapsed > 0 else 0.0,
+                    'Calls': self.calls[phase]
+                }
+        return {
+            'Steps': self.steps,
+            'WallTime': self.elapsed,
+            'StepsPerSecond': self.steps / self.elapsed if self.elapsed > 0 else 0.0,
+            'PeakMemory': self.peak_memory,
+            'Other': max(self.elapsed - sum(self.times.values()), 0.0),
+            'Phases': phases
+        }
@@ -0,0 +1,185 @@
+import os
+from math import ceil
+from queue import Empty
+from time import monotonic
+from typing import Dict
+
+from util.loggable import Loggable
+
+# Number of report intervals a run may stay silent before it is flagged as stalled
+STALL_REPORTS = 5
+
+# Reports the progress of a single run every few steps: the simulated time, the steps per
+# second and the time left.  Reports go to a queue when the run is part of a sweep, so that
+# the parent process can show them together, and are logged otherwise.  Every report is a
+# small dict, see report.
+class ProgressReporter(Loggable):
+    # Params:
+    #   - Id: run id
+    #   - interval: number of steps between reports
+    #   - queue: queue shared with the parent process, None to log the reports
+    def __init__(self, Id, interval: int, queue = None) -> None:
+        super().__init__()
+        if interval < 1:
+            raise ValueError('Progress must be reported at most every step.')
+        self.Id = str(Id)
+        self.interval = interval
+        self.queue = queue
+        self.first_step = 0
+        self.steps = 0
+        self.started = None
+
+    # Params:
+    #   - step: step the run starts from, later than 0 for restored runs
+    #   - steps: step the run ends at
+    def start(self, step: int, steps: int) -> None:
+        self.first_step, self.steps = step, steps
+        self.started = monotonic()
+        self.report('start', step, None)
+
+    # Params:
+    #   - step: number of steps run so far
+    #   - t: simulated time of the last step
+    def update(self, step: int, t: float) -> None:
+        self.report('progress', step, t)
+
+    # Params:
+    #   - step: step the run stopped at, earlier than the last step if it stopped early
+    #   - t: simulated time of the last step
+    def evaluated(self, step: int, t: float) -> None:
+        # A run that stops between two reports, such as on a collision or a steady state,
+        # still reports its last step
+        if step % self.interval != 0 and step > self.first_step:
+            self.update(step, t)
+        self.report('evaluated', step, None)
+
+    # Params:
+    #   - step: step the run stopped at
+    def finish(self, step: int) -> None:
+        self.report('done', step, None)
+
+    # Params:
+    #   - event: 'start', 'progress', 'evaluated' once the model stopped, or 'done' once the
+    #     output of the run is written
+    #   - step: number of steps run so far
+    #   - t: simulated time of the last step, None if not known
+    def report(self, event: str, step: int, t: float) -> None:
+        elapsed = monotonic() - self.started
+        rate = (step - self.first_step) / elapsed if elapsed > 0 else 0.0
+        eta = (self.steps - step) / rate if rate > 0 else None
+        message = {
+            'Event': event,
+            'Id': self.Id,
+            'Process': os.getpid(),
+            'Step': step,
+            'FirstStep': self.first_step,
+            'Steps': self.steps,
+            'Interval': self.interval,
+            'Time': t,
+            'StepsPerSecond': rate,
+            'ETA': eta
+        }
+        if self.queue is not None:
+            self.queue.put(message)
+        elif event == 'progress':
+            self.log(format_run(message))
+
+# Params:
+#   - seconds: length of time, None if not known
+# Returns:
+#   - the time as hours, minutes and seconds
+def format_seconds(seconds: float) -> str:
+    if seconds is None:
+        return '?'
+    seconds = int(ceil(seconds))
+    return f'{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}'
+
+# Params:
+#   - message: progress report of a run
+# Returns:
+#   - one line description of the progress of the run
+def format_run(message: dict) -> str:
+    time = f", t={message['Time']:.2f}s" if message['Time'] is not None else ''
+    return (f"Step {message['Step']}/{message['Steps']}{time}, "
+        f"{message['StepsPerSecond']:.1f} steps/s, ETA {format_seconds(message['ETA'])}")
+
+# Collects the progress reports of the runs of a sweep into a single view: runs done, runs in
+# flight, the total throughput and the projected finish of the sweep.  Runs that stop
+# reporting for several report intervals are flagged as stalled.
+class SweepProgress(Loggable):
+    # Params:
+    #   - queue: queue the runs report to
+    #   - runs: number of runs in the sweep
+    #   - total_steps: steps of every run of the sweep together, corrected as runs start part
+    #     way through or stop early
+    #   - interval: seconds between views of the sweep
+    def __init__(self, queue, runs: int, total_steps: int, interval: float = 10.0) -> None:
+        super().__init__()
+        self.queue = queue
+        self.runs = runs
+        self.total_steps = total_steps
+        self.interval = interval
+        self.done = 0
+        self.done_steps = 0
+        self.in_flight: Dict[str, dict] = {}
+        self.last_seen: Dict[str, float] = {}
+        self.started = monotonic()
+
+    # Handle reports until a None is put on the queue, showing the sweep every interval
+    def listen(self) -> None:
+        last_view = monotonic()
+        while True:
+            try:
+                message = self.queue.get(timeout=self.interval)
+            except Empty:
+                message = False
+            if message is None:
+                self.show()
+                return
+            if message:
+                self.handle(message)
+            if monotonic() - last_view >= self.interval:
+                self.show()
+                last_view = monotonic()
+
+    # Params:
+    #   - message: progress report of a run
+    def handle(self, message: dict) -> None:
+        Id = message['Id']
+        if message['Event'] == 'start':
+            # A restored run does not run the steps before its checkpoint
+            self.total_steps -= message['FirstStep']
+        if message['Event'] == 'done':
+            self.in_flight.pop(Id, None)
+            self.last_seen.pop(Id, None)
+            self.done += 1
+            # A run that stopped early does not run the rest of its steps
+            self.done_steps += message['Step'] - message['FirstStep']
+            self.total_steps -= message['Steps'] - message['Step']
+            return
+        self.in_flight[Id] = message
+        self.last_seen[Id] = monotonic()
+
+    # Log the runs done and in flight, the current throughput and the projected finish, and
+    # every run in flight.  The finish is projected from the average throughput of the sweep
+    # so far, which also counts the time spent between the steps of the runs.
+    def show(self) -> None:
+        now = monotonic()
+        running = [message for message in self.in_flight.values() if message['Event'] != 'evaluated']
+        throughput = sum(message['StepsPerSecond'] for message in running)
+        completed = self.done_steps + sum(message['Step'] - message['FirstStep'] for message in self.in_flight.values())
+        elapsed = now - self.started
+        remaining = max(self.total_steps - completed, 0)
+        eta = remaining * elapsed / completed if completed > 0 else None
+        self.log(f'{self.done}/{self.runs} run(s) done, {len(self.in_flight)} in flight, '
+            f'{throughput:.1f} steps/s, elapsed {format_seconds(elapsed)}, projected finish in {format_seconds(eta)}')
+        for Id, message in self.in_flight.items():
+            if message['Event'] == 'evaluated':
+                self.log(f"  {Id} (process {message['Process']}): Step {message['Step']}/{message['Steps']}, writing output")
+                continue
+
+            # Seconds between reports of the run, at its current speed
+            silent = now - self.last_seen[Id]
+            expected = message['Interval'] / message['StepsPerSecond'] if message['StepsPerSecond'] > 0 else 0.0
+            stalled = f', STALLED for {format_seconds(silent)}' if silent > STALL_REPORTS * max(expected, self.interval) else ''
+            self.log(f"  {Id} (process {message['Process']}): {format_run(message)}{stalled}")
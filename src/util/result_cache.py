@@ -0,0 +1,83 @@
+import json
+from hashlib import sha256
+from os import makedirs, path
+from typing import List
+from uuid import UUID, uuid5
+
+from util.loggable import Loggable
+from util.output_sink import OUTPUT_EXTENSIONS
+
+# Parameters that only change how a run is reported or written, not its results, so they are
+# left out of the hash.  Turning on progress reports or profiling keeps the cache.
+REPORTING_PARAMETERS = ['ProgressInterval', 'Profile', 'ProfileMemory', 'StreamOutput', 'OutputChunkSteps']
+
+# Content addressed cache of finished simulations.  A simulation is identified by a hash of
+# its resolved parameters (including the seed), the contents of its pre and post run scripts
+# and which copy of the same simulation it is, and that hash determines its run id.  A
+# finished run leaves a {Id}.json file holding its manifest row next to its output, so a
+# later run of the same simulation finds it in the output directory and is skipped.  Runs
+# without a seed draw a new one every time, so they are never found in the cache.
+class ResultCache(Loggable):
+    def __init__(self) -> None:
+        super().__init__()
+        self.scripts = {}
+
+    # Params:
+    #   - config: resolved config of the simulation
+    #   - copy: index of the copy when the same simulation is run several times
+    # Returns:
+    #   - run id of the simulation, the id of its first replica
+    def run_id(self, config: dict, copy: int) -> UUID:
+        content = json.dumps({
+            'Config': {name: value for name, value in config.items() if name not in REPORTING_PARAMETERS},
+            'PreRunScript': self.__script__(config.get('PreRunScript', '')),
+            'PostRunScript': self.__script__(config.get('PostRunScript', '')),
+            'Copy': copy
+        }, sort_keys=True)
+        return UUID(hex=sha256(content.encode('utf-8')).hexdigest()[:32])
+
+    # Get the manifest rows of a finished simulation
+    # Params:
+    #   - config: resolved config of the simulation
+    #   - Id: run id of the simulation
+    # Returns:
+    #   - manifest row of each replica, or None if any replica has not finished
+    def load(self, config: dict, Id: UUID) -> List[dict]:
+        directory = config.get('OutputDirectory', '')
+        extension = OUTPUT_EXTENSIONS.get(config.get('OutputFormat', 'csv'), 'csv')
+        trajectories = config.get('OutputTrajectories', True)
+        rows = []
+        for replica_id in replica_ids(Id, config.get('Replicas', 1)):
+            entry = f'{directory}{replica_id}.json'
+            if not path.exists(entry) or (trajectories and not path.exists(f'{directory}{replica_id}.{extension}')):
+                return None
+            with open(entry, 'r') as file:
+                rows.append(json.load(file))
+        return rows
+
+    # Record finished simulations in the cache
+    # Params:
+    #   - rows: manifest row of each replica of a finished simulation
+    def store(self, rows: List[dict]) -> None:
+        for row in rows:
+            if row['OutputDirectory'] != '':
+                makedirs(row['OutputDirectory'], exist_ok=True)
+            with open(f"{row['OutputDirectory']}{row['Id']}.json", 'w') as file:
+                json.dump(dict(row, Id=str(row['Id'])), file)
+
+    # Contents of a script, read once per file
+    def __script__(self, filename: str) -> str:
+        if filename == '':
+            return ''
+        if filename not in self.scripts:
+            with open(filename, 'r') as file:
+                self.scripts[filename] = file.read()
+        return self.scripts[filename]
+
+# Params:
+#   - Id: run id of the simulation
+#   - replicas: number of replicas of the simulation
+# Returns:
+#   - run id of each replica, the first replica uses the run id of the simulation
+def replica_ids(Id: UUID, replicas: int) -> List[UUID]:
+    return [Id] + [uuid5(Id, str(replica)) for replica in range(1, replicas)]
@@ -1,25 +1,54 @@
 import json
-from uuid import uuid4
-from os import path, makedirs
-from typing import List
+from numpy.random import SeedSequence
+from uuid import UUID, uuid4
+from os import makedirs
+from typing import List, Union
 
 from models.car import Car
+from util.collisions import COLLISION_POLICIES
 from util.model import Model
+from util.vectorized_model import VectorizedModel
+from util.population import DensityPopulation
+from util.profiler import PhaseProfiler
+from util.progress import ProgressReporter
+from util.output_sink import OUTPUT_EXTENSIONS, ReplicaSink, StreamingWriter, open_sink
 from util.loggable import Loggable
+from util.result_cache import replica_ids
 from util.script import Script
+from util.statistics import StatisticsCollector
+
+# Engines that can be selected with the 'Engine' parameter
+ENGINES = {
+    'loop': Model,
+    'vectorized': VectorizedModel
+}
 
 class SimulationFromJson(Loggable):
-    def __init__(self, json_file: str) -> None:
+    # Params:
+    #   - config: JSON config file, or the already parsed config
+    #   - overrides: parameters that replace the ones in the config, such as the values of a sweep
+    #   - Id: run id, a random one is assigned if not supplied
+    #   - copy: index of the copy when the same simulation is run several times
+    #   - progress_queue: queue progress reports are put on, None to log them
+    def __init__(self, config: Union[str, dict], overrides: dict = {}, Id: UUID = None, copy: int = 0, progress_queue = None) -> None:
         super().__init__()
 
         # Assign a guid to act as a run id
-        self.Id = uuid4()
+        self.Id = uuid4() if Id is None else Id
 
         # Load JSON file
-        self.log(f'Loading simulation from {json_file}')
-        with open(json_file, 'r') as file:
-            data = json.load(file)
-        
+        if isinstance(config, str):
+            self.log(f'Loading simulation from {config}')
+            with open(config, 'r') as file:
+                data = json.load(file)
+        else:
+            data = dict(config)
+        data.update(overrides)
+
+        # Every parameter of the config stays available to the pre and post run scripts
+        self.Config:                dict = data
+        self.SweepValues:           dict = dict(overrides)
+
         # Model parameters
         self.log('Loading model parameters...')
         self.Lambda:                float = data.get('Lambda', 1)
@@ -35,18 +64,88 @@ class SimulationFromJson(Loggable):
         self.LaneVelocityWeights:   List[float] = data.get('LaneVelocityWeights', [1.0 for _ in range(0, self.LaneCount)])
         self.PassingModifier:       float = data.get('PassingModifier', 0.1)
         self.ImpatienceStep:        float = data.get('ImpatienceStep', 0.001)
+        self.Engine:                str = data.get('Engine', 'loop')
+        self.History:               str = data.get('History', 'full')
+        self.StreamOutput:          bool = data.get('StreamOutput', False)
+        self.OutputChunkSteps:      int = data.get('OutputChunkSteps', 100)
+        self.OutputFormat:          str = data.get('OutputFormat', 'csv')
+        self.Replicas:              int = data.get('Replicas', 1)
+        self.Seed:                  int = data.get('Seed', None)
+        self.Copy:                  int = copy
+        self.CheckpointInterval:    int = data.get('CheckpointInterval', 0)
+        self.RestoreCheckpoint:     str = data.get('RestoreCheckpoint', '')
+        self.WarmStart:             str = data.get('WarmStart', '')
+        self.SaveEndState:          bool = data.get('SaveEndState', False)
+        self.ConvergenceMetrics:    List[str] = data.get('ConvergenceMetrics', [])
+        self.ConvergenceTolerance:  float = data.get('ConvergenceTolerance', 0.01)
+        self.ConvergenceWindow:     float = data.get('ConvergenceWindow', 50.0)
+        self.ConvergenceCheckSteps: int = data.get('ConvergenceCheckSteps', 100)
+        self.Statistics:            bool = data.get('Statistics', False)
+        self.StatisticsWindow:      float = data.get('StatisticsWindow', 0.0)
+        self.StopSpeed:             float = data.get('StopSpeed', 1.0)
+        self.ImpatienceBins:        List[float] = data.get('ImpatienceBins', [0.0, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0])
+        self.OutputTrajectories:    bool = data.get('OutputTrajectories', True)
+        self.StatisticsStart:       float = data.get('StatisticsStart', 0.0)
+        self.Density:               float = data.get('Density', None)
+        self.Profile:               bool = data.get('Profile', False)
+        self.ProfileMemory:         bool = data.get('ProfileMemory', False)
+        self.ProgressInterval:      int = data.get('ProgressInterval', 0)
+        self.CollisionPolicy:       str = data.get('CollisionPolicy', 'stop')
+        self.ProgressQueue = progress_queue
         self.Collided:              bool = False
 
-        # Configure pre run script
+        if self.Engine not in ENGINES:
+            raise ValueError(f"Unknown engine '{self.Engine}'.  Must be one of: {', '.join(ENGINES)}.")
+        if self.OutputFormat not in OUTPUT_EXTENSIONS:
+            raise ValueError(f"Unknown output format '{self.OutputFormat}'.  Must be one of: {', '.join(OUTPUT_EXTENSIONS)}.")
+        if not isinstance(self.Replicas, int) or self.Replicas < 1:
+            raise ValueError(f"Replicas must be a positive integer, got '{self.Replicas}'.")
+        if self.Replicas > 1 and self.Engine != 'vectorized':
+            raise ValueError('Replicas requires the vectorized engine.')
+        if self.Seed is not None and (not isinstance(self.Seed, int) or self.Seed < 0):
+            raise ValueError(f"Seed must be a non-negative integer, got '{self.Seed}'.")
+        if not isinstance(self.ProgressInterval, int) or self.ProgressInterval < 0:
+            raise ValueError(f"ProgressInterval must be a non-negative integer, got '{self.ProgressInterval}'.")
+        if not isinstance(self.CheckpointInterval, int) or self.CheckpointInterval < 0:
+            raise ValueError(f"CheckpointInterval must be a non-negative integer, got '{self.CheckpointInterval}'.")
+        if self.RestoreCheckpoint != '' and self.WarmStart != '':
+            raise ValueError('A run can either restore a checkpoint or warm start, not both.')
+        if self.CollisionPolicy not in COLLISION_POLICIES:
+            raise ValueError(f"Unknown collision policy '{self.CollisionPolicy}'.  Must be one of: {', '.join(COLLISION_POLICIES)}.")
+        if self.CollisionPolicy == 'remove' and (self.CheckpointInterval > 0 or self.SaveEndState):
+            raise ValueError("The state of a run can not be saved once cars are removed, the 'remove' collision policy does not support checkpoints or end states.")
+
+        # Random draws of every copy and replica come from independent streams of the seed, so
+        # results only depend on the config, never on the process that runs it.  Unseeded runs
+        # get a random seed, which is recorded in the manifest to make them repeatable.
+        if self.Seed is None:
+            self.Seed = SeedSequence().entropy
+
+        # Every replica is a separate run with its own id and output file
+        self.Ids = [self.Id] + [uuid4() for _ in range(1, self.Replicas)] if Id is None else replica_ids(Id, self.Replicas)
+        self.OutputFiles:           List[str] = [f'{self.OutputDirectory}{Id}.{OUTPUT_EXTENSIONS[self.OutputFormat]}' for Id in self.Ids]
+        self.OutputFile:            str = self.OutputFiles[0]
+        self.CheckpointFile:        str = data.get('CheckpointFile', f'{self.OutputDirectory}{self.Id}.checkpoint')
+        self.EndStateFile:          str = data.get('EndStateFile', f'{self.OutputDirectory}{self.Id}.state') if self.SaveEndState else ''
+        self.SummaryFiles:          List[str] = [f'{self.OutputDirectory}{Id}.summary.json' for Id in self.Ids] if self.Statistics or self.Profile else ['' for _ in self.Ids]
+        self.SummaryFile:           str = self.SummaryFiles[0]
+        self.CollisionFiles:        List[str] = ['' for _ in self.Ids]
+        self.Summaries:             List[dict] = None
+        self.Profiler:              PhaseProfiler = None
+
+        # Configure pre run script, without one the cars are generated from the density
         preRunFile = data.get('PreRunScript', '')
-        if preRunFile == '':
-            raise RuntimeError('PreRunScript not supplied.')
-        exec( open(preRunFile).read() )
+        if preRunFile == '' and self.Density is not None:
+            self.PreRunScript: Script = DensityPopulation()
+        else:
+            if preRunFile == '':
+                raise RuntimeError('PreRunScript not supplied.')
+            exec( open(preRunFile).read() )
 
-        # Required to supply an instance of the pre run script
-        if 'PreRunInstance' not in locals():
-            raise RuntimeError("PreRunInstance not defined in pre run script.")
-        self.PreRunScript: Script = locals()['PreRunInstance']
+            # Required to supply an instance of the pre run script
+            if 'PreRunInstance' not in locals():
+                raise RuntimeError("PreRunInstance not defined in pre run script.")
+            self.PreRunScript: Script = locals()['PreRunInstance']
 
         # Configure post run script
         self.PostRunScript: Script = None
@@ -59,6 +158,7 @@ class SimulationFromJson(Loggable):
             self.PostRunScript:         PostRunScript = locals()['PostRunInstance']
 
         self.Cars = None
+        self.ReplicaCars = None
         self.log('Model parameters loaded.')
 
     def run(self) -> None:
@@ -75,7 +175,10 @@ class SimulationFromJson(Loggable):
 
         # Build model with parameters
         self.log('Building model...')
-        self.model = Model(lbda=self.Lambda, 
+        options = {}
+        if self.Replicas > 1:
+            options['replicas'] = self.Replicas
+        self.model = ENGINES[self.Engine](lbda=self.Lambda, 
                            start_time=0,
                            max_time=self.t_max,
                            collision_threshold=self.L_car,
@@ -84,32 +187,132 @@ class SimulationFromJson(Loggable):
                            cars=self.Cars, 
                            lane_count=self.LaneCount,
                            lane_vmax_weights=self.LaneVelocityWeights,
-                           passing_modifier=self.PassingModifier,)
-        self.log('Model built.')
+                           passing_modifier=self.PassingModifier,
+                           history=self.History if self.OutputTrajectories else 'ring',
+                           seed=SeedSequence(self.Seed, spawn_key=(self.Copy,)),
+                           collision_policy=self.CollisionPolicy,
+                           **options)
+        self.log(f'Model built using the {self.Engine} engine.')
+
+        # Continue from a saved state or start from another run's state, and save the state
+        # periodically while running
+        if self.RestoreCheckpoint != '':
+            self.model.restore_checkpoint(self.RestoreCheckpoint)
+        if self.WarmStart != '':
+            self.model.warm_start(self.WarmStart)
+        if self.CheckpointInterval > 0:
+            self.log(f'Saving checkpoints every {self.CheckpointInterval} steps to {self.CheckpointFile}.')
+            self.make_output_directory()
+            self.model.attach_checkpoints(self.CheckpointFile, self.CheckpointInterval)
+
+        # Stop early once the run reaches a steady state
+        if len(self.ConvergenceMetrics) > 0:
+            self.log(f"Checking {', '.join(self.ConvergenceMetrics)} for convergence every {self.ConvergenceCheckSteps} steps.")
+            self.model.attach_convergence(self.ConvergenceMetrics, self.ConvergenceTolerance, self.ConvergenceWindow, self.ConvergenceCheckSteps)
+
+        # Aggregate statistics while running, instead of from the trajectories afterwards
+        if self.Statistics:
+            window_steps = int(round(self.StatisticsWindow / self.TimeStep)) if self.StatisticsWindow > 0 else 0
+            self.model.attach_statistics(StatisticsCollector(self.Replicas, self.LaneCount, self.L_track, self.TimeStep,
+                stop_speed=self.StopSpeed, impatience_bins=self.ImpatienceBins, window_steps=window_steps, start_time=self.StatisticsStart))
+
+        # Time every phase of the steps
+        if self.Profile:
+            self.Profiler = PhaseProfiler(memory=self.ProfileMemory)
+            self.model.attach_profiler(self.Profiler)
+
+        # Report the simulated time, speed and time left every few steps
+        progress = None
+        if self.ProgressInterval > 0:
+            progress = ProgressReporter(self.Id, self.ProgressInterval, self.ProgressQueue)
+            self.model.attach_progress(progress, self.ProgressInterval)
+
+        # When streaming, or with a limited history, samples are written to the output
+        # file in chunks while the model runs instead of being dumped afterwards
+        sink = None
+        if not self.OutputTrajectories:
+            self.log('Trajectory output is turned off.')
+        elif self.StreamOutput or self.History == 'ring':
+            self.log(f'Streaming samples to {self.OutputFile} during the run...')
+            self.make_output_directory()
+            if self.Replicas > 1:
+                sink = ReplicaSink([open_sink(output_file, self.LaneCount, self.OutputFormat) for output_file in self.OutputFiles])
+            else:
+                sink = open_sink(self.OutputFile, self.LaneCount, self.OutputFormat)
+            sink = StreamingWriter(sink, self.OutputChunkSteps)
+            self.model.attach_sink(sink)
 
         # Evaluate model
         self.log('Evaluating model..')
-        self.model.evaluate()
+        first_step = self.model.step
+        try:
+            if progress is not None:
+                progress.start(first_step, self.model.steps)
+            if self.Profiler is not None:
+                self.Profiler.start()
+            self.model.evaluate()
+            if self.Profiler is not None:
+                self.Profiler.stop(self.model.step - first_step)
+            if progress is not None:
+                progress.evaluated(self.model.step, self.model.start_time + (self.model.step - 1) * self.model.time_step)
+        finally:
+            if sink is not None:
+                sink.close()
         self.log('Run completed.')
+        if self.Profiler is not None:
+            profile = self.Profiler.summary()
+            self.log(f"Ran {profile['Steps']} steps in {profile['WallTime']:.3f}s, {profile['StepsPerSecond']:.1f} steps per second.")
+
+        # Save the final state for other runs to warm start from
+        if self.EndStateFile != '':
+            self.make_output_directory()
+            self.model.save_checkpoint(self.EndStateFile)
 
         self.Collided = self.model.collided
 
+        # Write the collisions of every replica that collided to its collision log
+        for replica, Id in enumerate(self.Ids):
+            count = self.model.collision_log.count(replica)
+            if count > 0:
+                self.make_output_directory()
+                self.CollisionFiles[replica] = f'{self.OutputDirectory}{Id}.collisions.csv'
+                self.model.collision_log.write(replica, self.CollisionFiles[replica])
+                self.log(f'{count} collision(s) written to {self.CollisionFiles[replica]}.')
+        self.ReplicaCars = self.model.replica_cars if self.Replicas > 1 else [self.Cars]
+        if self.Statistics or self.Profile:
+            self.Summaries = [self.model.statistics.summary(replica) if self.Statistics else {} for replica in range(0, self.Replicas)]
+        if self.Profile:
+            # Replicas of an ensemble run in one model, so they share its profile
+            for summary in self.Summaries:
+                summary['Profile'] = profile
+
         # Run post run script
         if self.PostRunScript is not None:
             self.log(f"Running post run script: {self.PostRunScript.Name}")
             self.PostRunScript.run(self)
             self.log(f"{self.PostRunScript.Name} ran successfully")
 
-        # Dump to csv
-        self.log(f'Dumping model to {self.OutputDirectory}{self.Id}.csv...')
-        self.dump_to_csv()
-        self.log('Dump completed.')
+        # Dump to the output file
+        if sink is None and self.OutputTrajectories:
+            self.log(f'Dumping model to {self.OutputFile}...')
+            self.dump_output()
+            self.log('Dump completed.')
+
+        # Write the statistics and profile of every replica to its summary file
+        if self.Statistics or self.Profile:
+            self.make_output_directory()
+            for Id, summary, summary_file in zip(self.Ids, self.Summaries, self.SummaryFiles):
+                with open(summary_file, 'w') as file:
+                    json.dump(dict(summary, Id=str(Id)), file, indent=4)
+            self.log(f'Summary written to {self.SummaryFile}.')
 
         self.log('Simulation run complete.')
+        if progress is not None:
+            progress.finish(self.model.step)
 
-        # Return self so that the TrafficSimulator can generate a manifest
-        return {
-                'Id': self.Id,
+        # Return a manifest row for every replica so that the TrafficSimulator can generate a manifest
+        return [{
+                'Id': Id,
                 'OutputDirectory': self.OutputDirectory,
                 'Lambda': self.Lambda,
                 'Delta': self.Delta,
@@ -122,12 +325,56 @@ class SimulationFromJson(Loggable):
                 'LaneCount': self.LaneCount,
                 'LaneVelocityWeights': self.LaneVelocityWeights,
                 'PassingModifier': self.PassingModifier,
-                'ImpatienceStep': self.ImpatienceStep
-        }
+                'ImpatienceStep': self.ImpatienceStep,
+                'Engine': self.Engine,
+                'History': self.History,
+                'OutputFormat': self.OutputFormat,
+                'Replicas': self.Replicas,
+                'Replica': replica,
+                'SweepValues': self.SweepValues,
+                'Seed': self.Seed,
+                'Copy': self.Copy,
+                'RestoredFrom': self.RestoreCheckpoint,
+                'WarmStart': self.WarmStart,
+                'EndState': self.EndStateFile,
+                'StopReason': self.model.get_stop(replica)[0],
+                'StopTime': self.model.get_stop(replica)[1],
+                'OutputTrajectories': self.OutputTrajectories,
+                'Density': self.Density,
+                'SummaryFile': self.SummaryFiles[replica],
+                'MeanSpeed': self.Summaries[replica]['Total']['MeanSpeed'] if self.Statistics else None,
+                'Flow': self.Summaries[replica]['Total']['Flow'] if self.Statistics else None,
+                'LaneChangeRate': self.Summaries[replica]['Total']['LaneChangeRate'] if self.Statistics else None,
+                'StopEvents': self.Summaries[replica]['Total']['StopEvents'] if self.Statistics else None,
+                'Profile': self.Profile,
+                'WallTime': profile['WallTime'] if self.Profile else None,
+                'StepsPerSecond': profile['StepsPerSecond'] if self.Profile else None,
+                'PeakMemory': profile['PeakMemory'] if self.Profile else None,
+                'CollisionPolicy': self.CollisionPolicy,
+                'CollisionCount': self.model.collision_log.count(replica),
+                'FirstCollisionTime': self.model.collision_log.first_time(replica),
+                'CollisionFile': self.CollisionFiles[replica]
+        } for replica, Id in enumerate(self.Ids)]
 
 
     def dump_to_csv(self) -> None:
-        # Check if the output directory exists
-        if not path.exists(self.OutputDirectory):
-            makedirs(self.OutputDirectory)
-        self.model.dump(f'{self.OutputDirectory}{self.Id}.csv')
+        self.make_output_directory()
+        for replica, Id in enumerate(self.Ids):
+            self.model.dump(f'{self.OutputDirectory}{Id}.csv', replica)
+
+    def dump_output(self) -> None:
+        if self.OutputFormat == 'csv':
+            self.dump_to_csv()
+            return
+        self.make_output_directory()
+        for replica, output_file in enumerate(self.OutputFiles):
+            sink = open_sink(output_file, self.LaneCount, self.OutputFormat)
+            try:
+                self.model.write_history(sink, replica)
+            finally:
+                sink.close()
+
+    def make_output_directory(self) -> None:
+        # Runs of a sweep in other processes may create the directory at the same time
+        if self.OutputDirectory != '':
+            makedirs(self.OutputDirectory, exist_ok=True)
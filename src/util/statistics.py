@@ -0,0 +1,179 @@
+import numpy as np
+from typing import List
+
+from const.param import ERROR_MARGIN
+
+# Quantities summed over every car and step, per replica and lane
+STATISTICS_FIELDS = ['CarSteps', 'SpeedSum', 'SpeedSquares', 'ImpatienceSum', 'ImpatienceSquares', 'LaneChanges', 'StopEvents']
+CAR_STEPS, SPEED_SUM, SPEED_SQUARES, IMPATIENCE_SUM, IMPATIENCE_SQUARES, LANE_CHANGES, STOP_EVENTS = range(0, len(STATISTICS_FIELDS))
+
+# Running aggregates of a run, updated every step so that reported statistics do not need
+# the trajectories of the cars.  Each step adds a handful of sums per replica and lane with
+# a few vectorized passes over the fleet; means, variances and rates are only computed when
+# the summary is built.  Optionally the aggregates of every window of a few seconds are
+# kept as a time series as well.
+class StatisticsCollector:
+    # Params:
+    #   - replicas: number of replicas of the run
+    #   - lane_count: number of lanes
+    #   - track_length: length of the track
+    #   - time_step: time step of the run
+    #   - stop_speed: a car that slows down below this speed counts as a stop and go event
+    #   - impatience_bins: lower edges of the bins of the impatience histogram, the last bin is open ended
+    #   - window_steps: number of steps in a window of the time series, 0 to only keep totals
+    #   - start_time: steps before this time are left out, to skip the transient of the run
+    def __init__(self, replicas: int, lane_count: int, track_length: float, time_step: float,
+            stop_speed: float = 1.0, impatience_bins: List[float] = [0.0, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0], window_steps: int = 0,
+            start_time: float = 0.0) -> None:
+        if len(impatience_bins) == 0 or list(impatience_bins) != sorted(impatience_bins):
+            raise ValueError('The impatience bins must be a non-empty ascending list.')
+        self.lane_count = lane_count
+        self.track_length = track_length
+        self.time_step = time_step
+        self.stop_speed = stop_speed
+        self.impatience_bins = np.array(impatience_bins, dtype=np.float64)
+        self.window_steps = window_steps
+        self.start_time = start_time
+
+        self.steps = np.zeros(replicas, dtype=np.int64)
+        self.sums = np.zeros((replicas, lane_count, len(STATISTICS_FIELDS)), dtype=np.float64)
+        self.histogram = np.zeros((replicas, lane_count, len(impatience_bins)), dtype=np.int64)
+        self.window_sums = np.zeros_like(self.sums)
+        self.window_counts = np.zeros(replicas, dtype=np.int64)
+        self.windows = [[] for _ in range(0, replicas)]
+
+        # Lane and whether each car was stopped at the previous step, one row per replica
+        self.lanes = None
+        self.stopped = None
+
+    # Params:
+    #   - velocities: velocity of every car at the start of the run, one row per replica
+    #   - lanes: lane of every car at the start of the run, one row per replica
+    def start(self, velocities: np.ndarray, lanes: np.ndarray) -> None:
+        self.lanes = lanes.copy()
+        self.stopped = velocities < self.stop_speed
+
+    # Leave cars out of every later step, once they are taken off the track
+    # Params:
+    #   - columns: position of each of the cars in the fixed order of the fleet
+    def remove(self, columns: List[int]) -> None:
+        self.lanes = np.delete(self.lanes, columns, axis=1)
+        self.stopped = np.delete(self.stopped, columns, axis=1)
+
+    # Add a step to the aggregates
+    # Params:
+    #   - replicas: replicas that ran the step
+    #   - t: time of the step
+    #   - velocities: velocity of every car of the replicas, one row per replica, cars in a fixed order
+    #   - lanes: lane of every car of the replicas
+    #   - impatience: impatience of every car of the replicas
+    def update(self, replicas: np.ndarray, t: float, velocities: np.ndarray, lanes: np.ndarray, impatience: np.ndarray) -> None:
+        if t < self.start_time - ERROR_MARGIN:
+            self.lanes[replicas] = lanes
+            self.stopped[replicas] = velocities < self.stop_speed
+            return
+        count, L = len(replicas), self.lane_count
+        offsets = (np.arange(count) * L)[:, np.newaxis]
+        cells = (offsets + lanes).ravel()
+        lane_sum = lambda weights, cells=cells: np.bincount(cells, weights=weights.ravel(), minlength=count * L).reshape(count, L)
+
+        # Lane changes count against the lane the car left, stop and go events against the
+        # lane the car stopped in
+        changed = lanes != self.lanes[replicas]
+        stopped = velocities < self.stop_speed
+        values = np.stack([
+            np.bincount(cells, minlength=count * L).reshape(count, L),
+            lane_sum(velocities),
+            lane_sum(velocities * velocities),
+            lane_sum(impatience),
+            lane_sum(impatience * impatience),
+            lane_sum(changed, (offsets + self.lanes[replicas]).ravel()),
+            lane_sum(stopped & ~self.stopped[replicas])], axis=2)
+        self.sums[replicas] += values
+        self.steps[replicas] += 1
+
+        B = len(self.impatience_bins)
+        bins = np.maximum(np.searchsorted(self.impatience_bins, impatience, side='right') - 1, 0)
+        self.histogram[replicas] += np.bincount((cells * B + bins.ravel()), minlength=count * L * B).reshape(count, L, B)
+
+        self.lanes[replicas] = lanes
+        self.stopped[replicas] = stopped
+
+        if self.window_steps > 0:
+            self.window_sums[replicas] += values
+            self.window_counts[replicas] += 1
+            for replica in replicas[self.window_counts[replicas] == self.window_steps]:
+                self.windows[replica].append({
+                    'Time': t,
+                    'Lanes': [self.__describe__(self.window_sums[replica, lane], self.window_steps) for lane in range(0, L)]
+                })
+                self.window_sums[replica] = 0
+                self.window_counts[replica] = 0
+
+    # Params:
+    #   - replica: replica to summarize
+    # Returns:
+    #   - statistics of the whole run and of each lane, and the time series of windows if kept
+    def summary(self, replica: int = 0) -> dict:
+        steps = int(self.steps[replica])
+        lanes = []
+        for lane in range(0, self.lane_count):
+            lanes.append(dict(self.__describe__(self.sums[replica, lane], steps), Lane=lane, ImpatienceHistogram=self.histogram[replica, lane].tolist()))
+        total = dict(self.__describe__(self.sums[replica].sum(axis=0), steps), ImpatienceHistogram=self.histogram[replica].sum(axis=0).tolist())
+        summary = {
+            'Steps': steps,
+            'Duration': steps * self.time_step,
+            'ImpatienceBins': self.impatience_bins.tolist(),
+            'Total': total,
+            'Lanes': lanes
+        }
+        if self.window_steps > 0:
+            summary['Windows'] = self.windows[replica]
+        return summary
+
+    # Returns:
+    #   - the aggregates collected so far, as saved in a checkpoint
+    def get_state(self) -> dict:
+        return {
+            'steps': self.steps.tolist(),
+            'sums': self.sums.tolist(),
+            'histogram': self.histogram.tolist(),
+            'window_sums': self.window_sums.tolist(),
+            'window_counts': self.window_counts.tolist(),
+            'windows': self.windows,
+            'lanes': self.lanes.tolist(),
+            'stopped': self.stopped.tolist()
+        }
+
+    # Params:
+    #   - state: aggregates, as returned by get_state
+    def set_state(self, state: dict) -> None:
+        self.steps = np.array(state['steps'], dtype=np.int64)
+        self.sums = np.array(state['sums'], dtype=np.float64)
+        self.histogram = np.array(state['histogram'], dtype=np.int64)
+        self.window_sums = np.array(state['window_sums'], dtype=np.float64)
+        self.window_counts = np.array(state['window_counts'], dtype=np.int64)
+        self.windows = state['windows']
+        self.lanes = np.array(state['lanes'], dtype=np.int64)
+        self.stopped = np.array(state['stopped'], dtype=bool)
+
+    # Params:
+    #   - sums: sums of every field, see STATISTICS_FIELDS
+    #   - steps: number of steps summed
+    # Returns:
+    #   - means, variances and rates of the sums
+    def __describe__(self, sums: np.ndarray, steps: int) -> dict:
+        cars, duration = sums[CAR_STEPS], steps * self.time_step
+        mean = lambda total: float(total / cars) if cars > 0 else 0.0
+        variance = lambda total, squares: max(mean(squares) - mean(total) ** 2, 0.0)
+        return {
+            'Density': float(cars / steps / self.track_length) if steps > 0 else 0.0,
+            'Flow': float(sums[SPEED_SUM] / steps / self.track_length) if steps > 0 else 0.0,
+            'MeanSpeed': mean(sums[SPEED_SUM]),
+            'SpeedVariance': variance(sums[SPEED_SUM], sums[SPEED_SQUARES]),
+            'LaneChanges': int(sums[LANE_CHANGES]),
+            'LaneChangeRate': float(sums[LANE_CHANGES] / duration) if duration > 0 else 0.0,
+            'StopEvents': int(sums[STOP_EVENTS]),
+            'MeanImpatience': mean(sums[IMPATIENCE_SUM]),
+            'ImpatienceVariance': variance(sums[IMPATIENCE_SUM], sums[IMPATIENCE_SQUARES])
+        }
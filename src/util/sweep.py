@@ -0,0 +1,109 @@
+import json
+from itertools import product
+from math import exp, floor, log
+from random import Random
+from typing import List
+
+# Random draws an axis of a sweep can be sampled from
+RANDOM_AXES = ['Uniform', 'LogUniform', 'Choice']
+
+# Set of simulations that share a base config and differ in the values of a few parameters.
+# Every point of the sweep holds one value for each of the swept parameters, in the order
+# of names, so that a point can be handed around as a compact tuple.
+class Sweep:
+    # Params:
+    #   - name: name of the sweep, usually the file it was loaded from
+    #   - base: config that every point of the sweep starts from
+    #   - names: names of the swept parameters
+    #   - points: tuple of values of the swept parameters for each point
+    def __init__(self, name: str, base: dict, names: List[str] = [], points: List[tuple] = [()]) -> None:
+        self.name = name
+        self.base = base
+        self.names = list(names)
+        self.points = list(points)
+
+    # Params:
+    #   - point: values of the swept parameters
+    # Returns:
+    #   - dictionary of the swept parameters and their values
+    def overrides(self, point: tuple) -> dict:
+        return dict(zip(self.names, point))
+
+# Load a simulation config as a sweep with a single point
+# Params:
+#   - filename: JSON config file
+def load_config(filename: str) -> Sweep:
+    with open(filename, 'r') as file:
+        return Sweep(filename, json.load(file))
+
+# Load a sweep spec.  A spec holds a base config, either inline or as the path of a
+# config file, and the axes to sweep over:
+#   - a list of values, or {"Range": [start, stop, step]} with the stop included, are
+#     swept as a grid over every combination
+#   - {"Uniform": [low, high]}, {"LogUniform": [low, high]} or {"Choice": [values]} are
+#     drawn at random "Samples" times for every point of the grid, seeded by "Seed"
+# Params:
+#   - filename: JSON sweep file
+def load_sweep(filename: str) -> Sweep:
+    with open(filename, 'r') as file:
+        spec = json.load(file)
+
+    base = spec.get('Base')
+    if base is None:
+        raise ValueError(f'Sweep {filename} does not supply a Base config.')
+    if isinstance(base, str):
+        with open(base, 'r') as file:
+            base = json.load(file)
+
+    axes = spec.get('Axes', {})
+    grid = [name for name, axis in axes.items() if not is_random_axis(axis)]
+    random = [name for name, axis in axes.items() if is_random_axis(axis)]
+    samples = spec.get('Samples', 1) if len(random) > 0 else 1
+    rng = Random(spec.get('Seed'))
+
+    points = []
+    for grid_point in product(*[grid_values(name, axes[name]) for name in grid]):
+        for _ in range(0, samples):
+            points.append(grid_point + tuple(draw(name, axes[name], rng) for name in random))
+    return Sweep(filename, base, grid + random, points)
+
+# Params:
+#   - axis: axis of a sweep spec
+# Returns:
+#   - True if the values of the axis are drawn at random
+def is_random_axis(axis) -> bool:
+    return isinstance(axis, dict) and len(axis) == 1 and next(iter(axis)) in RANDOM_AXES
+
+# Params:
+#   - name: name of the swept parameter
+#   - axis: list of values, or a range
+# Returns:
+#   - list of values of the axis
+def grid_values(name: str, axis) -> list:
+    if isinstance(axis, list):
+        return axis
+    if isinstance(axis, dict) and 'Range' in axis:
+        start, stop, step = axis['Range']
+        if step <= 0:
+            raise ValueError(f'The Range of {name} must have a positive step.')
+        # Round away the floating point error of the steps so values print cleanly
+        count = int(floor((stop - start) / step + 1e-9)) + 1
+        return [round(start + i * step, 12) for i in range(0, count)]
+    raise ValueError(f"Unknown axis for {name}.  Must be a list, Range, or one of: {', '.join(RANDOM_AXES)}.")
+
+# Params:
+#   - name: name of the swept parameter
+#   - axis: random axis
+#   - rng: random number generator of the sweep
+# Returns:
+#   - value drawn from the axis
+def draw(name: str, axis: dict, rng: Random):
+    kind, args = next(iter(axis.items()))
+    if kind == 'Uniform':
+        return rng.uniform(*args)
+    if kind == 'LogUniform':
+        low, high = args
+        if low <= 0 or high <= 0:
+            raise ValueError(f'The LogUniform bounds of {name} must be positive.')
+        return exp(rng.uniform(log(low), log(high)))
+    return rng.choice(args)
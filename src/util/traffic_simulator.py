@@ -1,91 +1,349 @@
 import csv
+import json
+import logging
+import traceback
+from math import ceil
 from typing import List
-from multiprocessing import Pool
+from multiprocessing import Pool, Queue
+from threading import Thread
 
+from const.param import ERROR_MARGIN
 from util.simulation_from_json import SimulationFromJson
-from util.loggable import Loggable
+from util.loggable import LOGGER_NAME, Loggable, configure_worker_logging, flush_logging, start_log_listener
+from util.progress import SweepProgress
+from util.result_cache import ResultCache
+from util.sweep import Sweep, load_config, load_sweep
+
+# Runs simulations for a list of sweeps.  A task only carries the index of its sweep and
+# the values of the swept parameters, the sweeps themselves are handed to each worker once.
+class SimulationWorker(Loggable):
+    # Params:
+    #   - sweeps: list of (name, base config, names of the swept parameters) of each sweep
+    #   - progress_queue: queue the simulations report their progress to, None to log it
+    def __init__(self, sweeps: List[tuple], progress_queue = None) -> None:
+        super().__init__()
+        self.sweeps = sweeps
+        self.progress_queue = progress_queue
+
+    # Execute a single simulation.  A simulation that fails is logged and left out, so that
+    # the rest of the sweep still runs.
+    # Params:
+    #   - task: index of the sweep, the values of the swept parameters, the copy of that point
+    #     and the run id, None for a random one
+    # Returns:
+    #   - manifest row of each replica of the simulation, None if it failed
+    def execute(self, task: tuple) -> List[dict]:
+        index, values, copy, Id = task
+        name, base, names = self.sweeps[index]
+        overrides = dict(zip(names, values))
+        swept = f' with {json.dumps(overrides)}' if len(overrides) > 0 else ''
+        self.log(f'Loading simulation from config {name}{swept}...')
+        try:
+            simulation = SimulationFromJson(base, overrides, Id, copy, self.progress_queue)
+            self.log(f'Simulation loaded.')
+            return simulation.run()
+        except Exception:
+            self.log(f'Simulation from config {name}{swept} failed:\n{traceback.format_exc()}', level=logging.ERROR)
+            return None
+        finally:
+            flush_logging()
+
+# Columns of the manifest, in order
+MANIFEST_COLUMNS = [
+    'Id',
+    'OutputDirectory',
+    'Lambda',
+    'Delta',
+    'V_max',
+    'd_min',
+    'L_car',
+    'L_track',
+    'TimeStep',
+    't_max',
+    'LaneCount',
+    'LaneVelocityWeights',
+    'PassingModifier',
+    'ImpatienceStep',
+    'Engine',
+    'History',
+    'OutputFormat',
+    'Replicas',
+    'Replica',
+    'SweepValues',
+    'Seed',
+    'Copy',
+    'RestoredFrom',
+    'WarmStart',
+    'EndState',
+    'StopReason',
+    'StopTime',
+    'OutputTrajectories',
+    'Density',
+    'SummaryFile',
+    'MeanSpeed',
+    'Flow',
+    'LaneChangeRate',
+    'StopEvents',
+    'Profile',
+    'WallTime',
+    'StepsPerSecond',
+    'PeakMemory',
+    'CollisionPolicy',
+    'CollisionCount',
+    'FirstCollisionTime',
+    'CollisionFile'
+]
+
+# Columns of the fundamental diagram table, in order
+FUNDAMENTAL_DIAGRAM_COLUMNS = ['Density', 'Lane', 'LaneDensity', 'Flow', 'Speed', 'SpeedVariance', 'SweepValues', 'Id']
+
+# Worker of the current pool process, set up once per process by _init_worker
+_worker = None
+
+def _init_worker(sweeps: List[tuple], progress_queue, log_queue, log_level: int) -> None:
+    global _worker
+    configure_worker_logging(log_queue, log_level)
+    _worker = SimulationWorker(sweeps, progress_queue)
+
+def _execute_task(task: tuple) -> List[dict]:
+    return _worker.execute(task)
 
 class TrafficSimulator(Loggable):
+    # Params:
+    #   - simulation_configs: JSON config files, each run as is
+    #   - manifest: manifest file to write
+    #   - simulation_count: number of simulations to run for each config and sweep point
+    #   - process_count: number of processes to run simulations in
+    #   - sweeps: JSON sweep files, see util.sweep.load_sweep
+    #   - cache: skip simulations that already finished with the same parameters and scripts, see util.result_cache
+    #   - fundamental_diagram: table to write the flow and speed of every density and lane to, None to
+    #     run the simulations as configured.  Every run only collects statistics, without trajectories.
+    #   - profile: time every phase of the steps of every simulation, see util.profiler
+    #   - profile_memory: trace the peak memory of every simulation as well
+    #   - progress: number of steps between progress reports of every simulation, 0 to keep the
+    #     ProgressInterval of each config
+    #   - progress_seconds: seconds between views of the progress of the sweep
     def __init__(self, 
             simulation_configs: List[str], 
             manifest: str = 'manifest.csv',
             simulation_count: int = 1,
-            process_count: int = 1) -> None:
+            process_count: int = 1,
+            sweeps: List[str] = [],
+            cache: bool = False,
+            fundamental_diagram: str = None,
+            profile: bool = False,
+            profile_memory: bool = False,
+            progress: int = 0,
+            progress_seconds: float = 10.0) -> None:
         super().__init__()
         self.process_count = process_count
-        self.simulation_configs = [sim_config for sim_config in simulation_configs for _ in range(0, simulation_count)]
+        self.progress_seconds = progress_seconds
+        self.progress_queue = None
         self.manifest = manifest
         self.results = None
+        self.failures = 0
+        self.cache = ResultCache() if cache else None
+        self.fundamental_diagram = fundamental_diagram
+
+        # Configs and sweeps are parsed once here, then expanded into compact tasks holding
+        # the index of the sweep, the values of the swept parameters and the copy of that point
+        self.sweeps: List[Sweep] = [load_config(config) for config in simulation_configs] + [load_sweep(sweep) for sweep in sweeps]
+        self.tasks = [(index, point, copy) for index, sweep in enumerate(self.sweeps) for point in sweep.points for copy in range(0, simulation_count)]
+        self.log(f'Expanded {len(self.sweeps)} config(s) and sweep(s) into {len(self.tasks)} simulation(s).')
+
+        if self.fundamental_diagram is not None:
+            self._configure_fundamental_diagram()
+
+        # Profiling from the command line applies to every simulation, on top of its config
+        if profile or profile_memory:
+            for sweep in self.sweeps:
+                sweep.base = dict(sweep.base, Profile=True)
+                if profile_memory:
+                    sweep.base['ProfileMemory'] = True
+        if progress > 0:
+            for sweep in self.sweeps:
+                sweep.base = dict(sweep.base, ProgressInterval=progress)
 
     # Run simulations
     def run(self) -> None:
         self.results = []
-        if self.process_count > 1:
-            self.log('Running simulations in parallel...')
-            self._execute_multithreaded()
-        else:
-            self.log('Running simulations sequentially...')
-            self._execute_singlethreaded()
+        self.failures = 0
+        self._open_manifest()
+        listener = None
+        try:
+            tasks = self._resume() if self.cache is not None else [(index, point, copy, None) for index, point, copy in self.tasks]
+            listener = self._start_progress(tasks)
+            if self.process_count > 1:
+                self.log('Running simulations in parallel...')
+                self._execute_multithreaded(tasks)
+            else:
+                self.log('Running simulations sequentially...')
+                self._execute_singlethreaded(tasks)
+        finally:
+            self.manifest_file.close()
+            if listener is not None:
+                self.progress_queue.put(None)
+                listener.join()
+                self.progress_queue = None
 
         self.log('Simulations complete.')
-
-        self.log('Generating manifest...')
-        self._generate_manifest()
         self.log(f'Manifest saved to {self.manifest}')
+
+        if self.fundamental_diagram is not None:
+            self._write_fundamental_diagram()
+
+        if self.failures > 0:
+            raise RuntimeError(f'{self.failures} simulation(s) failed, see the log.  The manifest lists the ones that finished.')
+
+    # Collect the progress reports of the simulations in a background thread, if any of them
+    # reports progress
+    # Params:
+    #   - tasks: tasks of the simulations to run
+    # Returns:
+    #   - the thread collecting the reports, None if no simulation reports progress
+    def _start_progress(self, tasks: List[tuple]) -> Thread:
+        configs = [self._resolve(task[0], task[1]) for task in tasks]
+        if not any(config.get('ProgressInterval', 0) > 0 for config in configs):
+            return None
+        # Steps of every run from the start, as the model counts them.  Runs that are restored
+        # or stop early correct the total as they report.
+        total_steps = sum(max(int(ceil(config.get('t_max', 1000.0) / config.get('TimeStep', 0.05) - ERROR_MARGIN)), 0) for config in configs)
+        self.progress_queue = Queue()
+        progress = SweepProgress(self.progress_queue, len(tasks), total_steps, self.progress_seconds)
+        listener = Thread(target=progress.listen, daemon=True)
+        listener.start()
+        return listener
+
+    # Switch every sweep to aggregates only output, the cars of each run are generated from
+    # its density unless the config supplies a pre-run script
+    def _configure_fundamental_diagram(self) -> None:
+        for sweep in self.sweeps:
+            sweep.base = dict(sweep.base, Statistics=True, OutputTrajectories=False)
+        for index, point, _ in self.tasks:
+            if self._resolve(index, point).get('Density') is None:
+                raise ValueError(f'Every simulation of a fundamental diagram needs a Density, {self.sweeps[index].name} does not supply one.')
+
+    # Write the fundamental diagram table, one row for each lane of every run and one for the
+    # whole track, read from the statistics summaries of the runs
+    def _write_fundamental_diagram(self) -> None:
+        table = []
+        for sim_data in self.results:
+            with open(sim_data['SummaryFile'], 'r') as file:
+                summary = json.load(file)
+            for lane in summary['Lanes'] + [dict(summary['Total'], Lane='All')]:
+                table.append({
+                    'Density': sim_data['Density'],
+                    'Lane': lane['Lane'],
+                    'LaneDensity': lane['Density'],
+                    'Flow': lane['Flow'],
+                    'Speed': lane['MeanSpeed'],
+                    'SpeedVariance': lane['SpeedVariance'],
+                    'SweepValues': json.dumps(sim_data['SweepValues']),
+                    'Id': sim_data['Id']
+                })
+        table = sorted(table, key=lambda row: (row['Density'], row['Lane'] == 'All', row['Lane'] if row['Lane'] != 'All' else 0))
+
+        with open(self.fundamental_diagram, 'w', newline='') as file:
+            writer = csv.DictWriter(file, fieldnames=FUNDAMENTAL_DIAGRAM_COLUMNS)
+            writer.writeheader()
+            writer.writerows(table)
+        self.log(f'Fundamental diagram of {len(self.results)} run(s) saved to {self.fundamental_diagram}')
     
+    # Give every simulation its run id from the cache, and record the ones that already finished.
+    # Simulations without a seed get a new random seed, and id, every time they run.
+    # Returns:
+    #   - tasks of the simulations that still have to run
+    def _resume(self) -> List[tuple]:
+        tasks = []
+        for index, point, copy in self.tasks:
+            config = self._resolve(index, point)
+            if config.get('Seed') is None:
+                tasks.append((index, point, copy, None))
+                continue
+            Id = self.cache.run_id(config, copy)
+            rows = self.cache.load(config, Id)
+            if rows is None:
+                tasks.append((index, point, copy, Id))
+            else:
+                self._record(rows, cached=True)
+        self.log(f'Found {len(self.tasks) - len(tasks)} finished simulation(s) in the cache, {len(tasks)} left to run.')
+        return tasks
+
     # Execute simulations sequentially
-    def _execute_singlethreaded(self) -> None:
-        for sim_config in self.simulation_configs:
-            self.results.append(self._execute_simulation(sim_config))
-
-    # Execute simulations in parallel
-    def _execute_multithreaded(self) -> None:
-        with Pool(processes=self.process_count) as pool:
-            self.results = pool.map(self._execute_simulation, self.simulation_configs)
-
-    # Execute a single simulation
-    def _execute_simulation(self, simulation_json) -> None:
-        self.log(f'Loading simulation from config {simulation_json}...')
-        simulation = SimulationFromJson(simulation_json)
-        self.log(f'Simulation loaded.')
-
-        return simulation.run()
-
-    def _generate_manifest(self) -> None:
-        if self.results is None:
-            raise RuntimeError('No results to generate manifest from.')
-            return
+    # Params:
+    #   - tasks: tasks of the simulations to run
+    def _execute_singlethreaded(self, tasks: List[tuple]) -> None:
+        worker = SimulationWorker(self._worker_sweeps(), self.progress_queue)
+        for task in tasks:
+            self._record(worker.execute(task))
 
-        with open(self.manifest, 'w', newline='') as file:
-            writer = csv.writer(file)
-            writer.writerow([
-                'Id',
-                'OutputDirectory',
-                'Lambda',
-                'Delta',
-                'V_max',
-                'd_min',
-                'L_car',
-                'L_track',
-                'TimeStep',
-                't_max',
-                'LaneCount',
-                'LaneVelocityWeights',
-                'PassingModifier',
-                'ImpatienceStep'])
-            for sim_data in self.results:
-                writer.writerow([
-                    sim_data['Id'],
-                    sim_data['OutputDirectory'], 
-                    sim_data['Lambda'],  
-                    sim_data['Delta'],   
-                    sim_data['V_max'],   
-                    sim_data['d_min'],   
-                    sim_data['L_car'],   
-                    sim_data['L_track'], 
-                    sim_data['TimeStep'],
-                    sim_data['t_max'],   
-                    sim_data['LaneCount'],   
-                    sim_data['LaneVelocityWeights'], 
-                    sim_data['PassingModifier'], 
-                    sim_data['ImpatienceStep']])
\ No newline at end of file
+    # Execute simulations in parallel.  Tasks are handed out one at a time, longest first,
+    # so that no core is left waiting on a long run at the end, and each result is recorded
+    # as soon as its run finishes.  Workers send their log records in batches over a queue,
+    # and this process writes them all, so the log of each record stays in one piece.
+    # Params:
+    #   - tasks: tasks of the simulations to run
+    def _execute_multithreaded(self, tasks: List[tuple]) -> None:
+        tasks = sorted(tasks, key=self._estimate_cost, reverse=True)
+        log_queue = Queue()
+        listener = start_log_listener(log_queue)
+        try:
+            initargs = (self._worker_sweeps(), self.progress_queue, log_queue, logging.getLogger(LOGGER_NAME).level)
+            with Pool(processes=self.process_count, initializer=_init_worker, initargs=initargs) as pool:
+                for rows in pool.imap_unordered(_execute_task, tasks, chunksize=1):
+                    self._record(rows)
+        finally:
+            listener.stop()
+
+    # Returns:
+    #   - what a worker needs to know about each sweep, without the points
+    def _worker_sweeps(self) -> List[tuple]:
+        return [(sweep.name, sweep.base, sweep.names) for sweep in self.sweeps]
+
+    # Estimate the relative cost of a simulation as cars x steps x lanes x replicas.  The cars
+    # are built by the pre-run script, so their number is only known if the config supplies
+    # a Density or a NumCars parameter for the script, and is otherwise assumed equal for every run.
+    # Params:
+    #   - task: task of the simulation
+    # Returns:
+    #   - estimated cost of the simulation
+    def _estimate_cost(self, task: tuple) -> float:
+        config = self._resolve(task[0], task[1])
+        steps = config.get('t_max', 1000.0) / config.get('TimeStep', 0.05)
+        if config.get('Density') is not None and config.get('PreRunScript', '') == '':
+            return config['Density'] * config.get('L_track', 1.0) * config.get('LaneCount', 1) ** 2 * steps * config.get('Replicas', 1)
+        return config.get('NumCars', 1) * steps * config.get('LaneCount', 1) * config.get('Replicas', 1)
+
+    # Params:
+    #   - index: index of the sweep
+    #   - point: values of the swept parameters
+    # Returns:
+    #   - config of the simulation with the swept values applied
+    def _resolve(self, index: int, point: tuple) -> dict:
+        sweep = self.sweeps[index]
+        config = dict(sweep.base)
+        config.update(sweep.overrides(point))
+        return config
+
+    # Create the manifest with only its header, rows are appended as simulations finish
+    # so the manifest always lists every finished run
+    def _open_manifest(self) -> None:
+        self.manifest_file = open(self.manifest, 'w', newline='')
+        self.manifest_writer = csv.DictWriter(self.manifest_file, fieldnames=MANIFEST_COLUMNS, extrasaction='ignore')
+        self.manifest_writer.writeheader()
+        self.manifest_file.flush()
+
+    # Append the manifest rows of a finished simulation, and add it to the cache
+    # Params:
+    #   - rows: manifest row of each replica of the simulation, None if it failed
+    #   - cached: whether the rows were loaded from the cache
+    def _record(self, rows: List[dict], cached: bool = False) -> None:
+        if rows is None:
+            self.failures += 1
+            return
+        if self.cache is not None and not cached:
+            self.cache.store(rows)
+        for sim_data in rows:
+            self.results.append(sim_data)
+            self.manifest_writer.writerow(dict(sim_data, SweepValues=json.dumps(sim_data['SweepValues'])))
+        self.manifest_file.flush()
@@ -0,0 +1,673 @@
+import csv
+import logging
+import numpy as np
+from copy import copy
+from typing import List
+
+from const.param import *
+from models.history import History
+from util.collisions import CollisionLog
+from util.model import Model
+from util.output_sink import output_columns
+
+# Alternative engine for Model that keeps the whole fleet in contiguous numpy arrays.
+# Every phase of a time step (lane, headway, velocity, position) is computed for all
+# cars at once instead of looping over Car objects.  Given the same seed it
+# reproduces the loop engine to within floating point rounding (see README).
+#
+# The engine can also run an ensemble of independent replicas of the same cars.  Every
+# per car array then holds replicas * num_cars entries, with the cars of replica r at
+# r * num_cars + their position in the initial car list, and each replica has its own
+# ordering, random stream and collision state.
+class VectorizedModel(Model):
+    # Parameters:
+    #   - replicas: number of independent replicas of the cars to run together
+    def __init__(self, *args, replicas: int = 1, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        if len(self.lights) > 0 or len(self.influencers) > 0:
+            raise ValueError('The vectorized engine does not support traffic lights or influencers.')
+        for c in self.cars:
+            if len(c.pos) != 1:
+                raise ValueError(f'Car #{c.id} must only contain its initial state to be used by the vectorized engine.')
+        if replicas < 1:
+            raise ValueError('The number of replicas must be at least 1.')
+        if self.collision_policy == 'remove':
+            raise ValueError('The vectorized engine does not support removing cars that collided.')
+
+        n = self.num_cars
+        self.replicas = replicas
+        size = replicas * n
+
+        # In ring mode only the rows still read by the dynamics are kept and rows are
+        # reused modulo the depth, otherwise there is one row for every step of the run
+        self.depth = self.max_history_depth() if self.history == 'ring' else self.steps + 1
+
+        # Per car parameters, indexed by replica * num_cars + the car's position in the initial car list
+        tile = lambda values, dtype: np.tile(np.array(values, dtype=dtype), replicas)
+        self.ids = tile([c.id for c in self.cars], np.int64)
+        self.replica_of = np.repeat(np.arange(replicas), n)
+        self.reaction_times = tile([c.reaction_time for c in self.cars], np.float64)
+        self.reaction_steps = tile([c.reaction_steps for c in self.cars], np.int64)
+        self.headway_thresholds = tile([c.headway_threshold for c in self.cars], np.float64)
+        self.max_velocities = tile([c.max_v for c in self.cars], np.float64)
+        self.lbdas = tile([c.lbda for c in self.cars], np.float64)
+        self.impatience_steps = tile([c.impatience_step for c in self.cars], np.float64)
+        self.fixed_velocities = tile([np.nan if c.fixed_velocity is None else c.fixed_velocity for c in self.cars], np.float64)
+        self.weights = np.array(self.lane_vmax_weights, dtype=np.float64)
+
+        # History of every car, one row per time step, every replica starts from the same state
+        self.allocate_history()
+        self.time_history[0] = tile([c.time[0] for c in self.cars], np.float64)
+        self.pos_history[0] = tile([c.pos[0] for c in self.cars], np.float64)
+        self.velocity_history[0] = tile([c.velocity[0] for c in self.cars], np.float64)
+        self.impatience_history[0] = tile([c.impatience[0] for c in self.cars], np.float64)
+        self.lane_history[0] = tile([c.lanes[0] for c in self.cars], np.int64)
+        for lane in range(0, self.lane_count):
+            self.headway_history[0, lane] = tile([c.headway[lane][0] for c in self.cars], np.float64)
+
+        # Indices of the cars of each replica sorted by position, front to back
+        self.order = np.arange(size).reshape(replicas, n)
+        self.output_order = self.order.copy()
+        self.delayed_orders = {}
+
+        # Replicas stop independently when their cars collide, and keep their own results
+        self.replica_running = np.ones(replicas, dtype=bool)
+        self.replica_collided = np.zeros(replicas, dtype=bool)
+        self.replica_collided_ids = [[] for _ in range(0, replicas)]
+        self.replica_end_times = np.full(replicas, self.end_time)
+        self.replica_stop_reasons = ['t_max' for _ in range(0, replicas)]
+        self.replica_stop_times = np.full(replicas, np.nan)
+        self.replica_lane_changes = [[] for _ in range(0, replicas)]
+        self.collision_log = CollisionLog(replicas)
+        self.step_collisions = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+        self.lane_changes = self.replica_lane_changes[0]
+        self.replica_cars = [self.cars]
+        self.rows = np.ones(replicas, dtype=np.int64)
+
+        # Distance between the positions of consecutive replicas when the positions of every
+        # replica are searched as one sorted array, larger than any lane change window
+        self.replica_span = 3 * self.track_length + 2 * max(self.headway_thresholds, default=0)
+
+        # Each replica draws from an independent random stream, the first one is the stream of
+        # the loop engine, so both engines agree given the same seed
+        self.streams = [self.random_stream(replica) for replica in range(0, replicas)]
+
+    # Allocate depth rows of history for every car of every replica
+    def allocate_history(self) -> None:
+        rows, size = self.depth, self.replicas * self.num_cars
+        self.time_history = np.zeros((rows, size), dtype=np.float64)
+        self.pos_history = np.zeros((rows, size), dtype=np.float64)
+        self.velocity_history = np.zeros((rows, size), dtype=np.float64)
+        self.impatience_history = np.zeros((rows, size), dtype=np.float64)
+        self.lane_history = np.zeros((rows, size), dtype=np.int64)
+        self.headway_history = np.zeros((rows, self.lane_count, size), dtype=np.float64)
+
+    # Run simulation, continuing from the current step
+    def evaluate(self) -> None:
+        for step in range(self.step, self.steps):
+
+            # Stop if we indicate the model should no longer be running
+            if not self.running:
+                break
+
+            # The dynamics run on history rows, real time is only computed for output
+            k = self.tick
+            t = self.start_time + step * self.time_step
+
+            # Current and next row of the history
+            row, next_row = k % self.depth, (k + 1) % self.depth
+            if self.profiler is not None:
+                self.profiler.mark()
+
+            # Order cars based on position
+            self.update_order(k, row)
+            self.lap('order')
+
+            # History rows each car perceives the others at, before the start of the run
+            # every car perceives the initial state
+            delayed = np.maximum(k - self.reaction_steps, 0) % self.depth
+            delayed_prev = np.maximum(k - self.reaction_steps - 1, 0) % self.depth
+
+            # Replicas that collide during this step still finish it
+            running = np.nonzero(self.replica_running)[0]
+
+            self.get_lane(t, row, next_row, delayed, delayed_prev)
+            self.lap('lane')
+            self.get_headway(t, row, next_row)
+            self.lap('headway')
+            self.get_velocity(t, next_row, delayed)
+            self.lap('velocity')
+            self.get_position(t, row, next_row)
+            if self.collision_policy == 'clamp':
+                self.clamp_collisions(row, next_row)
+            self.lap('position')
+            self.save_time(t, next_row)
+            self.rows[running] = k + 2
+            self.replica_stop_times[running] = t
+            self.output_order[running] = self.order[running]
+
+            # Hand the finished time step to the output sink, an ensemble hands over the
+            # samples of each replica that was running
+            if self.sink is not None:
+                if self.replicas == 1:
+                    self.sink.write(self.get_step_output())
+                else:
+                    self.sink.write({int(r): self.get_step_output(r) for r in running})
+            self.lap('output')
+
+            self.running = self.running and bool(self.replica_running.any())
+            self.step, self.tick = step + 1, k + 1
+            if self.statistics is not None:
+                self.statistics.update(running, t, *(values[running] for values in self.get_fleet_state()))
+            self.check_convergence(t)
+            self.save_periodic_checkpoint()
+            self.report_progress(t)
+            self.lap('monitoring')
+
+        self.save_to_cars()
+
+    # Sample the metrics of the running replicas and stop the ones that converged, if a check
+    # is due after the step that just finished
+    # Parameters:
+    #   - t: time of the step that just finished
+    def check_convergence(self, t: float) -> None:
+        if self.monitor is None or not self.running or self.step % self.convergence_steps != 0:
+            return
+        running = np.nonzero(self.replica_running)[0]
+        velocities, lanes, _ = self.get_fleet_state()
+        for replica in running[self.monitor.update(running.tolist(), self.monitor.measure(velocities[running], lanes[running]))]:
+            prefix = f'Replica {replica}: ' if self.replicas > 1 else ''
+            self.log(f'{prefix}Converged to a steady state at time t={t}.')
+            self.replica_running[replica] = False
+            self.replica_stop_reasons[replica] = 'converged'
+        self.running = bool(self.replica_running.any())
+
+    # Returns:
+    #   - current velocity, lane and impatience of every car, one row per replica
+    def get_fleet_state(self) -> tuple:
+        row, shape = self.tick % self.depth, (self.replicas, self.num_cars)
+        return (
+            self.velocity_history[row].reshape(shape),
+            self.lane_history[row].reshape(shape),
+            self.impatience_history[row].reshape(shape))
+
+    # Parameters:
+    #   - replica: replica to get the stop of
+    # Returns:
+    #   - why the replica stopped and the time of its last step
+    def get_stop(self, replica: int = 0) -> tuple:
+        stop_time = self.replica_stop_times[replica]
+        return self.replica_stop_reasons[replica], None if np.isnan(stop_time) else float(stop_time)
+
+    # Returns:
+    #   - the scalar state and the array state of the model, laid out like the loop engine's
+    #     with a leading replica axis on the orderings
+    def get_state(self) -> tuple:
+        window = min(self.tick + 1, self.max_history_depth())
+        rows = np.arange(self.tick + 1 - window, self.tick + 1) % self.depth
+        delayed = sorted(self.delayed_orders.items())
+        arrays = {
+            'ids': self.ids[:self.num_cars],
+            'time': self.time_history[rows],
+            'pos': self.pos_history[rows],
+            'velocity': self.velocity_history[rows],
+            'impatience': self.impatience_history[rows],
+            'lanes': self.lane_history[rows],
+            'headway': self.headway_history[rows],
+            'fixed_velocities': self.fixed_velocities,
+            'order': self.order,
+            'output_order': self.output_order,
+            'delayed_orders': np.array([order for _, order in delayed], dtype=np.int64).reshape(len(delayed), self.replicas, self.num_cars)
+        }
+        meta = dict(self.common_state(window),
+            streams=[stream.bit_generator.state for stream in self.streams],
+            lane_changes=self.replica_lane_changes,
+            delayed=[[float(r_t), None] for r_t, _ in delayed],
+            replica_running=self.replica_running.tolist(),
+            replica_collided=self.replica_collided.tolist(),
+            replica_collided_ids=self.replica_collided_ids,
+            replica_end_times=self.replica_end_times.tolist(),
+            replica_stop_reasons=self.replica_stop_reasons,
+            replica_stop_times=self.replica_stop_times.tolist(),
+            # Rows written by each replica relative to the current history index, replicas
+            # that stopped wrote fewer
+            rows=(self.rows - self.tick - 1).tolist(),
+            lights=[],
+            influencers=[])
+        return meta, arrays
+
+    # Replace the history of every car with a saved window, which starts the history over at
+    # row 0.  A window saved from a single replica is copied to every replica.
+    # Parameters:
+    #   - arrays: array state holding the window, as returned by get_state
+    #   - window: number of steps in the window
+    #   - steps: number of steps left to run
+    #   - offset: step of the run at the first step of the window
+    def set_history(self, arrays: dict, window: int, steps: int, offset: int) -> None:
+        if self.history == 'full':
+            self.depth = window + steps
+            self.allocate_history()
+        copies = self.replicas * self.num_cars // max(arrays['pos'].shape[-1], 1)
+
+        # A ring shallower than the window only keeps its most recent steps
+        keep = min(window, self.depth)
+        rows = np.arange(window - keep, window) % self.depth
+        for name, history in (('time', self.time_history), ('pos', self.pos_history), ('velocity', self.velocity_history),
+                ('impatience', self.impatience_history), ('lanes', self.lane_history), ('headway', self.headway_history)):
+            values = arrays[name][window - keep:]
+            history[rows] = np.tile(values, (1,) * (values.ndim - 1) + (copies,))
+        self.tick = self.first_step = window - 1
+        self.history_offset = offset
+
+    # Order the cars of each replica from scratch by their current position
+    def reset_order(self) -> None:
+        n = self.num_cars
+        pos = self.pos_history[self.tick % self.depth].reshape(self.replicas, n)
+        self.order = np.argsort(-pos, axis=1, kind='stable') + (np.arange(self.replicas) * n)[:, np.newaxis]
+        self.output_order = self.order.copy()
+        self.delayed_orders = {}
+        self.rows[:] = self.tick + 1
+
+    # Parameters:
+    #   - meta: scalar state, as returned by get_state
+    #   - arrays: array state, as returned by get_state
+    def set_state(self, meta: dict, arrays: dict) -> None:
+        self.set_history(arrays, meta['window'], self.steps - meta['step'], meta['history_offset'])
+        self.step = meta['step']
+        self.fixed_velocities = arrays['fixed_velocities']
+
+        self.order = arrays['order']
+        self.output_order = arrays['output_order']
+        self.delayed_orders = {r_t: order for (r_t, _), order in zip(meta['delayed'], arrays['delayed_orders'])}
+
+        for stream, state in zip(self.streams, meta['streams']):
+            stream.bit_generator.state = state
+        self.replica_lane_changes = meta['lane_changes']
+        self.lane_changes = self.replica_lane_changes[0]
+        self.replica_running = np.array(meta['replica_running'], dtype=bool)
+        self.replica_collided = np.array(meta['replica_collided'], dtype=bool)
+        self.replica_collided_ids = meta['replica_collided_ids']
+        self.replica_end_times = np.array(meta['replica_end_times'], dtype=np.float64)
+        self.replica_stop_reasons = meta['replica_stop_reasons']
+        self.replica_stop_times = np.array(meta['replica_stop_times'], dtype=np.float64)
+        self.rows = np.maximum(self.tick + 1 + np.array(meta['rows'], dtype=np.int64), 1)
+        self.set_common_state(meta)
+
+    # Repair the ordering of the cars of each replica the same way as CarOrder: cars at the front
+    # that wrapped around the end of the track are rotated to the back, then the order is stably
+    # sorted.  The stable sort is adaptive, so it is close to linear on the nearly sorted order.
+    # Parameters:
+    #   - k: current step
+    #   - row: history row of the current step
+    def update_order(self, k: int, row: int) -> None:
+        n = self.num_cars
+        pos = self.pos_history[row][self.order]
+        if k > 0:
+            wrapped = pos < self.pos_history[(k - 1) % self.depth][self.order]
+            count = np.where(wrapped.all(axis=1), 0, np.argmin(wrapped, axis=1))
+            if np.any(count > 0):
+                columns = (np.arange(n) + count[:, np.newaxis]) % n
+                self.order = np.take_along_axis(self.order, columns, axis=1)
+                pos = np.take_along_axis(pos, columns, axis=1)
+        if np.any(pos[:, 1:] > pos[:, :-1]):
+            self.order = np.take_along_axis(self.order, np.argsort(-pos, axis=1, kind='stable'), axis=1)
+
+    # Parameters:
+    #   - t: current time
+    #   - next_row: history row of the next step
+    def save_time(self, t: float, next_row: int) -> None:
+        self.time_history[next_row] = t
+
+    # Parameters:
+    #   - replica: replica to get the samples of
+    # Returns:
+    #   - one list per output column, holding the latest sample of each car in sorted order
+    def get_step_output(self, replica: int = 0) -> List[list]:
+        row, order = (self.rows[replica] - 1) % self.depth, self.output_order[replica]
+        columns = [
+            self.ids[order].tolist(),
+            self.time_history[row, order].tolist(),
+            self.pos_history[row, order].tolist(),
+            self.velocity_history[row, order].tolist(),
+            self.impatience_history[row, order].tolist(),
+            self.lane_history[row, order].tolist()]
+        for lane in range(0, self.lane_count):
+            columns.append(self.headway_history[row, lane, order].tolist())
+        return columns
+
+    # Parameters:
+    #   - delayed: history row each car perceives the others at
+    #   - delayed_prev: history row one step before delayed
+    # Returns:
+    #   - number of cars in an adjacent lane that passed each car
+    def get_passing_counts(self, delayed: np.ndarray, delayed_prev: np.ndarray) -> np.ndarray:
+        size = self.replicas * self.num_cars
+        counts = np.zeros(size, dtype=np.int64)
+
+        # Cars sharing a reaction time perceive the same snapshots
+        for r_t in np.unique(self.reaction_times):
+            members = np.nonzero(self.reaction_times == r_t)[0]
+            d, p = delayed[members[0]], delayed_prev[members[0]]
+            lanes = self.lane_history[d]
+            prev_pos, pos = self.pos_history[p], self.pos_history[d]
+
+            # Unwrap cars that crossed the end of the track
+            pos = np.where(pos < prev_pos, pos + self.track_length, pos)
+
+            # Order each replica by the earlier snapshot, starting from the last step's order so
+            # the adaptive stable sort only has to fix the cars that moved
+            order = self.delayed_orders.get(r_t, self.order)
+            order = np.take_along_axis(order, np.argsort(-prev_pos[order], axis=1, kind='stable'), axis=1)
+            prev_sorted, cur_sorted, lanes_sorted = prev_pos[order], pos[order], lanes[order]
+
+            # A car that is ahead of one of the cars before it in the order passed it.  Since
+            # cars only move forward, the cars it passed started between its earlier and later
+            # positions, right before it in the order.
+            first = np.full((self.replicas, 1), np.inf)
+            before = np.minimum.accumulate(np.concatenate((first, cur_sorted[:, :-1]), axis=1), axis=1)
+            group_counts = np.zeros(size, dtype=np.int64)
+            for r, b in zip(*np.nonzero(before < cur_sorted)):
+                start = np.searchsorted(-prev_sorted[r], -cur_sorted[r, b], side='right')
+                passed = np.arange(start, b)
+                passed = passed[(cur_sorted[r, passed] < cur_sorted[r, b]) & (prev_sorted[r, passed] > prev_sorted[r, b]) & (np.abs(lanes_sorted[r, passed] - lanes_sorted[r, b]) == 1)]
+                group_counts[order[r, passed]] += 1
+
+            # Only consider constant lanes
+            group_counts[lanes != self.lane_history[p]] = 0
+            counts[members] = group_counts[members]
+
+            # Keep the order sorted by the later snapshot for the lane change check and the next step
+            raw = self.pos_history[d]
+            self.delayed_orders[r_t] = np.take_along_axis(order, np.argsort(-raw[order], axis=1, kind='stable'), axis=1)
+        return counts
+
+    # Find the lanes next to each car that are blocked for a lane change.  A lane is blocked if a
+    # car is within the headway threshold of where the driver perceives itself, using the
+    # positions and lanes every car had at the same delayed snapshot.  Positions per lane are
+    # searched with a binary search, so this is O(log N) per car regardless of the reaction time.
+    # Parameters:
+    #   - delayed: history row each car perceives the others at
+    #   - cur_lane: current lane of each car
+    # Returns:
+    #   - whether the left lane and whether the right lane of each car is blocked
+    def get_blocked_lanes(self, delayed: np.ndarray, cur_lane: np.ndarray) -> tuple:
+        size = self.replicas * self.num_cars
+        blocked_left = np.zeros(size, dtype=bool)
+        blocked_right = np.zeros(size, dtype=bool)
+
+        for r_t in np.unique(self.reaction_times):
+            members = np.nonzero(self.reaction_times == r_t)[0]
+            d = delayed[members[0]]
+            lanes = self.lane_history[d]
+
+            # Positions ascending within each replica, with the replicas offset one after the
+            # other so that a single sorted array covers all of them
+            pos = self.pos_history[d] + self.replica_of * self.replica_span
+            order = self.delayed_orders[r_t][:, ::-1].ravel()
+            own_pos, own_lane = pos[members], lanes[members]
+            distance = self.headway_thresholds[members]
+
+            for target, blocked in ((cur_lane[members] - 1, blocked_left), (cur_lane[members] + 1, blocked_right)):
+                occupied = np.zeros(len(members), dtype=np.int64)
+                for lane in range(0, self.lane_count):
+                    in_lane = target == lane
+                    if not np.any(in_lane):
+                        continue
+                    positions = pos[order[lanes[order] == lane]]
+
+                    # Search the window shifted by a track length either way to handle wrapping
+                    for shift in (-self.track_length, 0, self.track_length):
+                        low = np.searchsorted(positions, own_pos[in_lane] - distance[in_lane] + shift, side='left')
+                        high = np.searchsorted(positions, own_pos[in_lane] + distance[in_lane] + shift, side='left')
+                        occupied[in_lane] += high - low
+
+                # The car itself does not block the lane it is in
+                occupied -= own_lane == target
+                blocked[members] = occupied > 0
+        return blocked_left, blocked_right
+
+    # Parameters:
+    #   - t: current time
+    #   - row: history row of the current step
+    #   - next_row: history row of the next step
+    #   - delayed: history row each car perceives the others at
+    #   - delayed_prev: history row one step before delayed
+    def get_lane(self, t: float, row: int, next_row: int, delayed: np.ndarray, delayed_prev: np.ndarray) -> None:
+        # Impatience from being passed, counted for every car at once
+        passing = self.get_passing_counts(delayed, delayed_prev) * self.passing_modifier if self.lane_count > 1 else None
+        self.lap('passing')
+
+        n = self.num_cars
+        size = self.replicas * n
+        cars = np.arange(size)
+        cur_lane = self.lane_history[row]
+        impatience = self.impatience_history[row].copy()
+
+        # Headway in the current lane and the lanes to the left and right, 0 outside of the track
+        perceived = self.headway_history[delayed, :, cars]
+        headway = perceived[cars, cur_lane]
+        left_headway = np.where(cur_lane > 0, perceived[cars, np.maximum(cur_lane - 1, 0)], 0.0)
+        right_headway = np.where(cur_lane < self.lane_count - 1, perceived[cars, np.minimum(cur_lane + 1, self.lane_count - 1)], 0.0)
+
+        if self.lane_count > 1:
+            # Drivers grow impatient if an adjacent lane has more headway, otherwise they calm down
+            impatient = (left_headway > headway) | (right_headway > headway)
+            impatience = np.where(impatient, impatience + self.impatience_steps,
+                np.where(impatience > 0, impatience - self.impatience_steps, impatience))
+
+            # Factor in passing cars to impatience
+            impatience = impatience + passing
+
+        # Lane change safety
+        order = self.order
+        can_go_left = cur_lane > 0
+        can_go_right = cur_lane < self.lane_count - 1
+        if self.lane_count > 1:
+            blocked_left, blocked_right = self.get_blocked_lanes(delayed, cur_lane)
+            can_go_left &= ~blocked_left
+            can_go_right &= ~blocked_right
+
+        # One draw per car of each replica, indexed like the loop engine
+        probability = 1 - (1 - ((2 / PI) * np.arctan(self.impatience_history[row]))) ** self.time_step
+        probability = np.where(probability < 0, 0, probability)
+        draws = np.concatenate([stream.random(n) for stream in self.streams])
+
+        change = draws <= probability
+        go_left = change & can_go_left & (left_headway >= right_headway)
+        go_right = change & ~go_left & can_go_right
+        new_lane = cur_lane - go_left + go_right
+        impatience[go_left | go_right] = 0
+
+        changed = (go_left | go_right) & self.replica_running[self.replica_of]
+        for i in order.ravel()[changed[order.ravel()]]:
+            self.replica_lane_changes[self.replica_of[i]].append({
+                'car_id': int(self.ids[i]),
+                'current_lane': int(cur_lane[i]),
+                'target_lane': int(new_lane[i]),
+                'time': t
+            })
+
+        self.impatience_history[next_row] = impatience
+        self.lane_history[next_row] = new_lane
+
+    # Parameters:
+    #   - t: current time
+    #   - row: history row of the current step
+    #   - next_row: history row of the next step
+    def get_headway(self, t: float, row: int, next_row: int) -> None:
+        n = self.num_cars
+        order = self.order.ravel()
+        ranks = np.arange(len(order))
+        replica = self.replica_of
+        running = self.replica_running[replica]
+        lanes = self.lane_history[row, order]
+        pos = self.pos_history[row, order]
+        collisions = []
+
+        for lane in range(0, self.lane_count):
+            headways = np.full(len(order), INF, dtype=np.float64)
+            lane_ranks = np.nonzero(lanes == lane)[0]
+            if len(lane_ranks) > 0:
+                # Nearest car ahead in this lane and replica, wrapping around to the back of the
+                # replica's order.  A car alone in its lane has no leader.
+                ahead = np.searchsorted(lane_ranks, ranks) - 1
+                last = np.searchsorted(lane_ranks, (replica + 1) * n) - 1
+                leader = lane_ranks[np.where((ahead >= 0) & (lane_ranks[ahead] // n == replica), ahead, last)]
+                valid = (leader // n == replica) & (leader != ranks)
+                headways[valid] = (pos[leader[valid]] - pos[valid]) % self.track_length
+
+                # Every collision in the lane at once, from the headways in the cars' own lane
+                collided = np.nonzero(valid & (headways < self.collision_threshold) & (lanes == lane) & running)[0]
+                if len(collided) > 0:
+                    collisions.append((order[collided], order[leader[collided]], np.full(len(collided), lane), headways[collided]))
+
+            self.headway_history[next_row, lane, order] = headways
+
+        self.step_collisions = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+        contacts = set()
+        if len(collisions) > 0:
+            cars, leaders, lanes, gaps = (np.concatenate(values) for values in zip(*collisions))
+            self.step_collisions = (cars, leaders)
+
+            # Only pairs that were not in contact at the last step collided.  Pairs are indexed
+            # like the loop engine's, by replica * num_cars + position in the initial car list.
+            contacts = set(zip(cars.tolist(), leaders.tolist()))
+            new = np.array([pair not in self.contacts for pair in zip(cars.tolist(), leaders.tolist())], dtype=bool)
+            if np.any(new):
+                self.collide(t, row, cars[new], leaders[new], lanes[new], gaps[new])
+        self.contacts = contacts
+
+    # Log the collisions of the step, and stop the replicas they happened in unless the
+    # policy lets them continue
+    # Parameters:
+    #   - t: current time
+    #   - row: history row of the current step
+    #   - cars: index of every car that collided
+    #   - leaders: index of the car each of them collided with
+    #   - lanes: lane of every collision
+    #   - gaps: distance between each car and its leader
+    def collide(self, t: float, row: int, cars: np.ndarray, leaders: np.ndarray, lanes: np.ndarray, gaps: np.ndarray) -> None:
+        replicas = self.replica_of[cars]
+        for replica in np.unique(replicas):
+            members = replicas == replica
+            self.collision_log.record(replica, t, self.ids[cars[members]], self.ids[leaders[members]], lanes[members], gaps[members])
+
+        # Collisions the run continues through are only worth a line of debug output each
+        level = logging.WARNING if self.collision_policy == 'stop' else logging.DEBUG
+        for i, j in zip(cars, leaders):
+            replica = self.replica_of[i]
+            prefix = f'Replica {replica}: ' if self.replicas > 1 else ''
+            self.log("%sCollision between car #%s and car #%s at time t=%s.\n    Car #%s: pos=%s; vel=%s\n    Car #%s: pos=%s; vel=%s",
+                prefix, self.ids[i], self.ids[j], t, self.ids[i], self.pos_history[row, i], self.velocity_history[row, i],
+                self.ids[j], self.pos_history[row, j], self.velocity_history[row, j], level=level)
+            if self.collision_policy != 'stop':
+                continue
+            self.replica_running[replica] = False
+            self.replica_collided[replica] = True
+            self.replica_stop_reasons[replica] = 'collision'
+            self.replica_collided_ids[replica] += [int(self.ids[i]), int(self.ids[j])]
+            self.replica_end_times[replica] = t - self.time_step
+            self.collided = True
+            self.collided_ids += [int(self.ids[i]), int(self.ids[j])]
+            self.end_time = t - self.time_step
+
+    # Slow down every car that collided during the step so that it ends the step at least the
+    # collision threshold behind the car it hit, or where it started the step if it was already
+    # closer than that.  Cars never move backward, since the orderings and the passing counts
+    # rely on it.  Collisions are found lane by lane front to back, so a car behind a clamped
+    # car is clamped against its new position.
+    # Parameters:
+    #   - row: history row of the current step
+    #   - next_row: history row of the next step
+    def clamp_collisions(self, row: int, next_row: int) -> None:
+        start, pos, velocity = self.pos_history[row], self.pos_history[next_row], self.velocity_history[next_row]
+        for i, j in zip(*self.step_collisions):
+            room = (pos[j] - start[i]) % self.track_length - self.collision_threshold
+            if velocity[i] * self.time_step > room:
+                velocity[i] = max(room, 0.0) / self.time_step
+                pos[i] = (start[i] + velocity[i] * self.time_step) % self.track_length
+
+    # Parameters:
+    #   - t: current time
+    #   - next_row: history row of the next step
+    #   - delayed: history row each car perceives the others at
+    def get_velocity(self, t: float, next_row: int, delayed: np.ndarray) -> None:
+        cars = np.arange(self.replicas * self.num_cars)
+        lane = self.lane_history[delayed, cars]
+        dist_to_next = self.headway_history[delayed, lane, cars]
+
+        # Get velocity of cars using Newell's equation
+        weight = self.weights[lane]
+        vel = (self.max_velocities * weight) - (self.max_velocities * weight) * np.exp((-1 * self.lbdas / (weight * self.max_velocities)) * ((dist_to_next - self.headway_thresholds)))
+
+        # Velocity cannot be < 0, and fixed velocities disregard further computation
+        vel = np.where(vel < 0, 0, vel)
+        vel = np.where(np.isnan(self.fixed_velocities), vel, self.fixed_velocities)
+
+        self.velocity_history[next_row] = vel
+
+    # Parameters:
+    #   - t: current time
+    #   - row: history row of the current step
+    #   - next_row: history row of the next step
+    def get_position(self, t: float, row: int, next_row: int) -> None:
+        stepsize = self.velocity_history[next_row] * self.time_step
+        self.pos_history[next_row] = (self.pos_history[row] + stepsize) % self.track_length
+
+    # Expose the evaluated history through the Car objects so that post run scripts
+    # and the CarBase getters keep working.  These are views, not copies.  The first
+    # replica uses the original Car objects, the others get copies of them.
+    def save_to_cars(self) -> None:
+        n = self.num_cars
+        cars = list(self.cars)
+        self.replica_cars = []
+        for replica in range(0, self.replicas):
+            replica_cars = cars if replica == 0 else [copy(c) for c in cars]
+            for c in replica_cars:
+                c.history_offset = self.history_offset
+            if self.history == 'full':
+                rows = self.rows[replica]
+                for i, c in enumerate(replica_cars):
+                    g = replica * n + i
+                    c.time = History.wrap(self.time_history[:rows, g])
+                    c.pos = History.wrap(self.pos_history[:rows, g])
+                    c.velocity = History.wrap(self.velocity_history[:rows, g])
+                    c.impatience = History.wrap(self.impatience_history[:rows, g])
+                    c.lanes = History.wrap(self.lane_history[:rows, g])
+                    c.headway = [History.wrap(self.headway_history[:rows, lane, g]) for lane in range(0, self.lane_count)]
+            self.replica_cars.append([replica_cars[g - replica * n] for g in self.output_order[replica]])
+        self.cars = self.replica_cars[0]
+
+    # Write the whole history of every car of a replica to an output sink, one car at a time
+    # Parameters:
+    #   - sink: object with a write(columns) method
+    #   - replica: replica to write
+    def write_history(self, sink, replica: int = 0) -> None:
+        if self.history != 'full':
+            raise RuntimeError('Only the most recent history is kept, attach an output sink to save the run instead.')
+        first, rows = self.first_step + 1, self.rows[replica]
+        for i in self.output_order[replica]:
+            sink.write([
+                np.full(max(rows - first, 0), self.ids[i]),
+                self.time_history[first:rows, i],
+                self.pos_history[first:rows, i],
+                self.velocity_history[first:rows, i],
+                self.impatience_history[first:rows, i],
+                self.lane_history[first:rows, i]] + [self.headway_history[first:rows, lane, i] for lane in range(0, self.lane_count)])
+
+    def dump(self, filename="data/run.csv", replica: int = 0) -> None:
+        if self.history != 'full':
+            raise RuntimeError('Only the most recent history is kept, attach an output sink to save the run instead.')
+        first, rows = self.first_step + 1, self.rows[replica]
+        with open(filename, 'w', newline='') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(output_columns(self.lane_count))
+            for i in self.output_order[replica]:
+                columns = [
+                    [int(self.ids[i])] * max(rows - first, 0),
+                    np.round(self.time_history[first:rows, i], 4).tolist(),
+                    np.round(self.pos_history[first:rows, i], 6).tolist(),
+                    np.round(self.velocity_history[first:rows, i], 6).tolist(),
+                    np.round(self.impatience_history[first:rows, i], 6).tolist(),
+                    self.lane_history[first:rows, i].tolist()] + [self.headway_history[first:rows, lane, i].tolist() for lane in range(0, self.lane_count)]
+                writer.writerows(zip(*columns))
@@ -1,8 +1,7 @@
 import pygame, sys
 from pygame.locals import *
-from models.carbase import CarBase
+from util.output_reader import load_cars_from_binary, load_cars_from_csv
 from math import *
-import csv
 
 
 class DrawCar:
@@ -53,41 +52,29 @@ class Visualizer:
         self.lane_count = lane_count
 
     def load(self, filename='data/run.csv'):
-        with open(filename, 'r') as file:
-            reader = csv.reader(file)
-            for rownum, row in enumerate(reader):
-
-                # Skip first row
-                if rownum == 0:
-                    continue
-
-                # Get data from csv
-                id = int(row[0])
-                position = float(row[2])
-                velocity = float(row[3])
-                time = float(row[1])
-                impatience = float(row[4])
-                lane = int(row[5])
-
-
-                # Make a new car if it doesn't exist
-                if id not in self.car_ids:
-                    self.car_ids.append(id)
-                    self.cars.append(CarBase(id))
-                    self.draw_cars[id] = DrawCar(id)
-
-                # Add information to car
-                self.cars[-1].pos.append(position)
-                self.cars[-1].velocity.append(velocity)
-                self.cars[-1].time.append(time)
-                self.cars[-1].lanes.append(lane)
-                self.cars[-1].impatience.append(impatience)
+        if filename.endswith('.bin'):
+            self.load_binary(filename)
+        else:
+            self.load_csv(filename)
 
         # Set time step and fps so it scales appropriately with simulation data
         self.time_step = self.cars[-1].time[-1] - self.cars[-1].time[-2]
         self.fps = int(3 / self.time_step) # 3 to make it a bit sped up
         self.fps_modifier = int(self.fps / 10)
 
+    # Load binary output, memory mapped rather than parsed
+    def load_binary(self, filename: str) -> None:
+        self.cars = load_cars_from_binary(filename)
+        for car in self.cars:
+            self.car_ids.append(car.id)
+            self.draw_cars[car.id] = DrawCar(car.id)
+
+    def load_csv(self, filename: str) -> None:
+        self.cars = load_cars_from_csv(filename)
+        for car in self.cars:
+            self.car_ids.append(car.id)
+            self.draw_cars[car.id] = DrawCar(car.id)
+
     def update_cars(self):
         # Keep parsing simulation data if we're running
         if self.running:
@@ -1,6 +1,7 @@
 from argparse import ArgumentParser
 from typing import List
 from util.visualizer import Visualizer
+from util.output_sink import OUTPUT_EXTENSIONS
 import uuid
 import csv
 
@@ -65,5 +66,7 @@ if __name__ == '__main__':
         int(simulation_params['LaneCount']),
         float(simulation_params['L_car']))
 
-    visualizer.load(f'{args.dir}{simulation_id}.csv')
+    # Older manifests do not record an output format, their output is always CSV
+    extension = OUTPUT_EXTENSIONS[simulation_params.get('OutputFormat') or 'csv']
+    visualizer.load(f'{args.dir}{simulation_id}.{extension}')
     visualizer.run()
@@ -0,0 +1,5 @@
+import sys
+from os import path
+
+# The simulator imports its modules relative to src, as when it is run from there
+sys.path.insert(0, path.join(path.dirname(path.dirname(path.abspath(__file__))), 'src'))
@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+
+from util.model import Model
+from util.vectorized_model import VectorizedModel
+from test_engine_parity import StepSink, make_cars
+
+TIME_STEP = 0.1
+
+# Params:
+#   - engine: model class to build
+#   - history: history mode of the run
+#   - max_time: end time of the run
+# Returns:
+#   - a model of a multi-lane run with a reaction time, not evaluated yet
+def build(engine, history: str = 'full', max_time: float = 30.0):
+    model = engine(lbda=1.0, start_time=0, max_time=max_time, collision_threshold=5.0, time_step=TIME_STEP, track_length=1000.0,
+        cars=make_cars(20, 2, 1.0, TIME_STEP), lane_count=2, lane_vmax_weights=[1.0, 1.0], passing_modifier=0.2,
+        history=history, seed=1, collision_policy='clamp')
+    model.sink = StepSink()
+    return model
+
+# Params:
+#   - model: evaluated model
+#   - times: times to read
+# Returns:
+#   - position, velocity, lane, impatience and headway of every car at each of the times
+def read_at_times(model, times: list) -> np.ndarray:
+    return np.array([[[car.get_pos_at_time(t), car.get_velocity_at_time(t), car.get_lane_at_time(t), car.get_impatience_at_time(t),
+        car.get_headway_at_time(t, 0), car.get_headway_at_time(t, 1)] for t in times] for car in sorted(model.cars, key=lambda c: c.id)])
+
+# A restored run writes the samples the original run wrote after the checkpoint, and the
+# time getters of its cars read the same values at those times
+@pytest.mark.parametrize('engine', [Model, VectorizedModel])
+def test_restored_run_continues_the_original(engine, tmp_path):
+    filename = str(tmp_path / 'run.ckpt')
+    original = build(engine)
+    original.attach_checkpoints(filename, 120)
+    original.evaluate()
+
+    restored = build(engine)
+    restored.restore_checkpoint(filename)
+    assert restored.step == 240
+    restored.evaluate()
+
+    after = original.sink.samples()
+    after = after[after[:, 1] >= 24.0 - 1e-9]
+    assert np.array_equal(restored.sink.samples(), after)
+
+    times = [24.0 + 0.5 * i for i in range(0, 12)]
+    assert np.array_equal(read_at_times(restored, times), read_at_times(original, times))
+    assert restored.collision_log.get_state() == original.collision_log.get_state()
+
+# A warm started run places the saved window before t = 0, so its first sample and the time
+# getters at t = 0 read the end state of the run it started from
+@pytest.mark.parametrize('engine', [Model, VectorizedModel])
+def test_warm_start_lines_up_at_zero(engine, tmp_path):
+    filename = str(tmp_path / 'end.ckpt')
+    burn_in = build(engine, max_time=20.0)
+    burn_in.evaluate()
+    burn_in.save_checkpoint(filename)
+
+    warm = build(engine, max_time=5.0)
+    warm.warm_start(filename)
+    warm.evaluate()
+
+    assert np.array_equal(read_at_times(warm, [0.0]), read_at_times(burn_in, [20.0]))
+    # Times before the start read the saved window
+    assert np.array_equal(read_at_times(warm, [-0.5, -0.1]), read_at_times(burn_in, [19.5, 19.9]))
+    # The first sample is written at t = 0, from the saved state
+    assert warm.sink.steps[0][:, 1].tolist() == [0.0] * warm.num_cars
+    for car in warm.cars:
+        assert car.time[warm.first_step + 1] == 0.0
@@ -0,0 +1,126 @@
+import numpy as np
+import pytest
+from random import Random
+
+from models.car import Car
+from util.loggable import configure_logging
+from util.model import Model
+from util.vectorized_model import VectorizedModel
+
+# Largest difference between the engines in any position, velocity, impatience or headway
+TOLERANCE = 1e-9
+
+configure_logging('ERROR')
+
+# Params:
+#   - n: number of cars
+#   - lanes: number of lanes
+#   - delta: reaction time of every car
+#   - time_step: time step of the run
+#   - seed: seed of the jitter of the initial positions
+# Returns:
+#   - cars spread evenly over the lanes of a 1000m track, jittered so that some of them collide
+def make_cars(n: int, lanes: int, delta: float, time_step: float, seed: int = 0) -> list:
+    rng = Random(seed)
+    cars = [Car(id=i + 1, reaction_time=delta, headway_threshold=7.5, x_0=i * (1000.0 / n) + rng.random() * 3, t_0=0,
+        h_0=lanes * (1000.0 / n), max_v=40.0, time_step=time_step, lane=i % lanes, lane_count=lanes, impatience_step=0.2) for i in range(n)]
+    return sorted(cars, key=lambda car: car.pos[-1], reverse=True)
+
+# Params:
+#   - engine: model class to run
+#   - policy: collision policy of the run
+#   - history: history mode of the run
+# Returns:
+#   - the evaluated model
+def run(engine, policy: str, history: str = 'full', n: int = 25, lanes: int = 2, delta: float = 1.0, time_step: float = 0.1, max_time: float = 60.0):
+    model = engine(lbda=1.0, start_time=0, max_time=max_time, collision_threshold=5.0, time_step=time_step, track_length=1000.0,
+        cars=make_cars(n, lanes, delta, time_step), lane_count=lanes, lane_vmax_weights=[1.0] * lanes, passing_modifier=0.2,
+        history=history, seed=1, collision_policy=policy)
+    model.sink = StepSink()
+    model.evaluate()
+    return model
+
+# Collects the samples of every step handed to it by a model, as one row per car and step
+class StepSink:
+    def __init__(self) -> None:
+        self.steps = []
+
+    def write(self, columns: list) -> None:
+        self.steps.append(np.array(columns, dtype=float).T)
+
+    # Returns:
+    #   - every sample, sorted by time and car id
+    def samples(self) -> np.ndarray:
+        samples = np.concatenate(self.steps)
+        return samples[np.lexsort((samples[:, 0], samples[:, 1]))]
+
+# Params:
+#   - a: evaluated model
+#   - b: evaluated model of the same run
+# Returns:
+#   - largest difference between the trajectories of the cars of the models
+def max_difference(a, b) -> float:
+    cars = {car.id: car for car in b.cars}
+    difference = 0.0
+    for car in a.cars:
+        other = cars[car.id]
+        for attribute in ('time', 'pos', 'velocity', 'impatience', 'lanes'):
+            x, y = np.array(getattr(car, attribute), dtype=float), np.array(getattr(other, attribute), dtype=float)
+            assert x.shape == y.shape
+            difference = max(difference, float(np.max(np.abs(x - y))))
+        for lane in range(0, a.lane_count):
+            difference = max(difference, float(np.max(np.abs(np.array(car.headway[lane], dtype=float) - np.array(other.headway[lane], dtype=float)))))
+    return difference
+
+# The engines agree on every sample of a multi-lane run with a reaction time, whatever the
+# policy does about its collisions and however much history is kept
+@pytest.mark.parametrize('history', ['full', 'ring'])
+@pytest.mark.parametrize('policy', ['stop', 'clamp'])
+def test_engines_agree(policy: str, history: str):
+    a, b = run(Model, policy, history), run(VectorizedModel, policy, history)
+    assert a.collision_log.count() > 0
+    assert a.collision_log.events == b.collision_log.events
+    assert a.collided_ids == b.collided_ids
+    assert a.get_stop() == b.get_stop()
+    assert a.lane_changes == b.lane_changes
+    x, y = a.sink.samples(), b.sink.samples()
+    assert x.shape == y.shape
+    assert np.max(np.abs(x - y)) <= TOLERANCE
+    if history == 'full':
+        assert max_difference(a, b) <= TOLERANCE
+
+# Removing cars is only supported by the loop engine, which gives the same samples whatever
+# history it keeps
+def test_remove_history_modes_agree():
+    full, ring = run(Model, 'remove', 'full'), run(Model, 'remove', 'ring')
+    assert len(full.removed_cars) > 0
+    assert full.collision_log.events == ring.collision_log.events
+    assert np.array_equal(full.sink.samples(), ring.sink.samples())
+    with pytest.raises(ValueError):
+        run(VectorizedModel, 'remove')
+
+def test_clamp_never_moves_cars_backward():
+    model = run(Model, 'clamp')
+    for car in model.cars:
+        steps = np.diff(np.array(car.pos, dtype=float)) % model.track_length
+        assert np.all(steps < model.track_length / 2)
+
+# Counts the car steps spent in contact, next to the collisions that are logged
+class ContactCountingModel(Model):
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.contact_steps = 0
+
+    def detect_collisions(self, t: float, k: int) -> None:
+        super().detect_collisions(t, k)
+        self.contact_steps += len(self.step_collisions)
+
+# A contact that lasts several steps is a single collision, logged at the step it started
+def test_sustained_contact_is_counted_once():
+    model = run(ContactCountingModel, 'clamp')
+    assert model.contact_steps > model.collision_log.count() > 0
+    last = {}
+    for t, car, leader, _, _ in model.collision_log.events[0]:
+        if (car, leader) in last:
+            assert t - last[(car, leader)] > model.time_step * 1.5
+        last[(car, leader)] = t
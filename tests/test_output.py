@@ -0,0 +1,122 @@
+import csv
+from threading import Event
+
+import numpy as np
+import pytest
+
+from util.model import Model
+from util.output_reader import load_cars_from_binary, load_cars_from_csv, read_binary_output
+from util.output_sink import BINARY_MAGIC, BinarySink, CsvSink, StreamingWriter, output_columns
+from test_engine_parity import make_cars
+
+LANES = 2
+
+# Params:
+#   - sink: sink to hand the samples of every step to
+# Returns:
+#   - the evaluated model of a short seeded multi-lane run
+def run_into(sink) -> Model:
+    model = Model(lbda=1.0, start_time=0, max_time=10.0, collision_threshold=5.0, time_step=0.1, track_length=1000.0,
+        cars=make_cars(20, LANES, 1.0, 0.1), lane_count=LANES, lane_vmax_weights=[1.0] * LANES, passing_modifier=0.2,
+        seed=1, collision_policy='clamp')
+    model.attach_sink(sink)
+    model.evaluate()
+    sink.close()
+    return model
+
+# Params:
+#   - filename: CSV output file
+# Returns:
+#   - the header and every row of the file as floats
+def read_csv(filename: str) -> tuple:
+    with open(filename, 'r', newline='') as file:
+        reader = csv.reader(file)
+        header = next(reader)
+        return header, np.array([[float(value) for value in row] for row in reader])
+
+# Sink that records what it is handed, and lets a test wait for a flush
+class RecordingSink:
+    def __init__(self) -> None:
+        self.steps = []
+        self.flushes = []
+        self.flushed = Event()
+        self.closed = False
+
+    def write(self, columns: list) -> None:
+        self.steps.append(columns)
+
+    def flush(self) -> None:
+        self.flushes.append(len(self.steps))
+        self.flushed.set()
+
+    def close(self) -> None:
+        self.closed = True
+
+# Every full chunk is written and flushed while the run goes on, the rest when it closes
+def test_streaming_writer_flushes_every_chunk():
+    sink = RecordingSink()
+    writer = StreamingWriter(sink, chunk_steps=10)
+    for step in range(0, 9):
+        writer.write([[step]])
+    assert not sink.flushed.wait(0.2)
+
+    writer.write([[9]])
+    assert sink.flushed.wait(5.0)
+    assert sink.flushes == [10]
+
+    for step in range(10, 25):
+        writer.write([[step]])
+    writer.close()
+    assert sink.flushes == [10, 20, 25]
+    assert [columns[0][0] for columns in sink.steps] == list(range(0, 25))
+    assert sink.closed
+
+# A streamed run writes the same samples, in the same order, as the run written to the sink directly
+@pytest.mark.parametrize('chunk_steps', [1, 7, 1000])
+def test_streamed_output_matches_direct_output(tmp_path, chunk_steps: int):
+    run_into(CsvSink(f'{tmp_path}/direct.csv', LANES))
+    run_into(StreamingWriter(CsvSink(f'{tmp_path}/streamed.csv', LANES), chunk_steps))
+
+    header, direct = read_csv(f'{tmp_path}/direct.csv')
+    streamed_header, streamed = read_csv(f'{tmp_path}/streamed.csv')
+    assert header == streamed_header == output_columns(LANES)
+    assert len(direct) == 20 * 100
+    assert np.array_equal(streamed, direct)
+
+# Binary output holds the samples of the CSV output at full precision, and reads back as the
+# same cars
+def test_binary_output_matches_csv(tmp_path):
+    run_into(StreamingWriter(CsvSink(f'{tmp_path}/run.csv', LANES), 7))
+    model = run_into(StreamingWriter(BinarySink(f'{tmp_path}/run.bin', LANES), 7))
+
+    header, rows = read_csv(f'{tmp_path}/run.csv')
+    records = read_binary_output(f'{tmp_path}/run.bin')
+    assert list(records.dtype.names) == header
+    assert len(records) == len(rows)
+    # CSV rounds time to 4 digits and the states of the cars to 6
+    for column, digits in zip(header, [None, 4, 6, 6, 6, None] + [None] * LANES):
+        values = records[column].astype(float)
+        assert np.array_equal(values if digits is None else np.round(values, digits), rows[:, header.index(column)]), column
+
+    binary_cars, csv_cars = load_cars_from_binary(f'{tmp_path}/run.bin'), load_cars_from_csv(f'{tmp_path}/run.csv')
+    assert [car.id for car in binary_cars] == [car.id for car in csv_cars]
+    final = {car.id: car for car in model.cars}
+    for binary, text in zip(binary_cars, csv_cars):
+        assert np.array_equal(np.array(binary.lanes), np.array(text.lanes))
+        assert np.allclose(np.array(binary.pos), np.array(text.pos), rtol=0, atol=5e-7)
+        assert binary.pos[-1] == final[binary.id].pos[-1]
+        assert binary.velocity[-1] == final[binary.id].velocity[-1]
+
+# A partially written record at the end of the file, left by a killed run, is ignored
+def test_binary_output_ignores_partial_record(tmp_path):
+    filename = f'{tmp_path}/run.bin'
+    run_into(BinarySink(filename, LANES))
+    records = read_binary_output(filename).copy()
+    with open(filename, 'ab') as file:
+        file.write(b'\x00' * 5)
+    assert np.array_equal(read_binary_output(filename), records)
+
+    with open(f'{tmp_path}/other.bin', 'wb') as file:
+        file.write(BINARY_MAGIC[:-1] + b'\x02')
+    with pytest.raises(ValueError, match='not a binary simulation output'):
+        read_binary_output(f'{tmp_path}/other.bin')
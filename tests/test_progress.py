@@ -0,0 +1,40 @@
+from queue import Queue
+
+from util.progress import ProgressReporter, SweepProgress
+
+# Returns:
+#   - every report put on the queue so far
+def drain(queue: Queue) -> list:
+    messages = []
+    while not queue.empty():
+        messages.append(queue.get())
+    return messages
+
+# A run that stops between two reports still reports the step it stopped at
+def test_early_stop_reports_last_step():
+    queue = Queue()
+    reporter = ProgressReporter('run', 10, queue)
+    reporter.start(0, 100)
+    reporter.update(10, 0.95)
+    reporter.evaluated(17, 1.65)
+    events = [(message['Event'], message['Step'], message['Time']) for message in drain(queue)]
+    assert events == [('start', 0, None), ('progress', 10, 0.95), ('progress', 17, 1.65), ('evaluated', 17, None)]
+
+    # A run that stops on a report is not reported twice
+    reporter.start(0, 100)
+    reporter.update(20, 1.95)
+    reporter.evaluated(20, 1.95)
+    assert [message['Event'] for message in drain(queue)] == ['start', 'progress', 'evaluated']
+
+# The total of the sweep leaves out the steps restored runs skip and early stops do not run
+def test_sweep_total_counts_steps_actually_run():
+    progress = SweepProgress(Queue(), 2, 200)
+    progress.handle({'Event': 'start', 'Id': 'restored', 'Step': 60, 'FirstStep': 60, 'Steps': 100})
+    progress.handle({'Event': 'start', 'Id': 'stopped', 'Step': 0, 'FirstStep': 0, 'Steps': 100})
+    assert progress.total_steps == 140
+
+    progress.handle({'Event': 'done', 'Id': 'restored', 'Step': 100, 'FirstStep': 60, 'Steps': 100})
+    progress.handle({'Event': 'done', 'Id': 'stopped', 'Step': 25, 'FirstStep': 0, 'Steps': 100})
+    assert progress.done == 2
+    assert progress.total_steps == progress.done_steps == 65
+    assert progress.in_flight == {}
@@ -0,0 +1,93 @@
+import json
+import os
+
+from util.result_cache import ResultCache
+from util.traffic_simulator import SimulationWorker, TrafficSimulator
+
+# Params:
+#   - directory: directory to write the config and the output of its runs to
+#   - config: parameters to add to or replace in a short seeded run of a generated population
+# Returns:
+#   - the config file
+def write_config(directory, **config) -> str:
+    config = dict({'Density': 0.02, 'L_track': 500.0, 'LaneCount': 2, 'TimeStep': 0.1, 't_max': 2.0, 'Seed': 7,
+        'OutputDirectory': f'{directory}/out/'}, **config)
+    filename = f'{directory}/config.json'
+    with open(filename, 'w') as file:
+        json.dump(config, file)
+    return filename
+
+# Params:
+#   - directory: directory to write the sweep to
+#   - config: base config file
+#   - axes: axes of the sweep
+# Returns:
+#   - the sweep file
+def write_sweep(directory, config: str, axes: dict) -> str:
+    filename = f'{directory}/sweep.json'
+    with open(filename, 'w') as file:
+        json.dump({'Base': config, 'Axes': axes}, file)
+    return filename
+
+# Params:
+#   - monkeypatch: pytest fixture, counts the simulations the workers execute
+#   - configs: config files to run
+#   - sweeps: sweep files to run
+# Returns:
+#   - the simulator once it ran, and the number of simulations it executed
+def run_cached(monkeypatch, configs: list = [], sweeps: list = []) -> tuple:
+    executed = []
+    execute = SimulationWorker.execute
+    monkeypatch.setattr(SimulationWorker, 'execute', lambda worker, task: executed.append(task) or execute(worker, task))
+    simulator = TrafficSimulator(configs, manifest=os.devnull, sweeps=sweeps, cache=True)
+    simulator.run()
+    return simulator, len(executed)
+
+# Turning on progress reports or profiling keeps the run id, changing a script does not
+def test_run_id_ignores_reporting_parameters(tmp_path):
+    script = tmp_path / 'pre_run_script.py'
+    script.write_text('# first version\n')
+    config = {'Lambda': 1.0, 'Seed': 3, 'PreRunScript': str(script)}
+    Id = ResultCache().run_id(config, 0)
+
+    reported = dict(config, ProgressInterval=100, Profile=True, ProfileMemory=True, StreamOutput=True, OutputChunkSteps=10)
+    assert ResultCache().run_id(reported, 0) == Id
+    assert ResultCache().run_id(dict(config, Lambda=2.0), 0) != Id
+    assert ResultCache().run_id(config, 1) != Id
+
+    script.write_text('# second version\n')
+    assert ResultCache().run_id(config, 0) != Id
+
+# A run found in the cache is listed again without running, whatever is reported
+def test_finished_run_is_skipped(tmp_path, monkeypatch):
+    config = write_config(tmp_path)
+    first, executed = run_cached(monkeypatch, configs=[config])
+    assert executed == 1
+
+    write_config(tmp_path, ProgressInterval=5, Profile=True)
+    second, executed = run_cached(monkeypatch, configs=[config])
+    assert executed == 0
+    assert [row['Id'] for row in second.results] == [str(row['Id']) for row in first.results]
+
+# A run without a seed draws a new one every time, so it always runs again
+def test_unseeded_run_is_not_cached(tmp_path, monkeypatch):
+    config = write_config(tmp_path, Seed=None)
+    first, executed = run_cached(monkeypatch, configs=[config])
+    assert executed == 1
+    second, executed = run_cached(monkeypatch, configs=[config])
+    assert executed == 1
+    assert second.results[0]['Id'] != first.results[0]['Id']
+
+# A sweep that stopped part way through only runs the simulations it did not finish
+def test_interrupted_sweep_resumes(tmp_path, monkeypatch):
+    sweep = write_sweep(tmp_path, write_config(tmp_path), {'Lambda': [0.5, 1.0, 2.0]})
+    first, executed = run_cached(monkeypatch, sweeps=[sweep])
+    assert executed == 3
+
+    # Lose the last run, as if the sweep was killed before it finished
+    lost = first.results[-1]
+    os.remove(f"{lost['OutputDirectory']}{lost['Id']}.json")
+
+    second, executed = run_cached(monkeypatch, sweeps=[sweep])
+    assert executed == 1
+    assert sorted(str(row['Id']) for row in second.results) == sorted(str(row['Id']) for row in first.results)
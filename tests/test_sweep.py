@@ -0,0 +1,83 @@
+import csv
+import json
+from math import log
+
+import pytest
+
+from util.sweep import load_sweep
+from util.traffic_simulator import TrafficSimulator
+
+# Params:
+#   - directory: directory to write the sweep to
+#   - spec: sweep spec
+# Returns:
+#   - the sweep file
+def write_sweep(directory, spec: dict) -> str:
+    filename = f'{directory}/sweep.json'
+    with open(filename, 'w') as file:
+        json.dump(spec, file)
+    return filename
+
+# Lists and ranges are swept as a grid, with the stop of a range included
+def test_grid_of_lists_and_ranges(tmp_path):
+    sweep = load_sweep(write_sweep(tmp_path, {'Base': {'t_max': 1.0}, 'Axes': {'Lambda': [0.5, 1.0], 'Delta': {'Range': [0.0, 0.3, 0.1]}}}))
+    assert sweep.names == ['Lambda', 'Delta']
+    assert sweep.points == [(Lambda, Delta) for Lambda in [0.5, 1.0] for Delta in [0.0, 0.1, 0.2, 0.3]]
+    assert sweep.overrides(sweep.points[-1]) == {'Lambda': 1.0, 'Delta': 0.3}
+    assert sweep.base == {'t_max': 1.0}
+
+# A base config given as a file is read from it
+def test_base_config_file(tmp_path):
+    config = tmp_path / 'config.json'
+    config.write_text(json.dumps({'t_max': 2.0}))
+    sweep = load_sweep(write_sweep(tmp_path, {'Base': str(config), 'Axes': {'Lambda': [1.0]}}))
+    assert sweep.base == {'t_max': 2.0}
+    assert sweep.points == [(1.0,)]
+
+# Random axes are drawn Samples times for every point of the grid, the same way for the same seed
+def test_random_axes_are_repeatable(tmp_path):
+    spec = {'Base': {}, 'Axes': {
+        'Lambda': [0.5, 1.0],
+        'PassingModifier': {'Uniform': [0.0, 0.5]},
+        'ImpatienceStep': {'LogUniform': [0.001, 0.1]},
+        'LaneCount': {'Choice': [1, 2, 3]}
+    }, 'Samples': 5, 'Seed': 42}
+    sweep = load_sweep(write_sweep(tmp_path, spec))
+    assert sweep.names == ['Lambda', 'PassingModifier', 'ImpatienceStep', 'LaneCount']
+    assert len(sweep.points) == 10
+    assert [point[0] for point in sweep.points] == [0.5] * 5 + [1.0] * 5
+    for _, modifier, step, lanes in sweep.points:
+        assert 0.0 <= modifier <= 0.5
+        assert log(0.001) <= log(step) <= log(0.1)
+        assert lanes in [1, 2, 3]
+
+    assert load_sweep(write_sweep(tmp_path, spec)).points == sweep.points
+    assert load_sweep(write_sweep(tmp_path, dict(spec, Seed=43))).points != sweep.points
+
+@pytest.mark.parametrize('axes, message', [
+    ({'Lambda': {'Range': [1.0, 0.0, -0.5]}}, 'positive step'),
+    ({'Lambda': {'LogUniform': [0.0, 1.0]}}, 'must be positive'),
+    ({'Lambda': 1.0}, 'Unknown axis')
+])
+def test_invalid_axes(tmp_path, axes: dict, message: str):
+    with pytest.raises(ValueError, match=message):
+        load_sweep(write_sweep(tmp_path, {'Base': {}, 'Axes': axes}))
+
+def test_missing_base(tmp_path):
+    with pytest.raises(ValueError, match='Base'):
+        load_sweep(write_sweep(tmp_path, {'Axes': {'Lambda': [1.0]}}))
+
+# Every run of a sweep records its swept values in the SweepValues column of the manifest
+def test_sweep_values_column(tmp_path):
+    base = {'Density': 0.02, 'L_track': 500.0, 'TimeStep': 0.1, 't_max': 1.0, 'Seed': 1, 'OutputDirectory': f'{tmp_path}/out/'}
+    sweep = write_sweep(tmp_path, {'Base': base, 'Axes': {'Lambda': [0.5, 1.0], 'LaneCount': {'Range': [1, 2, 1]}}})
+    manifest = f'{tmp_path}/manifest.csv'
+    TrafficSimulator([], manifest=manifest, sweeps=[sweep]).run()
+
+    with open(manifest, 'r', newline='') as file:
+        rows = list(csv.DictReader(file))
+    values = sorted((json.loads(row['SweepValues']) for row in rows), key=lambda values: (values['Lambda'], values['LaneCount']))
+    assert values == [{'Lambda': Lambda, 'LaneCount': lanes} for Lambda in [0.5, 1.0] for lanes in [1, 2]]
+    for row in rows:
+        assert float(row['Lambda']) == json.loads(row['SweepValues'])['Lambda']
+        assert int(row['LaneCount']) == json.loads(row['SweepValues'])['LaneCount']